@@ -8,7 +8,7 @@
 // UT wifi setup (REPLACE THESE WITH YOUR SETTINGS)
 const char* SSID = "<YOUR_WIFI_SSID>"; 
 const char* PASSWORD = "<YOUR_WIFI_PASSKEY>";
-const char* WEBHOOK_URL = "https://<VPS_IP>:<VPS_PORT>/<TELEGRAM_BOT_TOKEN>/";
+const char* WEBHOOK_URL = "https://<VPS_IP>:<VPS_PORT>/<TELEGRAM_BOT_TOKEN>/sensor";
 const char* LOCATION_NAME = "Bedroom Door"
 
 
@@ -0,0 +1,164 @@
+#include "M5StickCPlus.h"
+#include <HTTPClient.h>
+#include <WiFi.h>
+#include <ArduinoJson.h>  // Needs to be installed via Arduino library manager
+
+// Configuration
+const char* SSID = "<YOUR_WIFI_SSID>"; 
+const char* PASSWORD = "<YOUR_WIFI_PASSKEY>";
+const char* WEBHOOK_URL = "https://<VPS_IP>:<VPS_PORT>/<TELEGRAM_BOT_TOKEN>/sensor";
+const char* LOCATION_NAME = "Bedroom Door";
+const int POLLING_PERIOD = 1000; // Polling period in milliseconds between sensor readings 1000 = 1 second
+const int SEND_PERIOD = 10000;   // Maximum time in milliseconds that readings are buffered before being sent
+                                 // Must stay below SENSOR_DISCONNECT_TIME on the server
+
+// Buffered readings, sent together in a single "sensor_batch" request
+const int MAX_READINGS = 16;
+struct Reading {
+  const char* sensorStatus;
+  unsigned long takenAt; // millis() when the reading was taken
+  unsigned long seq;     // Sequence number, so the server drops readings of a batch that is resent
+};
+Reading readings[MAX_READINGS];
+int readingCount = 0;
+unsigned long lastSend = 0;
+unsigned long retryAt = 0; // millis() until which the server asked not to send again (429 with Retry-After)
+const char* RESPONSE_HEADERS[] = {"Retry-After"};
+unsigned long nextSeq = 0;
+uint32_t bootId = 0; // Random id chosen at startup, since the sequence numbers start over after a restart
+
+// Function to setup the device on the wireless network
+void setup_wifi() {
+  delay(10);
+  // We start by connecting to a WiFi network
+  M5.Lcd.println();
+  M5.Lcd.print("Connecting to ");
+  M5.Lcd.println(SSID);
+
+  //WiFi.mode(WIFI_STA);
+  WiFi.begin(SSID, PASSWORD);
+
+  // Print "." until the network is connected for better UX
+  while (WiFi.status() != WL_CONNECTED) {
+    delay(1000);
+    M5.Lcd.print(".");
+  }
+
+  // Print the local IP of the device once connected to the network
+  M5.Lcd.println("");
+  M5.Lcd.println("WiFi connected");
+  M5.Lcd.println("IP address: ");
+  M5.Lcd.println(WiFi.localIP());
+}
+
+bool checkWifiConnection() {
+  if (WiFi.status() != WL_CONNECTED) {
+    M5.Lcd.println("Reconnecting to WiFi...");
+    setup_wifi();
+    return WiFi.status() == WL_CONNECTED;
+  }
+  return true;
+}
+
+void sendBatchRequest() {
+  if (readingCount == 0 || (long)(millis() - retryAt) < 0) {
+    return; // Keep buffering while the server is busy, the readings are sent once the retry time has passed
+  }
+  if (checkWifiConnection()) {
+    HTTPClient http;
+    http.begin(WEBHOOK_URL); // Webhook URL
+    http.addHeader("Content-Type", "application/json");
+    http.collectHeaders(RESPONSE_HEADERS, 1);
+
+    DynamicJsonDocument doc(128 + MAX_READINGS * 64);
+    doc["action"] = "sensor_batch";
+    doc["location"] = LOCATION_NAME;
+    doc["boot"] = bootId;
+    JsonArray batch = doc.createNestedArray("readings");
+
+    // The server timestamps each reading using its age when the batch is sent
+    unsigned long now = millis();
+    for (int i = 0; i < readingCount; i++) {
+      JsonObject reading = batch.createNestedObject();
+      reading["sensor_status"] = readings[i].sensorStatus;
+      reading["age_ms"] = now - readings[i].takenAt;
+      reading["seq"] = readings[i].seq;
+    }
+
+    String payload;
+    serializeJson(doc, payload);
+
+    int httpResponseCode = http.POST(payload);
+
+    // Print the response on the LCD
+    M5.Lcd.fillScreen(BLACK);
+    M5.Lcd.setCursor(0, 0);
+    if(httpResponseCode >= 200 && httpResponseCode < 300) {
+      String response = http.getString();
+      M5.Lcd.println(response);
+      readingCount = 0; // Only clear the buffer once the server has handled it
+    } else if(httpResponseCode == 429) {
+      // The server is overloaded, keep the readings and wait as long as it asks before sending them again
+      long retryAfter = max(http.header("Retry-After").toInt(), 1L);
+      retryAt = millis() + retryAfter * 1000;
+      M5.Lcd.println("Server busy, retry in " + String(retryAfter) + "s");
+    } else if(httpResponseCode > 0) {
+      // Keep the readings, they are sent again with the next request
+      M5.Lcd.println("HTTP Error: " + String(httpResponseCode));
+    } else {
+      M5.Lcd.println("POST Error: " + String(httpResponseCode));
+    }
+
+    http.end();
+  } else {
+    M5.Lcd.println("Failed to Connect WiFi");
+  }
+  lastSend = millis();
+}
+
+void bufferReading(const char* sensorStatus) {
+  if (readingCount == MAX_READINGS) {
+    // Drop the oldest reading to make room, the newest state is the one that matters
+    for (int i = 1; i < MAX_READINGS; i++) {
+      readings[i - 1] = readings[i];
+    }
+    readingCount--;
+  }
+  readings[readingCount].sensorStatus = sensorStatus;
+  readings[readingCount].takenAt = millis();
+  readings[readingCount].seq = nextSeq++;
+  readingCount++;
+}
+
+void setup() {
+  M5.begin();
+  bootId = esp_random() & 0x7FFFFFFF;
+  pinMode(26, INPUT_PULLUP);
+  M5.Lcd.setRotation(3);
+  M5.Lcd.fillScreen(BLACK);
+  M5.Lcd.setTextColor(WHITE);
+  M5.Lcd.setTextSize(2);
+  setup_wifi();
+}
+
+void loop() {
+  static int lastState = -1; // To store the last state
+  int sensorState = digitalRead(26);
+
+  if (sensorState == HIGH) {
+    M5.Lcd.println("Door Open");
+    bufferReading("OPEN");
+  } else {
+    M5.Lcd.println("Door Closed");
+    bufferReading("CLOSED");
+  }
+
+  // State changes are sent right away together with the buffered readings,
+  // unchanged readings are only sent once the send period has passed to keep the sensor connected
+  if (sensorState != lastState || millis() - lastSend >= SEND_PERIOD) {
+    lastState = sensorState;
+    sendBatchRequest();
+  }
+
+  delay(POLLING_PERIOD);
+}
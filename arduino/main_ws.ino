@@ -0,0 +1,119 @@
+#include "M5StickCPlus.h"
+#include <WiFi.h>
+#include <WebSocketsClient.h>  // "WebSockets" by Markus Sattler, needs to be installed via Arduino library manager
+#include <ArduinoJson.h>       // Needs to be installed via Arduino library manager
+
+// Configuration
+const char* SSID = "<YOUR_WIFI_SSID>"; 
+const char* PASSWORD = "<YOUR_WIFI_PASSKEY>";
+const char* WEBHOOK_HOST = "<VPS_IP>";
+const int WEBHOOK_PORT = 443;
+const char* WEBSOCKET_PATH = "/<TELEGRAM_BOT_TOKEN>/ws";
+const char* LOCATION_NAME = "Bedroom Door";
+const int POLLING_PERIOD = 100; // Polling period in milliseconds between sensor readings
+
+WebSocketsClient webSocket;
+int lastState = -1; // To store the last state sent to the server
+
+// Function to setup the device on the wireless network
+void setup_wifi() {
+  delay(10);
+  // We start by connecting to a WiFi network
+  M5.Lcd.println();
+  M5.Lcd.print("Connecting to ");
+  M5.Lcd.println(SSID);
+
+  //WiFi.mode(WIFI_STA);
+  WiFi.begin(SSID, PASSWORD);
+
+  // Print "." until the network is connected for better UX
+  while (WiFi.status() != WL_CONNECTED) {
+    delay(1000);
+    M5.Lcd.print(".");
+  }
+
+  // Print the local IP of the device once connected to the network
+  M5.Lcd.println("");
+  M5.Lcd.println("WiFi connected");
+  M5.Lcd.println("IP address: ");
+  M5.Lcd.println(WiFi.localIP());
+}
+
+bool checkWifiConnection() {
+  if (WiFi.status() != WL_CONNECTED) {
+    M5.Lcd.println("Reconnecting to WiFi...");
+    setup_wifi();
+    return WiFi.status() == WL_CONNECTED;
+  }
+  return true;
+}
+
+const char* readStatus() {
+  return digitalRead(26) == HIGH ? "OPEN" : "CLOSED";
+}
+
+void sendStatus(const char* sensorStatus, bool identify) {
+  StaticJsonDocument<200> doc;
+  if (identify) {
+    doc["location"] = LOCATION_NAME; // The first frame on a connection identifies the sensor
+  }
+  doc["sensor_status"] = sensorStatus;
+
+  String payload;
+  serializeJson(doc, payload);
+  webSocket.sendTXT(payload);
+}
+
+void webSocketEvent(WStype_t type, uint8_t* payload, size_t length) {
+  M5.Lcd.fillScreen(BLACK);
+  M5.Lcd.setCursor(0, 0);
+  switch (type) {
+    case WStype_CONNECTED:
+      // Identify the sensor and send the current state on every (re)connect
+      M5.Lcd.println("Socket connected");
+      lastState = digitalRead(26);
+      sendStatus(readStatus(), true);
+      break;
+    case WStype_DISCONNECTED:
+      M5.Lcd.println("Socket disconnected");
+      break;
+    case WStype_TEXT:
+      M5.Lcd.println((char*)payload);
+      break;
+    default:
+      break;
+  }
+}
+
+void setup() {
+  M5.begin();
+  pinMode(26, INPUT_PULLUP);
+  M5.Lcd.setRotation(3);
+  M5.Lcd.fillScreen(BLACK);
+  M5.Lcd.setTextColor(WHITE);
+  M5.Lcd.setTextSize(2);
+  setup_wifi();
+
+  // Keep one long-lived TLS connection to the server instead of a new HTTPS request per reading.
+  // The server pings the socket to track liveness, so no heartbeat readings need to be sent.
+  webSocket.beginSSL(WEBHOOK_HOST, WEBHOOK_PORT, WEBSOCKET_PATH);
+  webSocket.onEvent(webSocketEvent);
+  webSocket.setReconnectInterval(5000);
+  webSocket.enableHeartbeat(15000, 3000, 2); // Also detect a dead connection from the device side
+}
+
+void loop() {
+  if (!checkWifiConnection()) {
+    M5.Lcd.println("Failed to Connect WiFi");
+  }
+  webSocket.loop();
+
+  int sensorState = digitalRead(26);
+  if (webSocket.isConnected() && sensorState != lastState) {
+    lastState = sensorState;
+    M5.Lcd.println(sensorState == HIGH ? "Door Open" : "Door Closed");
+    sendStatus(readStatus(), false);
+  }
+
+  delay(POLLING_PERIOD);
+}
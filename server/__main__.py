@@ -1,32 +1,49 @@
 import asyncio
-from aiohttp import web
+from aiohttp import web, WSMsgType, WSCloseCode
 import ssl
 import os
 import sys
+import multiprocessing
+import hashlib
 import json
+import math
 from telebot import types
-import logging
-from time import time, sleep
-import threading
-import requests
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from time import perf_counter
 
-from .util import handle_env, get_commands, get_ssl_filepaths
+from . import clock
+from .util import handle_env, get_commands, get_ssl_filepaths, get_spool_path
+
+# The replay stubs Telegram and MongoDB, so it runs without their environment variables
+if __name__ == "__main__" and sys.argv[1:2] == ["replay"]:
+    from .replay import main as replay_main
+    sys.exit(replay_main(sys.argv[2:]))
 
 handle_env()
 
+# Commands that run without starting the webhook, e.g. python -m server export --format csv
+if __name__ == "__main__" and sys.argv[1:2] == ["export"]:
+    from .export import main as export_main
+    sys.exit(export_main(sys.argv[2:]))
+
 # Import logger and AlarmBot after environment vars have been prepared
 from .logger import logger
-from .config import SENSOR_DISCONNECT_TIME
-from .telegram import AlarmBot, handle_event, device_disconnected
+from .config import (SENSOR_WS_HEARTBEAT, SENSOR_WS_REFRESH, STATE_SNAPSHOT_INTERVAL, SENSOR_MAX_BODY, TELEGRAM_MAX_BODY, 
+                     EVENT_RETENTION_DAYS, ROLLUP_INTERVAL)
+from .metrics import Metrics, REQUEST_SECONDS, REQUESTS
+from .admission import AdmissionController, Priority
+from .rollup import rollup_events
+from .schema import SENSOR_VALIDATORS, SOCKET_FIRST_FRAME_VALIDATOR, SOCKET_FRAME_VALIDATOR, decode_json
+from .spool import EventSpool
+from .state import retry_locked
+from .telegram import (AlarmBot, Coalescer, Dispatcher, EventQueue, Monitor, Mongo, State, Subscriptions, handle_event, 
+                       handle_events, on_sensor_disconnected)
+
+# The fingerprint of the last webhook and commands registration, see register_bot
+TELEGRAM_FINGERPRINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram.fingerprint')
     
-async def set_bot_commands():
+async def set_bot_commands(user_commands: list[types.BotCommand]):
     """Set the latest user and admin commands on the bot"""
     logger.warn("Setting bot commands ...")
-    
-    user_commands = [types.BotCommand(command=command, description=description)
-                     for command, description in get_commands().items()]
 
     # Set commands for all users
     await AlarmBot.set_my_commands(user_commands)
@@ -37,49 +54,16 @@ async def log_start(run_type: str):
     logger.warn(f"{bot_info.username} {run_type} started with token {AlarmBot.token}")
     
 
-def start_sensor_check():
-    """Monitor sensor connections using the 'ping' route"""
-    
-    # Delay for the server to start
-    sleep(5)
-    
-    while True:
-        try:
-            # Send a POST request to the webhook URL
-            response = requests.post(AlarmBot.webhook_url, json={"action": "ping"}, verify=False)
-            if response.status_code != 200:
-                logger.error(f"Ping failed during sensor connection check with status code {response.status_code}")
-
-        except requests.RequestException as e:
-            logger.error(f"Ping failed during sensor connection check: {e}", exc_info=e)
-
-        sleep(10)  # Wait for 10 seconds (or your desired interval) before the next ping
-        
-                
 # ------------------ WEBHOOK (production environment) ------------------ #
 
 async def on_ping(data: dict):
     """
-    Handles Ping events
-    Checks the system for disconnected sensors
+    Handles Ping events, used by uptime monitors to verify that the server is running.
+    Disconnected sensors are detected by the in-loop DisconnectMonitor, not by this route.
     
     {"action": "ping"}
     """
-    logger.info(f"Ping received: {data}")
-    
-    # Check the system for disconnections
-    current_time = int(time())
-    disconnected_sensors = []
-    for location, status in AlarmBot.sensor_status_cache.items():
-        last_message_time = status["last_message"]
-        if current_time - last_message_time > SENSOR_DISCONNECT_TIME:
-            await device_disconnected(location)
-            disconnected_sensors.append(location)
-            logger.info(f"Device has been disconnected: {location}")
-    
-    # Remove disconnected sensors from the cache
-    for sensor in disconnected_sensors:
-        del AlarmBot.sensor_status_cache[sensor]
+    logger.info(f"Ping received: {data}", sample_key="ping")
             
     return web.Response(text="Success: Ping received!", status=200)
 
@@ -95,10 +79,10 @@ async def on_sensor_event(data: dict):
         "sensor_status": "OPEN" or "CLOSED"
     }
     """
-    logger.info(f"M5Stick Sensor event received: {data}")
+    logger.info(f"M5Stick Sensor event received: {data}", sample_key="sensor_event")
     
     # Temporary override since getting datetime on M5Stick is much more complicated
-    data["timestamp"] = int(time())
+    data["timestamp"] = int(clock.time())
     
     try:
         await handle_event(data)
@@ -106,44 +90,436 @@ async def on_sensor_event(data: dict):
     except Exception as err:
         logger.error(f"An error occurred when processing the sensor event: {err}", exc_info=err)
         return web.Response(text=f"Error: {err}", status=500)        
+    
+async def on_sensor_batch(data: dict):
+    """
+    Handles a batch of readings buffered by one or more M5 sticks, processed in order in a single pass.
+    The request payload should be formatted like the following example:
+    
+    {
+        "action": "sensor_batch",
+        "location": "Bedroom Door",  <- Default location for readings that don't set their own
+        "readings": [
+            {"sensor_status": "CLOSED", "age_ms": 9000},
+            {"sensor_status": "OPEN", "age_ms": 1000, "location": "Front Door"}
+        ]
+    }
+    
+    `age_ms` is the amount of milliseconds between the reading and the request being sent, since the 
+    M5Stick does not have a reliable clock.
+    
+    Readings can have an optional `seq` number counted by the sensor, together with a `boot` id that the sensor 
+    picks at startup, so readings from a batch that is resent after a timeout are only handled once.
+    """
+    readings = data["readings"]
+    logger.info(f"M5Stick Sensor batch received with {len(readings)} readings", 
+                sample_key="sensor_batch")
+    
+    now = clock.time()
+    events = []
+    for reading in readings:
+        location = reading.get("location", data.get("location"))
+        if not location:
+            return web.Response(text=f"Error: Reading without a location {reading}", status=400)
+        event = {"action": "sensor_event",
+                 "timestamp": int(now - reading.get("age_ms", 0) / 1000),
+                 "location": location,
+                 "sensor_status": reading["sensor_status"]}
+        if "seq" in reading:
+            event["seq"] = reading["seq"]
+            if "boot" in data:
+                event["boot"] = data["boot"]
+        events.append(event)
+        
+    try:
+        await handle_events(events)
+        return web.Response(text="Success!", status=200)
+    except Exception as err:
+        logger.error(f"An error occurred when processing the sensor batch: {err}", exc_info=err)
+        return web.Response(text=f"Error: {err}", status=500)
+
+# The handler of each sensor action, the payloads are validated against SENSOR_VALIDATORS first
+SENSOR_HANDLERS = {
+    "ping": on_ping,
+    "sensor_event": on_sensor_event,
+    "sensor_batch": on_sensor_batch,
+}
+
+# The open WebSocket connection of each sensor: {location: WebSocketResponse}
+sensor_sockets = {}
+Metrics.gauge("roomraider_sensor_sockets", "Sensors connected over WebSocket", lambda: len(sensor_sockets))
+
+async def on_sensor_socket(request):
+    """
+    Handles the persistent WebSocket channel of a single M5 stick. The first frame identifies the sensor,
+    every following frame is sent when the sensor status changes:
+    
+    {"location": "Bedroom Door", "sensor_status": "OPEN" or "CLOSED"}
+    {"sensor_status": "OPEN" or "CLOSED"}
+    
+    Liveness is tracked with WebSocket ping/pong instead of the disconnect timeout, and the sensor is 
+    disconnected as soon as the connection drops. Frames are validated like the sensor payloads: an invalid 
+    first frame closes the connection, later invalid frames are dropped.
+    """
+    if request.match_info.get('token') != AlarmBot.token:
+        return web.Response(status=403)
+    
+    ws = web.WebSocketResponse(heartbeat=SENSOR_WS_HEARTBEAT, max_msg_size=SENSOR_MAX_BODY)
+    await ws.prepare(request)
+    
+    location = None
+    try:
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            try:
+                data = decode_json(msg.data)
+            except ValueError:
+                logger.error(f"Failed to decode JSON from sensor socket: {msg.data}")
+                continue
+            
+            error = (SOCKET_FIRST_FRAME_VALIDATOR if location is None else SOCKET_FRAME_VALIDATOR)(data)
+            if error:
+                logger.error(f"Invalid sensor socket frame from {location}: {error}", sample_key="invalid_frame")
+                if location is None:
+                    await ws.close(code=WSCloseCode.POLICY_VIOLATION, message=error.encode())
+                    break
+                continue
+            
+            if location is None:
+                location = data["location"]
+                
+                # Replace a stale connection from the same sensor (e.g. after a WiFi reconnect)
+                previous = sensor_sockets.get(location)
+                sensor_sockets[location] = ws
+                if previous is not None:
+                    await previous.close()
+                Monitor.hold(location)
+                logger.info(f"M5Stick Sensor socket connected: {location}")
+                
+            await handle_event({"action": "sensor_event",
+                                "timestamp": int(clock.time()),
+                                "location": location,
+                                "sensor_status": data["sensor_status"]})
+    except Exception as err:
+        logger.error(f"An error occurred on the sensor socket for {location}: {err}", exc_info=err)
+    finally:
+        # Only disconnect the sensor if it has not already reconnected on a new socket
+        if location is not None and sensor_sockets.get(location) is ws:
+            del sensor_sockets[location]
+            Monitor.release(location)
+            await on_sensor_disconnected(location)
+    
+    return ws
+
+async def read_json(request, max_size: int):
+    """
+    Read and decode the JSON body of a request exactly once.
+    
+    Oversized bodies are rejected from the Content-Length header before anything is read, and the body is 
+    read as bytes and handed to the decoder without an intermediate string.
+    """
+    if request.content_length is None:
+        raise web.HTTPLengthRequired(text="Error: Content-Length is required")
+    if request.content_length > max_size:
+        raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=request.content_length)
+    
+    body = await request.read()
+    try:
+        return decode_json(body)
+    except ValueError:
+        logger.error(f"Failed to decode JSON from webhook request: {body[:256]!r}", sample_key="malformed_json")
+        raise web.HTTPBadRequest(text="Error: Malformed JSON")
+    
+# Bounds the sensor requests handled at once and rate limits each sensor, see AdmissionController
+Admission = AdmissionController()
+Metrics.gauge("roomraider_sensor_requests_active", "Sensor requests being handled", lambda: Admission.active)
+Metrics.gauge("roomraider_sensor_requests_queued", "Sensor requests waiting for admission", Admission.queued)
+
+def sensor_priority(action: str, data: dict) -> Priority:
+    """Classify a valid sensor payload by its most important reading, comparing each reading to the cached status"""
+    if action == "ping":
+        return Priority.HEARTBEAT
+    
+    readings = data["readings"] if action == "sensor_batch" else [data]
+    priority = Priority.HEARTBEAT
+    for reading in readings:
+        location = reading.get("location", data.get("location"))
+        sensor = State.get_sensor(location) if location else None
+        if sensor is not None and sensor["last_sensor_status"] == reading["sensor_status"]:
+            continue
+        if sensor is not None and State.get_system_status(Subscriptions.group_of(location)) == "Armed":
+            return Priority.ARMED_CHANGE
+        priority = Priority.CHANGE
+    return priority
+
+def sensor_location(action: str, data: dict):
+    """Get the sensor a payload is rate limited as, None for pings"""
+    if action == "sensor_batch":
+        return data.get("location") or next((reading["location"] for reading in data["readings"] 
+                                             if "location" in reading), None)
+    return data.get("location")
+
+async def on_sensor_payload(data) -> tuple[str, web.Response]:
+    """
+    Validate a decoded sensor payload against the schema of its action and handle it once it is admitted,
+    returns (action, response). Rejected requests get a 429 response with a Retry-After header.
+    """
+    action = data.get("action") if isinstance(data, dict) else None
+    validate = SENSOR_VALIDATORS.get(action)
+    if validate is None:
+        return "unknown", web.Response(text="Error: Unknown action", status=400)
+    # From here on the action is one of the known actions, so it is safe to use in metric labels and sample keys
+    
+    error = validate(data)
+    if error:
+        logger.error(f"Invalid {action} payload: {error}", sample_key=f"invalid_payload:{action}")
+        return action, web.Response(text=f"Error: {error}", status=400)
+    
+    retry_after = await Admission.acquire(sensor_priority(action, data), sensor_location(action, data))
+    if retry_after is not None:
+        logger.info(f"Rejected {action} request, retry after {retry_after:.1f}s", sample_key=f"rejected:{action}")
+        return action, web.Response(text="Error: Too many requests", status=429, 
+                                    headers={"Retry-After": str(math.ceil(retry_after))})
+    try:
+        return action, await SENSOR_HANDLERS[action](data)
+    finally:
+        Admission.release()
+
+async def handle_sensor(request):
+    # Handles requests from the M5StickCPlus contact sensors and uptime monitors on /{token}/sensor
+    start = perf_counter()
+    action = "unknown"
+    response = web.Response(status=500)
+    try:
+        if request.match_info.get('token') != AlarmBot.token:
+            response = web.Response(status=403)
+        else:
+            data = await read_json(request, SENSOR_MAX_BODY)
+            action, response = await on_sensor_payload(data)
+    except web.HTTPException as err:
+        response = web.Response(text=err.text, status=err.status)
+    except Exception as err:
+        logger.error(f"Error handling sensor request: {err}", exc_info=err)
+    finally:
+        REQUEST_SECONDS.observe(perf_counter() - start, action=action)
+        REQUESTS.inc(action=action, status=response.status)
+    return response
 
 async def handle(request):
-    # Handles requests to the webhook
+    # Handles Telegram updates on /{token}/, and sensor payloads from devices still posting to the old route
+    start = perf_counter()
+    action = "unknown"
+    response = web.Response(status=500)
     try:
-        request_body = await request.text()
-        try:
-            data = json.loads(request_body)
-        except json.JSONDecodeError:
-            logger.error(f"Failed to decode JSON from webhook request: {request_body}")
-            raise
-        
-        # Check if the 'action' key exists and has the value 'ping' to handle uptime monitor
-        if data.get('action') == 'ping':
-            return await on_ping(data)
+        data = await read_json(request, TELEGRAM_MAX_BODY)
         
-        # Handle the event from the M5StickCPlus contact sensor
-        if data.get('action') == 'sensor_event':
-            return await on_sensor_event(data)
+        if isinstance(data, dict) and "action" in data:
+            # Sensor payloads on the old route get the same size limit as on /sensor
+            if request.content_length > SENSOR_MAX_BODY:
+                raise web.HTTPRequestEntityTooLarge(max_size=SENSOR_MAX_BODY, actual_size=request.content_length)
+            action, response = await on_sensor_payload(data)
         
-        # Otherwise handle as Telegram API request
-        if request.match_info.get('token') == AlarmBot.token:
-            update = types.Update.de_json(request_body)
+        # Otherwise handle as Telegram API request, built from the already decoded body
+        elif request.match_info.get('token') == AlarmBot.token:
+            action = "telegram_update"
+            update = types.Update.de_json(data)
             await AlarmBot.process_new_updates([update])
-            return web.Response()
+            response = web.Response()
         else:
-            return web.Response(status=403)
+            response = web.Response(status=403)
+    except web.HTTPException as err:
+        response = web.Response(text=err.text, status=err.status)
     except Exception as err:
         logger.error(f"Error handling webhook request: {err}", exc_info=err)
-    
-async def setup_webhook():
-    """Set up the webhook for the bot"""
-    # Set bot commands
-    await set_bot_commands()
+    finally:
+        REQUEST_SECONDS.observe(perf_counter() - start, action=action)
+        REQUESTS.inc(action=action, status=response.status)
+    return response
         
-    # Set webhook
-    app = web.Application()
+
+async def on_metrics(request):
+    """Serves the server metrics in the Prometheus text format on /{token}/metrics"""
+    if request.match_info.get('token') != AlarmBot.token:
+        return web.Response(status=403)
+    return web.Response(text=Metrics.render(), content_type="text/plain", charset="utf-8")
+    
+
+async def prepare_database(app):
+    """Connect to MongoDB in the background, the primary worker also migrates the stored events and creates the indexes"""
+    async def prepare():
+        try:
+            await Mongo.connect()
+            if not app["primary"]:
+                return
+            migrated = await asyncio.to_thread(Mongo.prepare)
+            logger.warn(f"MongoDB indexes ready, migrated {migrated} events to the typed schema", logger_type="main")
+        except Exception as err:
+            logger.error(f"Failed to prepare the MongoDB events collection: {err}", exc_info=err)
+            
+    app["prepare_database"] = asyncio.create_task(prepare())
+    
+    
+async def start_rollups(app):
+    """Periodically roll up the raw events into the hourly and daily buckets, the primary worker only"""
+    async def rollup_loop():
+        await app["prepare_database"]
+        retention_ready = False
+        while True:
+            try:
+                hours = await asyncio.to_thread(rollup_events, Mongo, clock.time())
+                if hours > 1:
+                    logger.warn(f"Rolled up the events of {hours} hours", logger_type="main")
+                # Raw events only start expiring once the rollups caught up, so no history is lost on the first run
+                if not retention_ready:
+                    await asyncio.to_thread(Mongo.ensure_ttl, Mongo.events, EVENT_RETENTION_DAYS)
+                    retention_ready = True
+            except Exception as err:
+                logger.error(f"Failed to roll up the events: {err}", logger_type="main", exc_info=err)
+            await asyncio.sleep(ROLLUP_INTERVAL)
+            
+    app["rollups"] = asyncio.create_task(rollup_loop())
+    
+    
+async def stop_rollups(app):
+    """Stop the rollup task, an interrupted run is repeated on the next start"""
+    app["rollups"].cancel()
+    
+    
+async def start_event_queue(app):
+    """Open the event spool and start draining it to MongoDB on the app's event loop"""
+    EventQueue.start()
+    
+    
+async def stop_event_queue(app):
+    """Spool the remaining queued events and try to write them to MongoDB before shutting down"""
+    await EventQueue.stop()
+    
+    
+async def start_monitor(app):
+    """Start the sensor disconnect monitor on the app's event loop"""
+    # Track the sensors already in the state (restored from a snapshot or connected through other workers),
+    # giving each a full timeout from now so a restart doesn't disconnect sensors that were only waiting on the server
+    now = int(clock.time())
+    for location, sensor in State.sensors().items():
+        Monitor.touch(location, max(sensor["last_message"], now))
+    Monitor.start()
+    
+    
+async def stop_monitor(app):
+    """Stop the sensor disconnect monitor"""
+    await Monitor.stop()
+    
+    
+async def start_socket_refresh(app):
+    """
+    Periodically move the shared last message time of the sensors connected to this worker over WebSocket forward.
+    These sensors only send frames when their status changes, so without it the other workers would time them out.
+    """
+    async def refresh_loop():
+        while True:
+            await asyncio.sleep(SENSOR_WS_REFRESH)
+            try:
+                await retry_locked(State.touch_sensors, list(sensor_sockets), int(clock.time()))
+            except Exception as err:
+                logger.error(f"Failed to refresh the sensors connected over WebSocket: {err}", logger_type="main", 
+                             exc_info=err)
+            
+    app["socket_refresh"] = asyncio.create_task(refresh_loop())
+    
+    
+async def stop_socket_refresh(app):
+    """Stop refreshing the sensors connected over WebSocket"""
+    app["socket_refresh"].cancel()
+    
+    
+async def start_coalescer(app):
+    """Start the alert coalescer on the app's event loop"""
+    Coalescer.start()
+    
+    
+async def stop_coalescer(app):
+    """Send the alert changes that are still held back before shutting down"""
+    await Coalescer.stop()
+    
+    
+async def start_state_snapshots(app):
+    """Periodically snapshot the in-memory state to disk so a restart resumes where it left off"""
+    async def snapshot_loop():
+        while True:
+            await asyncio.sleep(STATE_SNAPSHOT_INTERVAL)
+            await save_state_snapshot(app)
+            
+    app["state_snapshots"] = asyncio.create_task(snapshot_loop())
+    
+    
+async def save_state_snapshot(app):
+    """Write a snapshot of the state if it changed, the file is written from a worker thread"""
+    data = State.snapshot()
+    if data is None:
+        return
+    try:
+        await asyncio.to_thread(State.save_snapshot, data)
+    except Exception as err:
+        logger.error(f"Failed to save the state snapshot: {err}", logger_type="main", exc_info=err)
+    
+    
+async def stop_state_snapshots(app):
+    """Stop the snapshot task and write a final snapshot"""
+    app["state_snapshots"].cancel()
+    await save_state_snapshot(app)
+    
+    
+async def close_sensor_sockets(app):
+    """Close the open sensor WebSocket connections on shutdown without sending disconnect alerts"""
+    sockets = list(sensor_sockets.values())
+    sensor_sockets.clear()
+    for ws in sockets:
+        await ws.close(message=b"Server shutdown")
+    
+    
+async def drain_alerts(app):
+    """Wait for in-flight Telegram alerts to be delivered before shutting down"""
+    await Dispatcher.drain()
+    
+    
+def create_app(primary: bool = True, ssl_cert: str = None) -> web.Application:
+    """Build the aiohttp app with the webhook routes and the background services
+    
+    Args:
+        primary (bool): Whether this is the first (or only) worker, which also runs the one-off database tasks.
+        ssl_cert (str): The webhook certificate, registers the webhook and commands with Telegram in the background if given.
+    """
+    app = web.Application(client_max_size=TELEGRAM_MAX_BODY)
+    app["primary"] = primary
+    app["ssl_cert"] = ssl_cert
     app.router.add_post('/{token}/', handle)
+    app.router.add_post('/{token}/sensor', handle_sensor)
+    app.router.add_get('/{token}/ws', on_sensor_socket)
+    app.router.add_get('/{token}/metrics', on_metrics)
+    app.on_startup.append(prepare_database)
+    if primary and ssl_cert:
+        app.on_startup.append(start_registration)
+    if primary:
+        app.on_startup.append(start_rollups)
+        app.on_cleanup.append(stop_rollups)
+    app.on_startup.append(start_event_queue)
+    app.on_startup.append(start_monitor)
+    app.on_startup.append(start_socket_refresh)
+    app.on_startup.append(start_coalescer)
+    app.on_startup.append(start_state_snapshots)
+    app.on_shutdown.append(close_sensor_sockets)
+    app.on_cleanup.append(stop_monitor)
+    app.on_cleanup.append(stop_socket_refresh)
+    app.on_cleanup.append(stop_state_snapshots)
+    app.on_cleanup.append(stop_event_queue)
+    app.on_cleanup.append(stop_coalescer)
+    app.on_cleanup.append(drain_alerts)
+    return app
+    
     
+def get_webhook_config() -> tuple:
+    """Set the webhook URL of the bot from the environment, returns the listener settings and certificate files"""
     # Get webhook address
     webhook_host = os.getenv("WEBHOOK_HOST")
     webhook_port = os.getenv("WEBHOOK_PORT")
@@ -151,47 +527,105 @@ async def setup_webhook():
     
     webhook_url_base = "https://{}:{}".format(webhook_host, webhook_port)
     webhook_url_path = "/{}/".format(AlarmBot.token)
-    webhook_url_full = webhook_url_base + webhook_url_path
-    AlarmBot.webhook_url = webhook_url_full
+    AlarmBot.webhook_url = webhook_url_base + webhook_url_path
         
     # Get ssl certificate files
     ssl_cert, ssl_priv = get_ssl_filepaths()
     
-    # Set webhook
-    try:
-        logger.warn(f"Setting webhook on {webhook_url_full}")
-        
-        await AlarmBot.remove_webhook()
-        await AlarmBot.set_webhook(url=webhook_url_full, certificate=open(ssl_cert, 'r'))
-    except Exception as e:
-        logging.error(f"Failed to set up webhook: {e}")
-        sys.exit(1)
+    return webhook_listen, webhook_port, ssl_cert, ssl_priv
+
+
+def registration_fingerprint(commands: list[types.BotCommand], ssl_cert: str) -> str:
+    """Hash everything that is sent to Telegram when the webhook and commands are registered"""
+    with open(ssl_cert, 'rb') as f:
+        certificate = hashlib.sha256(f.read()).hexdigest()
+    registration = {"bot": AlarmBot.token.split(":")[0],
+                    "url": AlarmBot.webhook_url,
+                    "certificate": certificate,
+                    "commands": [[command.command, command.description] for command in commands]}
+    return hashlib.sha256(json.dumps(registration, sort_keys=True).encode("utf8")).hexdigest()
+
+
+async def register_bot(ssl_cert: str):
+    """
+    Set the bot commands and webhook, skipped if neither changed since the last registration.
+    
+    The fingerprint of the last registration is cached in TELEGRAM_FINGERPRINT, and the webhook is also checked 
+    with Telegram since it can be removed from elsewhere (e.g. by a polling test bot with the same token).
+    """
+    user_commands = [types.BotCommand(command=command, description=description)
+                     for command, description in get_commands().items()]
+    fingerprint = registration_fingerprint(user_commands, ssl_cert)
+    
+    cached = None
+    if os.path.exists(TELEGRAM_FINGERPRINT):
+        with open(TELEGRAM_FINGERPRINT) as f:
+            cached = f.read().strip()
+    if cached == fingerprint:
+        webhook_info = await AlarmBot.get_webhook_info()
+        if webhook_info.url == AlarmBot.webhook_url:
+            logger.warn("Webhook and bot commands are unchanged, skipping the registration")
+            return
     
-    # Log start of bot
-    await log_start(run_type="webhook")
+    await set_bot_commands(user_commands)
     
-    # Return the values to be processed (web.run_app cannot be started inside of async function)
-    return app, webhook_listen, webhook_port, ssl_cert, ssl_priv
+    # Setting the webhook replaces the previous one, it doesn't have to be removed first
+    logger.warn(f"Setting webhook on {AlarmBot.webhook_url}")
+    with open(ssl_cert, 'r') as certificate:
+        await AlarmBot.set_webhook(url=AlarmBot.webhook_url, certificate=certificate)
+    
+    with open(TELEGRAM_FINGERPRINT, 'w') as f:
+        f.write(fingerprint)
+        
 
+async def start_registration(app):
+    """Register the bot with Telegram in the background, while the listener already takes sensor traffic"""
+    async def register():
+        try:
+            await register_bot(app["ssl_cert"])
+            await log_start(run_type="webhook")
+        except Exception as err:
+            logger.critical(f"Failed to set up webhook: {err}", exc_info=err)
+            
+    app["registration"] = asyncio.create_task(register())
 
-if __name__ == "__main__":
-    # Build app
-    app, host, port, cert, priv = asyncio.run(setup_webhook())  # Get the app and other values
 
-    # Start the sensor check thread
-    sensor_check_thread = threading.Thread(target=start_sensor_check, daemon=True)
-    sensor_check_thread.start()
+def run_worker(host: str, port: str, context: ssl.SSLContext, worker: int, ssl_cert: str):
+    """Run one webhook worker process, the workers share the port through SO_REUSEPORT"""
+    # Every worker appends to its own spool, the spool of a worker is resumed by the same worker after a restart
+    EventQueue.spool = EventSpool(get_spool_path(worker))
+    try:
+        web.run_app(create_app(primary=worker == 0, ssl_cert=ssl_cert), host=host, port=port, ssl_context=context, reuse_port=True)
+    except Exception as err:
+        logger.critical(f"An error occurred when running worker {os.getpid()}: {err}", exc_info=err)
+
+
+if __name__ == "__main__":
+    # The webhook and commands are registered in the background once the listener is started
+    host, port, cert, priv = get_webhook_config()
 
     # Build SSL context
     try:
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         context.load_cert_chain(cert, priv)
     except ssl.SSLError as e:
-        logging.critical(f"Failed to load SSL certificates", exc_info=e)
+        logger.critical(f"Failed to load SSL certificates", exc_info=e)
         sys.exit(1)
+        
+    workers = int(os.getenv("WEBHOOK_WORKERS") or 1)
     
     # Start the webhook listener
-    try:
-        web.run_app(app, host=host, port=port, ssl_context=context)  # Run the app here
-    except Exception as err:
-        logger.critical(f"An error occurred when running/attempting to run the webhook: {err}", exc_info=err)
\ No newline at end of file
+    if workers == 1:
+        try:
+            web.run_app(create_app(ssl_cert=cert), host=host, port=port, ssl_context=context)  # Run the app here
+        except Exception as err:
+            logger.critical(f"An error occurred when running/attempting to run the webhook: {err}", exc_info=err)
+    else:
+        # The workers share the state through the SQLite state store, the first one registers the webhook
+        logger.warn(f"Starting {workers} webhook workers", logger_type="main")
+        fork = multiprocessing.get_context("fork")
+        processes = [fork.Process(target=run_worker, args=(host, port, context, i, cert)) for i in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
\ No newline at end of file
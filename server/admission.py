@@ -0,0 +1,113 @@
+import asyncio
+import heapq
+from enum import IntEnum
+from itertools import count
+from time import monotonic
+from typing import Optional
+
+from .config import SENSOR_MAX_ACTIVE, SENSOR_MAX_QUEUED, SENSOR_RATE, SENSOR_BURST, SENSOR_RETRY_AFTER
+from .dispatcher import TokenBucket
+from .metrics import REQUESTS_SHED
+
+
+class Priority(IntEnum):
+    """The priority of a sensor request, lower values are admitted first"""
+    ARMED_CHANGE = 0  # A status change of a sensor in an armed group, always admitted
+    CHANGE = 1  # A status change (or a new sensor) while disarmed
+    HEARTBEAT = 2  # Readings without a status change and pings, shed first
+
+
+class AdmissionController:
+    def __init__(self, max_active: int = SENSOR_MAX_ACTIVE, max_queued: int = SENSOR_MAX_QUEUED,
+                 rate: float = SENSOR_RATE, burst: float = SENSOR_BURST, retry_after: float = SENSOR_RETRY_AFTER):
+        """Bounds the sensor requests that are handled at once and rate limits every sensor.
+
+        At most `max_active` requests are handled at the same time, further requests wait in a queue ordered by
+        priority, and once `max_queued` are waiting new requests are rejected. Heartbeats are never queued: they
+        are shed as soon as every slot is taken. Status changes of armed sensors skip the rate limit and the queue.
+
+        Args:
+            max_active (int): The amount of requests handled at once.
+            max_queued (int): The amount of requests that can wait for a slot.
+            rate (float): The sustained amount of requests per second of a single sensor.
+            burst (float): The amount of requests a single sensor can send in a quick burst.
+            retry_after (float): The amount of seconds a rejected request should wait before it is retried.
+        """
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.rate = rate
+        self.burst = burst
+        self.retry_after = retry_after
+        self.active = 0
+        self._buckets = {}  # {location: TokenBucket} of the sensors that sent a request recently
+        self._swept = monotonic()
+        self._queue = []  # [(priority, order, future), ...] of the requests waiting for a slot
+        self._order = count()
+
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def _evict_idle(self, now: float) -> None:
+        """Drop the buckets that filled up again, a new bucket for the same sensor behaves exactly the same"""
+        idle_since = now - self.burst / self.rate
+        self._buckets = {location: bucket for location, bucket in self._buckets.items() if bucket.updated > idle_since}
+        self._swept = now
+
+    def _rate_limit(self, location: str) -> float:
+        # The locations come from the request bodies, so the buckets of sensors that went quiet are evicted
+        now = monotonic()
+        if now - self._swept >= self.burst / self.rate:
+            self._evict_idle(now)
+        
+        bucket = self._buckets.get(location)
+        if bucket is None:
+            bucket = self._buckets[location] = TokenBucket(self.rate, self.burst)
+        return bucket.try_acquire()
+
+    async def acquire(self, priority: Priority, location: str = None) -> Optional[float]:
+        """
+        Wait for a slot to handle a request of a sensor, release it with `release` once the request is handled.
+
+        Returns None when the request is admitted, or the amount of seconds after which it should be retried.
+        """
+        if priority == Priority.ARMED_CHANGE:
+            self.active += 1
+            return None
+
+        if location is not None:
+            wait = self._rate_limit(location)
+            if wait:
+                REQUESTS_SHED.inc(reason="rate_limited")
+                return max(wait, self.retry_after)
+
+        if self.active < self.max_active and not self._queue:
+            self.active += 1
+            return None
+        if priority == Priority.HEARTBEAT:
+            REQUESTS_SHED.inc(reason="heartbeat")
+            return self.retry_after
+        if len(self._queue) >= self.max_queued:
+            REQUESTS_SHED.inc(reason="queue_full")
+            return self.retry_after
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot was handed over just before the request was cancelled, pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+        return None
+
+    def release(self) -> None:
+        """Free the slot of a handled request, or hand it over to the first waiting request"""
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
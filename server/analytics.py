@@ -0,0 +1,244 @@
+from array import array
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+import pytz
+
+from .config import (ALERT_TIMEZONE, FLAP_WINDOW, ANALYTICS_PUSHDOWN_THRESHOLD, ANALYTICS_MAX_TIME_MS, 
+                     ANALYTICS_ROLLUP_DAYS)
+from .mongo import EventsMongoDB
+from .rollup import iter_buckets
+
+
+@dataclass
+class EventColumns:
+    """Events of a time window stored as columns, one row per event"""
+    locations: list[str]  # The location names, indexed by location_ids
+    location_ids: np.ndarray  # int32
+    timestamps: np.ndarray  # int64
+    is_open: np.ndarray  # bool
+    
+
+@dataclass
+class HistorySummary:
+    """Per-location activity over a time window, every array is indexed like `locations`"""
+    locations: list[str]
+    events: np.ndarray  # The amount of events
+    opens: np.ndarray  # The amount of OPEN events
+    closes: np.ndarray  # The amount of CLOSED events
+    open_seconds: np.ndarray  # The total amount of seconds spent open
+    flaps: np.ndarray  # The amount of changes that were reversed within FLAP_WINDOW
+    hourly: np.ndarray  # (locations, 24) histogram of events by local hour of the day
+    
+    @property
+    def flap_rates(self) -> np.ndarray:
+        return self.flaps / np.maximum(self.events, 1)
+    
+    
+def load_columns(mongo: EventsMongoDB, start: int, end: int, location: str = None) -> EventColumns:
+    """Stream the events of a time window from MongoDB into columnar arrays"""
+    location_index = {}
+    location_ids = array('i')
+    timestamps = array('q')
+    is_open = array('b')
+    
+    projection = {"_id": 0, "timestamp": 1, "location": 1, "sensor_status": 1}
+    for event in mongo.iter_events(start, end, location, projection=projection):
+        location_id = location_index.setdefault(event["location"], len(location_index))
+        location_ids.append(location_id)
+        timestamps.append(event["timestamp"])
+        is_open.append(event["sensor_status"] == "OPEN")
+        
+    return EventColumns(locations=list(location_index),
+                        location_ids=np.frombuffer(location_ids, dtype=np.int32),
+                        timestamps=np.frombuffer(timestamps, dtype=np.int64),
+                        is_open=np.frombuffer(is_open, dtype=np.int8).astype(bool))
+    
+    
+def local_hours(timestamps: np.ndarray, tz=pytz.timezone(ALERT_TIMEZONE)) -> np.ndarray:
+    """Get the local hour of the day of each timestamp, looking up the UTC offset once per day"""
+    days, inverse = np.unique(timestamps // 86400, return_inverse=True)
+    offsets = np.array([tz.utcoffset(datetime.utcfromtimestamp(int(day) * 86400 + 43200)).total_seconds() 
+                        for day in days], dtype=np.int64)
+    return ((timestamps + offsets[inverse]) // 3600) % 24
+    
+    
+def summarize_columns(columns: EventColumns, end: int, flap_window: int = FLAP_WINDOW) -> HistorySummary:
+    """Compute the per-location summary of a time window with vectorized operations"""
+    n_locations = len(columns.locations)
+    
+    # Sort by location, then by timestamp, so the events of each sensor are consecutive
+    order = np.lexsort((columns.timestamps, columns.location_ids))
+    location_ids = columns.location_ids[order]
+    timestamps = columns.timestamps[order]
+    is_open = columns.is_open[order]
+    
+    # Each event lasts until the next event of the same sensor, or the end of the window
+    is_last = np.ones(len(order), dtype=bool)
+    is_last[:-1] = location_ids[:-1] != location_ids[1:]
+    next_timestamps = np.empty_like(timestamps)
+    next_timestamps[:-1] = timestamps[1:]
+    next_timestamps[is_last] = end
+    durations = np.clip(next_timestamps - timestamps, 0, None)
+    
+    # A flap is a change that is reversed by the next event of the same sensor within the flap window
+    next_open = np.empty_like(is_open)
+    next_open[:-1] = is_open[1:]
+    flapped = ~is_last & (next_open != is_open) & (durations <= flap_window)
+    
+    hourly = np.bincount(location_ids * 24 + local_hours(timestamps), minlength=n_locations * 24)
+    
+    return HistorySummary(locations=columns.locations,
+                          events=np.bincount(location_ids, minlength=n_locations),
+                          opens=np.bincount(location_ids[is_open], minlength=n_locations),
+                          closes=np.bincount(location_ids[~is_open], minlength=n_locations),
+                          open_seconds=np.bincount(location_ids[is_open], weights=durations[is_open], 
+                                                   minlength=n_locations),
+                          flaps=np.bincount(location_ids[flapped], minlength=n_locations),
+                          hourly=hourly.reshape(n_locations, 24))
+    
+    
+def aggregate_summary(mongo: EventsMongoDB, start: int, end: int, location: str = None, 
+                      flap_window: int = FLAP_WINDOW, max_time_ms: int = ANALYTICS_MAX_TIME_MS) -> HistorySummary:
+    """
+    Compute the per-location summary of a time window inside MongoDB.
+    
+    The pipeline pairs each event with the next event of the same sensor and groups by location and local hour,
+    so at most 24 documents per location are returned instead of every event in the window.
+    """
+    match = {"timestamp": {"$gte": start, "$lte": end}}
+    if location is not None:
+        match["location"] = location
+        
+    pipeline = [
+        {"$match": match},
+        {"$setWindowFields": {
+            "partitionBy": "$location",
+            "sortBy": {"timestamp": 1},
+            "output": {"next_timestamp": {"$shift": {"output": "$timestamp", "by": 1, "default": end}},
+                       "next_status": {"$shift": {"output": "$sensor_status", "by": 1, "default": None}}}}},
+        {"$project": {
+            "location": 1,
+            "open": {"$eq": ["$sensor_status", "OPEN"]},
+            "hour": {"$hour": {"date": "$date", "timezone": ALERT_TIMEZONE}},
+            "duration": {"$max": [{"$subtract": ["$next_timestamp", "$timestamp"]}, 0]},
+            "flap": {"$and": [{"$ne": ["$next_status", None]},
+                              {"$ne": ["$next_status", "$sensor_status"]},
+                              {"$lte": [{"$subtract": ["$next_timestamp", "$timestamp"]}, flap_window]}]}}},
+        {"$group": {
+            "_id": {"location": "$location", "hour": "$hour"},
+            "events": {"$sum": 1},
+            "opens": {"$sum": {"$cond": ["$open", 1, 0]}},
+            "open_seconds": {"$sum": {"$cond": ["$open", "$duration", 0]}},
+            "flaps": {"$sum": {"$cond": ["$flap", 1, 0]}}}},
+    ]
+    groups = list(mongo.events.aggregate(pipeline, maxTimeMS=max_time_ms))
+    
+    location_index = {}
+    for group in groups:
+        location_index.setdefault(group["_id"]["location"], len(location_index))
+    n_locations = len(location_index)
+    
+    location_ids = np.array([location_index[group["_id"]["location"]] for group in groups], dtype=np.int64)
+    hours = np.array([group["_id"]["hour"] for group in groups], dtype=np.int64)
+    events = np.array([group["events"] for group in groups], dtype=np.int64)
+    opens = np.array([group["opens"] for group in groups], dtype=np.int64)
+    
+    hourly = np.zeros((n_locations, 24), dtype=np.int64)
+    np.add.at(hourly, (location_ids, hours), events)
+    total_events = hourly.sum(axis=1)
+    total_opens = np.bincount(location_ids, weights=opens, minlength=n_locations).astype(np.int64)
+    
+    return HistorySummary(locations=list(location_index),
+                          events=total_events,
+                          opens=total_opens,
+                          closes=total_events - total_opens,
+                          open_seconds=np.bincount(location_ids, weights=[g["open_seconds"] for g in groups], 
+                                                   minlength=n_locations),
+                          flaps=np.bincount(location_ids, weights=[g["flaps"] for g in groups], 
+                                            minlength=n_locations).astype(np.int64),
+                          hourly=hourly)
+    
+    
+def rollup_summary(mongo: EventsMongoDB, start: int, end: int, location: str = None) -> tuple[HistorySummary, int]:
+    """
+    Compute the per-location summary of the rolled up hours of a time window from the hourly and daily buckets.
+    
+    The window starts at the hour of `start`. Returns the summary and the end of the rolled up hours, the events 
+    after it are not included.
+    """
+    buckets, stop = iter_buckets(mongo, start, end, location)
+    
+    location_index = {}
+    totals = []  # [events, opens, closes, open_seconds, flaps] per location
+    hourly = []
+    for bucket in buckets:
+        i = location_index.setdefault(bucket["location"], len(location_index))
+        if i == len(totals):
+            totals.append([0, 0, 0, 0, 0])
+            hourly.append([0] * 24)
+        for j, field in enumerate(("events", "opens", "closes", "open_seconds", "flaps")):
+            totals[i][j] += bucket[field]
+        if "hours" in bucket:
+            hourly[i] = [a + b for a, b in zip(hourly[i], bucket["hours"])]
+        else:
+            hourly[i][bucket["hour"]] += bucket["events"]
+            
+    totals = np.array(totals, dtype=np.int64).reshape(-1, 5)
+    return HistorySummary(locations=list(location_index),
+                          events=totals[:, 0],
+                          opens=totals[:, 1],
+                          closes=totals[:, 2],
+                          open_seconds=totals[:, 3],
+                          flaps=totals[:, 4],
+                          hourly=np.array(hourly, dtype=np.int64).reshape(-1, 24)), stop
+    
+    
+def merge_summaries(first: HistorySummary, second: HistorySummary) -> HistorySummary:
+    """Add up the summaries of two consecutive time windows"""
+    locations = list(dict.fromkeys(first.locations + second.locations))
+    location_index = {location: i for i, location in enumerate(locations)}
+    
+    def merge(field: str) -> np.ndarray:
+        a, b = getattr(first, field), getattr(second, field)
+        merged = np.zeros((len(locations),) + a.shape[1:], dtype=np.result_type(a, b))
+        np.add.at(merged, [location_index[location] for location in first.locations], a)
+        np.add.at(merged, [location_index[location] for location in second.locations], b)
+        return merged
+    
+    return HistorySummary(locations=locations, **{field: merge(field) for field in 
+                                                  ("events", "opens", "closes", "open_seconds", "flaps", "hourly")})
+    
+    
+def summarize_events(mongo: EventsMongoDB, start: int, end: int, location: str = None) -> HistorySummary:
+    """
+    Compute the per-location summary of a time window from the raw events.
+    
+    Small windows are loaded into columns and summarized locally, windows with more than 
+    ANALYTICS_PUSHDOWN_THRESHOLD events are grouped inside MongoDB instead of transferring every event.
+    """
+    query = {"timestamp": {"$gte": start, "$lte": end}}
+    if location is not None:
+        query["location"] = location
+        
+    if mongo.events.count_documents(query, maxTimeMS=ANALYTICS_MAX_TIME_MS) > ANALYTICS_PUSHDOWN_THRESHOLD:
+        return aggregate_summary(mongo, start, end, location)
+    return summarize_columns(load_columns(mongo, start, end, location), end)
+    
+    
+def summarize(mongo: EventsMongoDB, start: int, end: int, location: str = None) -> HistorySummary:
+    """
+    Compute the per-location summary of a time window.
+    
+    Windows longer than ANALYTICS_ROLLUP_DAYS read the hourly and daily rollups (see server/rollup.py) up to the 
+    last rolled up hour, and only the raw events after it, so the cost doesn't grow with the length of the window 
+    and the summary still covers the hours whose raw events already expired.
+    """
+    if end - start <= ANALYTICS_ROLLUP_DAYS * 86400:
+        return summarize_events(mongo, start, end, location)
+    
+    summary, stop = rollup_summary(mongo, start, end, location)
+    if stop >= end:
+        return summary
+    return merge_summaries(summary, summarize_events(mongo, max(start, stop), end, location))
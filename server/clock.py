@@ -0,0 +1,47 @@
+import time as _time
+
+
+class SystemClock:
+    """The wall clock, used unless another clock is installed with set_clock"""
+    def time(self) -> float:
+        return _time.time()
+
+
+class VirtualClock:
+    def __init__(self, start: float = 0):
+        """A clock that only moves when it is told to, so recorded traffic can be replayed faster than real time
+
+        Args:
+            start (float): The Unix timestamp the clock starts at.
+        """
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def set(self, timestamp: float) -> None:
+        """Move the clock to `timestamp`, the clock never goes back"""
+        if timestamp > self.now:
+            self.now = timestamp
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+_clock = SystemClock()
+
+
+def time() -> float:
+    """Get the current Unix timestamp from the installed clock, used instead of time.time() by the alarm state machine"""
+    return _clock.time()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock) -> object:
+    """Install a clock (anything with a `time()` method), returns the previous clock so it can be restored"""
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
@@ -0,0 +1,156 @@
+import asyncio
+import heapq
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from . import clock
+from .mongo import IoTEvent
+
+
+@dataclass
+class LocationDigest:
+    """The state changes of one sensor that were held back during a coalescing window"""
+    location: str
+    events: list[IoTEvent] = field(default_factory=list)
+    changes: int = 0  # All changes in the window, including the first one that was sent right away
+    flapping: bool = False
+
+    @property
+    def sensor_status(self) -> str:
+        return self.events[-1].sensor_status
+
+    @property
+    def first_timestamp(self) -> int:
+        return self.events[0].timestamp
+
+    @property
+    def last_timestamp(self) -> int:
+        return self.events[-1].timestamp
+
+
+class AlertCoalescer:
+    def __init__(self, window: float, flap_changes: int, on_flush: Callable[[list[LocationDigest]], Awaitable[None]],
+                 logger=None):
+        """Merges bursts of state changes per sensor into a single digest between detection and delivery.
+
+        The first change of a sensor is passed through to be sent right away and opens a window for that sensor.
+        Further changes within the window are held back, and once the window runs out they are flushed as one
+        digest, which opens the next window. A window without held back changes closes, so the next change of
+        the sensor is sent right away again.
+
+        Args:
+            window (float): The amount of seconds changes of a sensor are held back after an alert. 0 disables coalescing.
+            flap_changes (int): A sensor that changes this many times within one window is marked as flapping.
+            on_flush (coroutine function): Called with the digests of all windows that ran out at the same time.
+            logger: Optional logger used to report failed flushes (printed otherwise).
+        """
+        self.window = window
+        self.flap_changes = flap_changes
+        self.on_flush = on_flush
+        self.logger = logger
+        self._heap = []  # [(deadline, location), ...] one entry per open window
+        self._windows = {}  # {location: LocationDigest} of the open windows
+        self._wakeup = None
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def pending(self) -> int:
+        """Get the amount of changes that are held back"""
+        return sum(len(digest.events) for digest in self._windows.values())
+
+    def add(self, events: list[IoTEvent], now: float) -> list[IoTEvent]:
+        """Register new state changes, returns the changes that should be sent right away"""
+        if self.window <= 0:
+            return events
+
+        immediate = []
+        earliest = self._heap[0][0] if self._heap else None
+        for event in events:
+            digest = self._windows.get(event.location)
+            if digest is None:
+                # First change of a burst, open a window and let it through
+                self._windows[event.location] = LocationDigest(event.location, changes=1)
+                heapq.heappush(self._heap, (now + self.window, event.location))
+                immediate.append(event)
+            else:
+                digest.events.append(event)
+                digest.changes += 1
+                digest.flapping = digest.flapping or digest.changes >= self.flap_changes
+
+        # Only wake the background task if a window runs out before the one it is sleeping on
+        if self._wakeup is not None and self._heap and (earliest is None or self._heap[0][0] < earliest):
+            self._wakeup.set()
+        return immediate
+
+    def next_deadline(self) -> Optional[float]:
+        """Get the time the earliest window runs out, or None if no windows are open"""
+        return self._heap[0][0] if self._heap else None
+
+    def flush_due(self, now: float) -> list[LocationDigest]:
+        """Close all windows that ran out at `now`, returns the digests of those with held back changes"""
+        digests = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, location = heapq.heappop(self._heap)
+            digest = self._windows.pop(location)
+            if not digest.events:
+                continue
+            digests.append(digest)
+            # Keep coalescing a sensor that is still changing, a flapping sensor gets one digest per window
+            self._windows[location] = LocationDigest(location, flapping=digest.flapping)
+            heapq.heappush(self._heap, (deadline + self.window, location))
+        return digests
+
+    def flush_all(self) -> list[LocationDigest]:
+        """Close every window, returns the digests of those with held back changes"""
+        digests = [digest for digest in self._windows.values() if digest.events]
+        self._heap.clear()
+        self._windows.clear()
+        return digests
+
+    def start(self) -> None:
+        """Start the background task on the running event loop"""
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background task and flush the changes that are still held back"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        await self._flush(self.flush_all())
+
+    async def _run(self) -> None:
+        while True:
+            deadline = self.next_deadline()
+            try:
+                if deadline is None:
+                    await self._wakeup.wait()
+                else:
+                    await asyncio.wait_for(self._wakeup.wait(), max(deadline - clock.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            await self._flush(self.flush_due(clock.time()))
+
+    async def _flush(self, digests: list[LocationDigest]) -> None:
+        if not digests:
+            return
+        try:
+            await self.on_flush(digests)
+        except Exception as err:
+            # Keep coalescing, only the digests of this flush are lost
+            msg = f"Failed to send the digests of {len(digests)} sensors: {err}"
+            if self.logger is not None:
+                self.logger.error(msg, exc_info=err)
+            else:
+                print(msg)
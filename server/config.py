@@ -1,4 +1,65 @@
 MONGODB_DATABASE = "et-final-project"
 MONGODB_EVENTS_COLLECTION = "events"
+MONGODB_HOURLY_COLLECTION = "events_hourly"  # Per-location hourly rollups of the events (see server/rollup.py)
+MONGODB_DAILY_COLLECTION = "events_daily"  # Per-location daily rollups of the events
+MONGODB_ROLLUP_STATE_COLLECTION = "rollup_state"  # How far the events are rolled up and the sensor states at that point
+MONGODB_SCHEMA_COLLECTION = "schema"  # The schema version of each collection, so finished migrations are skipped
 
-SENSOR_DISCONNECT_TIME = 60  # The amount of time that should be passed for a sensor to be disconnected
\ No newline at end of file
+SENSOR_DISCONNECT_TIME = 60  # The amount of time that should be passed for a sensor to be disconnected
+SENSOR_WS_HEARTBEAT = 15  # Seconds between WebSocket pings to connected sensors, a missed pong disconnects the sensor
+SENSOR_WS_REFRESH = 20  # Seconds between refreshes of the shared last message time of WebSocket sensors, below SENSOR_DISCONNECT_TIME
+SENSOR_MAX_BODY = 16 * 1024  # The maximum size in bytes of a sensor request body, larger requests are rejected unread
+TELEGRAM_MAX_BODY = 1024 * 1024  # The maximum size in bytes of a Telegram update request body
+SENSOR_BATCH_MAX_READINGS = 256  # The maximum amount of readings in a single sensor_batch request
+SENSOR_MAX_ACTIVE = 64  # The amount of sensor requests handled at once, further requests wait in a queue
+SENSOR_MAX_QUEUED = 256  # The amount of sensor requests that can wait, more are rejected with 429 (heartbeats are never queued)
+SENSOR_RATE = 5  # The sustained amount of requests per second of a single sensor, status changes of armed sensors are exempt
+SENSOR_BURST = 10  # The amount of requests a single sensor can send in a quick burst
+SENSOR_RETRY_AFTER = 1  # The amount of seconds in the Retry-After header of a rejected sensor request
+STATE_SNAPSHOT_INTERVAL = 10  # Seconds between snapshots of the in-memory sensor registry (only written if it changed)
+STATE_DB_BUSY_TIMEOUT = 0.05  # Seconds a SQLite state write waits for the lock of another worker before it is retried
+STATE_DB_LOCK_RETRIES = 50  # The amount of attempts of a SQLite state write while other workers hold the lock
+STATE_DB_RETRY_DELAY = 0.02  # Seconds the event loop runs other requests between attempts of a locked SQLite state write
+
+ALERT_TIMEZONE = 'US/Central'  # The timezone used for the alert timestamps and history summaries
+ALERT_COALESCE_WINDOW = 30  # Seconds further changes of a sensor are held back after an alert and sent as one digest (0 to disable)
+ALERT_FLAP_CHANGES = 4  # A sensor that changes this many times within one coalescing window is marked as flapping
+
+EVENT_BATCH_SIZE = 100  # The maximum amount of events written to MongoDB in one insert_many batch
+EVENT_FLUSH_INTERVAL = 0.25  # The maximum amount of seconds an event waits in memory before it is fsynced to the spool
+EVENT_SPOOL_COMPACT_BYTES = 1024 * 1024  # The spool is truncated once it is fully written to MongoDB and larger than this
+EVENT_RETRY_MAX_DELAY = 30  # The maximum amount of seconds between attempts to drain the spool while MongoDB is unreachable
+DEDUP_CACHE_SIZE = 100000  # The amount of recent sensor reading keys kept in memory to drop resent readings
+EVENT_QUERY_BATCH_SIZE = 1000  # The amount of events fetched per round trip when streaming event history
+
+# Telegram Bot API rate limits used by the alert dispatcher (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+TG_GLOBAL_RATE = 30  # The maximum amount of messages per second sent across all chats
+TG_CHAT_RATE = 1  # The sustained amount of messages per second sent to a single chat
+TG_CHAT_BURST = 3  # The amount of messages that can be sent to a single chat in a quick burst
+TG_MAX_RETRIES = 3  # The amount of times a message is retried after a 429 (Too Many Requests) response
+
+TEMPLATE_RELOAD_INTERVAL = 5  # The minimum amount of seconds between checks for changed files in server/resources
+
+LOG_MAX_BYTES = 10 * 1024 * 1024  # The size of server/logs/log.txt before it is rotated and compressed
+LOG_BACKUP_COUNT = 5  # The amount of compressed log files that are kept
+LOG_SAMPLE_INTERVAL = 60  # Repetitive logs (e.g. sensor heartbeats) are logged at most once per interval in seconds
+PROFILE_DEFAULT_SECONDS = 10  # The length of a /profile window when no amount of seconds is given
+PROFILE_MAX_SECONDS = 120  # The maximum length of a /profile window
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples of the event loop thread while profiling
+PROFILE_LAG_INTERVAL = 0.05  # Seconds between event loop lag measurements while profiling
+
+# Event history analytics used by the /history command
+FLAP_WINDOW = 30  # A state change that is reversed within this amount of seconds counts as a flap
+HISTORY_DEFAULT_DAYS = 7  # The amount of days summarized by /history when no amount is given
+HISTORY_MAX_DAYS = 365  # The maximum amount of days that can be summarized by /history
+HISTORY_TIMEOUT = 20  # The maximum amount of seconds /history waits for the summary
+ANALYTICS_PUSHDOWN_THRESHOLD = 50000  # Windows with more events than this are grouped inside MongoDB
+ANALYTICS_MAX_TIME_MS = 15000  # The maximum amount of milliseconds MongoDB may spend on an analytics query
+ANALYTICS_ROLLUP_DAYS = 2  # Windows longer than this amount of days are summarized from the rollups
+EXPORT_MAX_UPLOAD_BYTES = 50 * 1024 * 1024  # The maximum size of an /export file, the Bot API limit for documents
+
+# Retention of the raw events and their rollups
+EVENT_RETENTION_DAYS = 90  # Raw events are deleted by a TTL index this amount of days after they happened (None keeps them)
+ROLLUP_HOURLY_RETENTION_DAYS = 400  # Hourly rollups are deleted after this amount of days, daily rollups are kept
+ROLLUP_INTERVAL = 300  # Seconds between runs of the rollup job
+ROLLUP_DELAY = 120  # Seconds after the end of an hour before it is rolled up, should be longer than FLAP_WINDOW
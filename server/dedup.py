@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Optional
+
+
+def sequence_key(reading: dict) -> Optional[str]:
+    """
+    Get the idempotency key of a reading that carries a sequence number: the device (location and boot id,
+    since the counter starts over when the M5Stick restarts) plus the sequence number. None for other readings.
+    """
+    if "seq" not in reading:
+        return None
+    device = f"{reading['location']}/{reading['boot']}" if "boot" in reading else reading["location"]
+    return f"{device}#{reading['seq']}"
+
+
+def event_key(reading: dict) -> str:
+    """
+    Get the idempotency key stored with a new event, the sequence key if the reading has one.
+
+    Otherwise the key is a hash of the reading (sensor, status and timestamp), so the same reading sent again gets
+    the same key and is only stored once. Timestamps have a resolution of one second, so a sensor that changes to
+    the same status twice within a second without a seq is stored once (its alerts are not affected).
+    """
+    key = sequence_key(reading)
+    if key is not None:
+        return key
+    payload = f"{reading['location']}|{reading['sensor_status']}|{reading['timestamp']}"
+    return blake2b(payload.encode("utf8"), digest_size=12).hexdigest()
+
+
+class DedupCache:
+    def __init__(self, maxsize: int):
+        """Bounded set of recently seen keys, the least recently seen key is evicted once `maxsize` is reached"""
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+    def add(self, key: str) -> bool:
+        """Add a key, returns False if it was already seen"""
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return False
+        self._keys[key] = None
+        if len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+        return True
@@ -0,0 +1,133 @@
+import asyncio
+from time import monotonic, perf_counter
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+from .config import TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST, TG_MAX_RETRIES
+from .logger import logger
+from .metrics import TELEGRAM_SEND_SECONDS, TELEGRAM_MESSAGES
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """Token bucket rate limiter for coroutines on a single event loop.
+        
+        Args:
+            rate (float): The amount of tokens added per second.
+            capacity (float): The maximum amount of tokens that can be stored (burst size).
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        
+    def try_acquire(self) -> float:
+        """Take a token if one is available.
+        
+        Returns 0 if the token was taken, otherwise the amount of seconds until one is available.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+        
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it"""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+            
+
+class AlertDispatcher:
+    def __init__(self, bot: AsyncTeleBot, global_rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE, 
+                 chat_burst: float = TG_CHAT_BURST, max_retries: int = TG_MAX_RETRIES):
+        """Sends messages to many chats concurrently while staying inside the Telegram Bot API limits.
+        
+        Every message takes a token from the bucket of its chat and from the global bucket before it is sent,
+        and 429 (Too Many Requests) responses are retried after the `retry_after` given by Telegram.
+        
+        Args:
+            bot (AsyncTeleBot): The bot used to send the messages.
+            global_rate (float): The maximum amount of messages per second across all chats.
+            chat_rate (float): The sustained amount of messages per second for a single chat.
+            chat_burst (float): The amount of messages that can be sent to a single chat in a burst.
+            max_retries (int): The amount of retries for a message after a 429 response.
+        """
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        
+        # Keep references to the background sends so they are not garbage collected before finishing
+        self._tasks = set()
+        
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+        
+    async def send(self, chat_id, text: str, **kwargs):
+        """Send a single message, waiting for the rate limits and retrying 429 responses.
+        
+        Returns the sent message, or None if the message could not be delivered.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            start = perf_counter()
+            try:
+                message = await self.bot.send_message(chat_id, text=text, **kwargs)
+                TELEGRAM_SEND_SECONDS.observe(perf_counter() - start)
+                TELEGRAM_MESSAGES.inc(result="sent")
+                return message
+            except ApiTelegramException as err:
+                TELEGRAM_SEND_SECONDS.observe(perf_counter() - start)
+                if err.error_code != 429 or attempt == self.max_retries:
+                    TELEGRAM_MESSAGES.inc(result="failed")
+                    logger.error(f"Failed to send message to {chat_id}: {err}", logger_type="main", exc_info=err)
+                    return None
+                TELEGRAM_MESSAGES.inc(result="rate_limited")
+                retry_after = err.result_json.get("parameters", {}).get("retry_after", 1)
+                logger.warn(f"Rate limited by Telegram when messaging {chat_id}, retrying in {retry_after}s", 
+                            logger_type="main")
+                await asyncio.sleep(retry_after)
+            except Exception as err:
+                TELEGRAM_MESSAGES.inc(result="failed")
+                logger.error(f"Failed to send message to {chat_id}: {err}", logger_type="main", exc_info=err)
+                return None
+        
+    async def send_all(self, chat_ids: list, text: str, **kwargs) -> list:
+        """Send the same message to all chats at once and wait for every delivery"""
+        return await asyncio.gather(*(self.send(chat_id, text, **kwargs) for chat_id in chat_ids))
+    
+    def broadcast(self, chat_ids: list, text: str, **kwargs) -> asyncio.Task:
+        """Send the same message to all chats at once in the background, returns without waiting"""
+        task = asyncio.get_running_loop().create_task(self.send_all(chat_ids, text, **kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+    
+    def pending(self) -> int:
+        """Get the amount of background broadcasts that are still being sent"""
+        return len(self._tasks)
+    
+    def cancel(self) -> None:
+        """Cancel the background broadcasts, e.g. to shut down without waiting for rate limited alerts"""
+        for task in list(self._tasks):
+            task.cancel()
+    
+    async def drain(self) -> None:
+        """Wait for all background sends to finish"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
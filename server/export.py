@@ -0,0 +1,154 @@
+import argparse
+import csv
+import io
+import sys
+from datetime import datetime, timezone
+from itertools import islice
+from typing import BinaryIO, Iterator
+
+import pytz
+
+from .config import ALERT_TIMEZONE, EVENT_QUERY_BATCH_SIZE
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+EXPORT_FORMATS = ("csv", "parquet", "arrow")
+EXPORT_COLUMNS = ("_id", "action", "timestamp", "date", "location", "sensor_status", "system_status", "key")
+EXPORT_PROJECTION = {column: 1 for column in EXPORT_COLUMNS}
+
+
+def format_available(fmt: str) -> bool:
+    """Whether the dependencies of an export format are installed"""
+    return fmt == "csv" or pa is not None
+
+
+def _chunks(events: Iterator[dict], chunk_size: int) -> Iterator[list[dict]]:
+    while True:
+        chunk = list(islice(events, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _columns(chunk: list[dict]) -> dict:
+    """Turn a chunk of event documents into export columns"""
+    return {
+        "_id": [str(event["_id"]) for event in chunk],
+        "action": [event.get("action") for event in chunk],
+        "timestamp": [int(event["timestamp"]) for event in chunk],
+        "date": [datetime.fromtimestamp(int(event["timestamp"]), tz=timezone.utc) for event in chunk],
+        "location": [event.get("location") for event in chunk],
+        "sensor_status": [event.get("sensor_status") for event in chunk],
+        "system_status": [event.get("system_status") for event in chunk],
+        "key": [event.get("key") for event in chunk],
+    }
+
+
+def _arrow_schema():
+    return pa.schema([("_id", pa.string()), ("action", pa.string()), ("timestamp", pa.int64()),
+                      ("date", pa.timestamp("s", tz="UTC")), ("location", pa.string()),
+                      ("sensor_status", pa.string()), ("system_status", pa.string()), ("key", pa.string())])
+
+
+def export_events(mongo, output: BinaryIO, fmt: str = "csv", start: int = None, end: int = None,
+                  location: str = None, chunk_size: int = EVENT_QUERY_BATCH_SIZE) -> int:
+    """
+    Stream the events of a time range into a CSV, Parquet or Arrow IPC file, one chunk at a time.
+
+    The events are read from a cursor and every chunk is written as soon as it is fetched, so the memory use
+    only depends on `chunk_size` and not on the size of the history. Parquet and Arrow need pyarrow.
+
+    :param mongo (EventsMongoDB): The connector to read the events from.
+    :param output (BinaryIO): The binary file or stream to write to, it is not closed.
+    :param fmt (str): One of EXPORT_FORMATS.
+    :param start (int): The start timestamp to filter events by.
+    :param end (int): The end timestamp to filter events by.
+    :param location (str): The sensor location to filter events by.
+    :param chunk_size (int): The amount of events fetched and written at once.
+
+    :return int: The amount of exported events
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if not format_available(fmt):
+        raise RuntimeError(f"Exporting to {fmt} requires pyarrow (pip install pyarrow)")
+
+    events = mongo.iter_events(start, end, location, projection=EXPORT_PROJECTION, batch_size=chunk_size)
+    exported = 0
+
+    if fmt == "csv":
+        text = io.TextIOWrapper(output, encoding="utf8", newline="")
+        try:
+            writer = csv.writer(text)
+            writer.writerow(EXPORT_COLUMNS)
+            for chunk in _chunks(events, chunk_size):
+                columns = _columns(chunk)
+                columns["date"] = [date.isoformat() for date in columns["date"]]
+                writer.writerows(zip(*(columns[column] for column in EXPORT_COLUMNS)))
+                text.flush()
+                exported += len(chunk)
+        finally:
+            text.detach()  # Leave the output open for the caller, also when the export fails
+        return exported
+
+    schema = _arrow_schema()
+    if fmt == "parquet":
+        writer = pa.parquet.ParquetWriter(output, schema)
+    else:
+        writer = pa.ipc.new_file(output, schema)
+    try:
+        for chunk in _chunks(events, chunk_size):
+            writer.write_batch(pa.RecordBatch.from_pydict(_columns(chunk), schema=schema))
+            exported += len(chunk)
+    finally:
+        writer.close()
+    return exported
+
+
+def parse_time(value: str) -> int:
+    """Parse a Unix timestamp or an ISO date (e.g. 2023-11-22 or 2023-11-22T22:00), in ALERT_TIMEZONE if it has no offset"""
+    if value.isdigit():
+        return int(value)
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = pytz.timezone(ALERT_TIMEZONE).localize(date)
+    return int(date.timestamp())
+
+
+def main(argv: list[str]) -> int:
+    """Command line entry point: python -m server export [options]"""
+    parser = argparse.ArgumentParser(prog="python -m server export",
+                                     description="Stream the stored sensor events to a CSV, Parquet or Arrow IPC file")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv", help="The output format (default: csv)")
+    parser.add_argument("--start", type=parse_time, help="Only export events from this Unix timestamp or ISO date")
+    parser.add_argument("--end", type=parse_time, help="Only export events until this Unix timestamp or ISO date")
+    parser.add_argument("--location", help="Only export the events of this sensor location")
+    parser.add_argument("--chunk-size", type=int, default=EVENT_QUERY_BATCH_SIZE, help="Events fetched and written at once")
+    parser.add_argument("-o", "--output", default="-", help="The output file, - for stdout (default)")
+    args = parser.parse_args(argv)
+
+    # Imported here so the module can be used without a connection string
+    from .mongo import EventsMongoDB
+    mongo = EventsMongoDB()
+
+    try:
+        if args.output == "-":
+            exported = export_events(mongo, sys.stdout.buffer, args.format, args.start, args.end,
+                                     args.location, args.chunk_size)
+            sys.stdout.buffer.flush()
+        else:
+            with open(args.output, "wb") as f:
+                exported = export_events(mongo, f, args.format, args.start, args.end, args.location, args.chunk_size)
+    except RuntimeError as err:
+        print(err, file=sys.stderr)
+        return 1
+    finally:
+        mongo.close()
+
+    print(f"Exported {exported} events", file=sys.stderr)
+    return 0
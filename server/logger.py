@@ -1,18 +1,111 @@
+import atexit
+import gzip
+import json
 import logging
-from os import getenv
+import shutil
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from os import getenv, remove, register_at_fork
 from os.path import join, isdir
+from queue import SimpleQueue
+from time import monotonic
 import tg_logger
 from telebot import logger as main_logger
 
+from .config import LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_SAMPLE_INTERVAL
 from .util import get_logfile
 
 formatter = logging.Formatter('%(module)s : %(levelname)s : %(asctime)s : %(message)s')
 
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects for the log file"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record),
+                 "level": record.levelname,
+                 "module": record.module,
+                 "message": record.getMessage()}
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+    
+    
+class SamplingFilter(logging.Filter):
+    def __init__(self, interval: float = LOG_SAMPLE_INTERVAL):
+        """
+        Rate limits repetitive records (e.g. sensor heartbeats) to one per `interval` seconds for each `sample_key`.
+        Records without a `sample_key` always pass. The amount of suppressed records is added to the next one that passes.
+        Keys whose interval ran out are evicted once per interval, so the filter only holds the recently used keys.
+        """
+        super().__init__()
+        self.interval = interval
+        self._last = {}  # {sample_key: monotonic time of the last record that passed}
+        self._suppressed = {}  # {sample_key: amount of records suppressed since}
+        self._swept = monotonic()
+        
+    def _evict_expired(self, now: float) -> None:
+        """Drop the keys whose interval ran out, their next record passes like the first one"""
+        expired_before = now - self.interval
+        self._last = {key: last for key, last in self._last.items() if last > expired_before}
+        self._suppressed = {key: count for key, count in self._suppressed.items() if key in self._last}
+        self._swept = now
+        
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample_key", None)
+        if key is None:
+            return True
+        
+        now = monotonic()
+        if now - self._swept >= self.interval:
+            self._evict_expired(now)
+        if now - self._last.get(key, float("-inf")) < self.interval:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return False
+        
+        self._last[key] = now
+        suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} similar suppressed)"
+            record.args = None
+        return True
+    
+    
+class DeferredQueueHandler(QueueHandler):
+    """Queues records as-is so that formatting happens on the listener thread instead of the event loop"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The listener runs in the same process, so the record doesn't need to be made picklable
+        return record
+    
+    
+def _gzip_rotator(source: str, dest: str) -> None:
+    """Compress rotated log files"""
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    remove(source)
+    
+    
+def _queue_handlers(target: logging.Logger, handlers: list) -> QueueListener:
+    """Move the handlers of a logger to a background thread fed by a queue"""
+    for handler in handlers:
+        target.removeHandler(handler)
+        
+    queue = SimpleQueue()
+    queue_handler = DeferredQueueHandler(queue)
+    queue_handler.addFilter(SamplingFilter())
+    target.addHandler(queue_handler)
+    
+    listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
 # Set the level for the main logger from asynctelebot module to debug, then determine handler levels individually
 main_logger.setLevel(logging.DEBUG)
 
-file_handler = logging.FileHandler(get_logfile(), encoding='utf-8')
-file_handler.setFormatter(formatter)
+file_handler = RotatingFileHandler(get_logfile(), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+file_handler.namer = lambda name: name + ".gz"
+file_handler.rotator = _gzip_rotator
+file_handler.setFormatter(JsonFormatter())
 file_handler.setLevel(logging.DEBUG)  # <---- DETERMINES WHICH LOG LEVELS ARE OUTPUT TO THE LOG FILE
 
 # Set the level of the existing StreamHandler
@@ -30,61 +123,73 @@ tg_logger.setup(telegram_logger,
                 token=getenv("TG_BOT_TOKEN"),
                 users=getenv("TG_USERS").split(","))  # Logs to the admin user by default
 
+# Format and write the records on background threads, repetitive records are sampled before being queued
+main_listener = _queue_handlers(main_logger, list(main_logger.handlers))
+telegram_listener = _queue_handlers(telegram_logger, list(telegram_logger.handlers))
+
+# Threads don't survive a fork, restart the listeners in forked webhook workers
+register_at_fork(after_in_child=lambda: (main_listener.start(), telegram_listener.start()))
+
 
 class CustomLogger:
     def __init__(self, main_log, tg_log):
         self.main_logger = main_log
         self.telegram_logger = tg_log
 
-    def debug(self, msg: str, logger_type: str = None, exc_info=None) -> None:
+    def debug(self, msg: str, logger_type: str = None, exc_info=None, sample_key: str = None) -> None:
+        extra = {"sample_key": sample_key}
         if logger_type == "main":
-            self.main_logger.debug(msg, exc_info=exc_info)
+            self.main_logger.debug(msg, exc_info=exc_info, extra=extra)
         elif logger_type == "telegram":
             assert exc_info is None, "exc_info is not supported on telegram logger"
-            self.telegram_logger.debug(msg)
+            self.telegram_logger.debug(msg, extra=extra)
         elif logger_type is None:
-            self.main_logger.debug(msg, exc_info=exc_info)
-            self.telegram_logger.debug(msg)
+            self.main_logger.debug(msg, exc_info=exc_info, extra=extra)
+            self.telegram_logger.debug(msg, extra=extra)
 
-    def info(self, msg: str, logger_type: str = None, exc_info=None) -> None:
+    def info(self, msg: str, logger_type: str = None, exc_info=None, sample_key: str = None) -> None:
+        extra = {"sample_key": sample_key}
         if logger_type == "main":
-            self.main_logger.info(msg, exc_info=exc_info)
+            self.main_logger.info(msg, exc_info=exc_info, extra=extra)
         elif logger_type == "telegram":
             assert exc_info is None, "exc_info is not supported on telegram logger"
-            self.telegram_logger.info(msg)
+            self.telegram_logger.info(msg, extra=extra)
         elif logger_type is None:
-            self.main_logger.info(msg, exc_info=exc_info)
-            self.telegram_logger.info(msg)
+            self.main_logger.info(msg, exc_info=exc_info, extra=extra)
+            self.telegram_logger.info(msg, extra=extra)
 
-    def warn(self, msg: str, logger_type: str = None, exc_info=None) -> None:
+    def warn(self, msg: str, logger_type: str = None, exc_info=None, sample_key: str = None) -> None:
+        extra = {"sample_key": sample_key}
         if logger_type == "main":
-            self.main_logger.warning(msg, exc_info=exc_info)
+            self.main_logger.warning(msg, exc_info=exc_info, extra=extra)
         elif logger_type == "telegram":
             assert exc_info is None, "exc_info is not supported on telegram logger"
-            self.telegram_logger.warning(msg)
+            self.telegram_logger.warning(msg, extra=extra)
         elif logger_type is None:
-            self.main_logger.warning(msg, exc_info=exc_info)
-            self.telegram_logger.warning(msg)
+            self.main_logger.warning(msg, exc_info=exc_info, extra=extra)
+            self.telegram_logger.warning(msg, extra=extra)
 
-    def error(self, msg: str, logger_type: str = None, exc_info=None) -> None:
+    def error(self, msg: str, logger_type: str = None, exc_info=None, sample_key: str = None) -> None:
+        extra = {"sample_key": sample_key}
         if logger_type == "main":
-            self.main_logger.error(msg, exc_info=exc_info)
+            self.main_logger.error(msg, exc_info=exc_info, extra=extra)
         elif logger_type == "telegram":
             assert exc_info is None, "exc_info is not supported on telegram logger"
-            self.telegram_logger.error(msg)
+            self.telegram_logger.error(msg, extra=extra)
         elif logger_type is None:
-            self.main_logger.error(msg, exc_info=exc_info)
-            self.telegram_logger.error(msg)
+            self.main_logger.error(msg, exc_info=exc_info, extra=extra)
+            self.telegram_logger.error(msg, extra=extra)
 
-    def critical(self, msg: str, logger_type: str = None, exc_info=None) -> None:
+    def critical(self, msg: str, logger_type: str = None, exc_info=None, sample_key: str = None) -> None:
+        extra = {"sample_key": sample_key}
         if logger_type == "main":
-            self.main_logger.critical(msg, exc_info=exc_info)
+            self.main_logger.critical(msg, exc_info=exc_info, extra=extra)
         elif logger_type == "telegram":
             assert exc_info is None, "exc_info is not supported on telegram logger"
-            self.telegram_logger.critical(msg)
+            self.telegram_logger.critical(msg, extra=extra)
         elif logger_type is None:
-            self.main_logger.critical(msg, exc_info=exc_info)
-            self.telegram_logger.critical(msg)
+            self.main_logger.critical(msg, exc_info=exc_info, extra=extra)
+            self.telegram_logger.critical(msg, extra=extra)
 
 
 # Creating an instance of the CustomLogger class named 'logger'
@@ -0,0 +1,162 @@
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter, time
+from typing import Callable
+
+# Latency buckets in seconds, from sub-millisecond event handling to slow Atlas and Bot API round trips
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: dict = None) -> str:
+    items = list(key) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in items) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        """A value that only goes up, e.g. the amount of handled requests"""
+        self.name = name
+        self.documentation = documentation
+        self.values = {}  # {label key: value}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(_label_key(labels), 0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(key)} {value}" for key, value in self.values.items()]
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str, function: Callable[[], float] = None):
+        """A value that goes up and down, either set directly or read from `function` when rendered"""
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {self.get()}"]
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS):
+        """Counts observations in fixed buckets, an observation is a bisect and two additions"""
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.series = {}  # {label key: [bucket counts..., +Inf count, sum]}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, **labels):
+        """Decorator that observes the duration of each call of a coroutine function"""
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def count(self, **labels) -> int:
+        series = self.series.get(_label_key(labels))
+        return sum(series[:-1]) if series else 0
+
+    def quantile(self, q: float, **labels) -> float:
+        """Estimate a quantile by interpolating inside the bucket that contains it"""
+        series = self.series.get(_label_key(labels))
+        if not series:
+            return 0
+        rank = q * sum(series[:-1])
+        cumulative = 0
+        for i, bucket_count in enumerate(series[:-1]):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(key, {'le': bound})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """Holds all metrics of the process and renders them in the Prometheus text format"""
+        self.metrics = {}
+        self.started = time()
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str, function: Callable[[], float] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, function))
+
+    def histogram(self, name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+Metrics = MetricsRegistry()
+
+# Hot path latencies
+REQUEST_SECONDS = Metrics.histogram("roomraider_request_seconds", "Time spent handling a webhook request by action")
+HANDLE_EVENTS_SECONDS = Metrics.histogram("roomraider_handle_events_seconds", "Time spent in handle_events")
+MONGO_WRITE_SECONDS = Metrics.histogram("roomraider_mongo_write_seconds", "Time spent writing a batch of events to MongoDB")
+TELEGRAM_SEND_SECONDS = Metrics.histogram("roomraider_telegram_send_seconds", "Time spent sending a Telegram message")
+
+# Counters
+REQUESTS = Metrics.counter("roomraider_requests_total", "Webhook requests by action and response status")
+REQUESTS_SHED = Metrics.counter("roomraider_requests_shed_total", "Sensor requests rejected by admission control by reason (rate_limited, heartbeat, queue_full)")
+MONGO_WRITTEN_EVENTS = Metrics.counter("roomraider_mongo_written_events_total", "Events written to MongoDB")
+DUPLICATE_EVENTS = Metrics.counter("roomraider_duplicate_events_total", "Events dropped as duplicates by the dedup cache or the unique key index")
+MONGO_WRITE_ERRORS = Metrics.counter("roomraider_mongo_write_errors_total", "Failed MongoDB batch writes")
+TELEGRAM_MESSAGES = Metrics.counter("roomraider_telegram_messages_total", "Telegram messages by result (sent, failed, rate_limited)")
+ALERTS_COALESCED = Metrics.counter("roomraider_alerts_coalesced_total", "Sensor state changes sent in an alert digest instead of their own alert")
+SENSOR_CONNECTS = Metrics.counter("roomraider_sensor_connects_total", "Sensors that connected")
+SENSOR_DISCONNECTS = Metrics.counter("roomraider_sensor_disconnects_total", "Sensors that disconnected")
@@ -1,11 +1,23 @@
+import asyncio
+import threading
 from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
 from os import getenv
+from time import perf_counter
+from typing import Iterator, Optional
 from urllib.parse import quote_plus
-from dotenv import find_dotenv, load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from bson import ObjectId
 
-from .config import MONGODB_DATABASE, MONGODB_EVENTS_COLLECTION
+from .spool import EventSpool
+from .metrics import MONGO_WRITE_SECONDS, MONGO_WRITTEN_EVENTS, MONGO_WRITE_ERRORS, DUPLICATE_EVENTS
+from .config import (MONGODB_DATABASE, MONGODB_EVENTS_COLLECTION, MONGODB_HOURLY_COLLECTION, MONGODB_DAILY_COLLECTION,
+                     MONGODB_ROLLUP_STATE_COLLECTION, MONGODB_SCHEMA_COLLECTION, EVENT_BATCH_SIZE, EVENT_FLUSH_INTERVAL, 
+                     EVENT_QUERY_BATCH_SIZE, EVENT_RETRY_MAX_DELAY, ROLLUP_HOURLY_RETENTION_DAYS)
+
+EVENT_SCHEMA_VERSION = 1  # Events have an integer timestamp and a BSON date
+
 
 @dataclass
 class IoTEvent:
@@ -15,44 +27,77 @@ class IoTEvent:
     location: str  # The location of the sensor (added for scalability)
     sensor_status: str  # "OPEN" or "CLOSED"
     system_status: str  # "ARMED" or "DISARMED"
+    key: str = None  # Idempotency key, unique per event (see dedup.event_key)
     _id: ObjectId = None  # The ID of the event in the database, automatically generated
+    date: datetime = None  # The timestamp as a BSON date, set when the event is stored
+    
+    def __post_init__(self):
+        # Events stored before the typed schema have the timestamp as a string
+        self.timestamp = int(self.timestamp)
     
     def dict(self):
-        return {k: str(v) for k, v in asdict(self).items()}
+        event = asdict(self)
+        event["date"] = datetime.fromtimestamp(self.timestamp, tz=timezone.utc)
+        return event
+    
+    def record(self) -> dict:
+        """The fields of the event without the database fields, e.g. to write the event to the spool as JSON"""
+        event = asdict(self)
+        del event["_id"], event["date"]
+        return event
     
 
 class EventsMongoDB(MongoClient):
     def __init__(self, *args, **kwargs):
         """Connector that contains all methods required to interact with the MongoDB M5Stick Event data.
             
-        Warn: Loads connection values from .env or environment, make sure that these are loaded before this is instantiated.
+        Warn: Reads the connection string from the environment, make sure that .env is loaded (see util.handle_env) 
+        before this is instantiated.
         """
-        envpath = find_dotenv(raise_error_if_not_found=True, usecwd=True)
-        load_dotenv(dotenv_path=envpath)
-
-        # Construct the connection string
         cxn_string = getenv("MONGODB_CONNECTION_STRING")
-
         
         super().__init__(cxn_string, *args, **kwargs)
         
         self.uri = cxn_string
         self.database = self[MONGODB_DATABASE]
         self.events = self.database[MONGODB_EVENTS_COLLECTION]
+        self.hourly = self.database[MONGODB_HOURLY_COLLECTION]
+        self.daily = self.database[MONGODB_DAILY_COLLECTION]
+        self.rollup_state = self.database[MONGODB_ROLLUP_STATE_COLLECTION]
+        self.schema = self.database[MONGODB_SCHEMA_COLLECTION]
     
     # ------------------ USER METHODS ------------------ #
     
-    def get_all_events(self, start: int = None, end: int = None) -> list[IoTEvent]:
+    def get_all_events(self, start: int = None, end: int = None, location: str = None) -> list[IoTEvent]:
         """
         Fetches all events from the database.
         
         :param start (int): The start timestamp to filter events by.
         :param end (int): The end timestamp to filter events by.
+        :param location (str): The sensor location to filter events by.
         
         :return list[M5StickEvent]: A list of all events in the database
         """
+        return [IoTEvent(**event) for event in self.iter_events(start, end, location)]
+    
+    def iter_events(self, start: int = None, end: int = None, location: str = None, projection: dict = None, 
+                    batch_size: int = EVENT_QUERY_BATCH_SIZE) -> Iterator[dict]:
+        """
+        Streams the events from the database in timestamp order, holding one cursor batch in memory at a time.
+        
+        :param start (int): The start timestamp to filter events by.
+        :param end (int): The end timestamp to filter events by.
+        :param location (str): The sensor location to filter events by.
+        :param projection (dict): The fields to return for each event, all fields by default.
+        :param batch_size (int): The amount of events fetched from the server per round trip.
+        
+        :return Iterator[dict]: The raw event documents
+        """
         query = {}
         
+        if location is not None:
+            query["location"] = location
+        
         if start is not None or end is not None:
             timestamp_query = {}
             if start is not None:
@@ -61,31 +106,334 @@ class EventsMongoDB(MongoClient):
                 timestamp_query["$lte"] = end
             query["timestamp"] = timestamp_query
             
-        return [IoTEvent(**event) for event in self.events.find(query)]
+        cursor = self.events.find(query, projection=projection, batch_size=batch_size).sort("timestamp", ASCENDING)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
 
     
     def add_event(self, event: IoTEvent) -> IoTEvent:
-        """Adds a user to the MongoDB database only if a user with the same ID doesn't already exist.
+        """Adds a single event to the MongoDB database.
 
         Args:
-            user (User): The user to add to the database.
+            event (IoTEvent): The event to add to the database.
+            
+        Returns the event with the `_id` assigned by the insert.
         """
         event_dict = event.dict()
         if "_id" in event_dict:
             del event_dict["_id"]
             
-        self.events.insert_one(event_dict)
+        try:
+            result = self.events.insert_one(event_dict)
+        except DuplicateKeyError:
+            # The event was already stored with the same key
+            return event
+        
+        # Take the ID from the insert result instead of querying the document back
+        event._id = result.inserted_id
+        return event
+    
+    def add_events(self, events: list[IoTEvent]) -> list[IoTEvent]:
+        """Adds a batch of events to the MongoDB database in a single round trip.
+        
+        The batch is inserted unordered, so events that were already stored with the same key are rejected by
+        the unique index without stopping the rest of the batch.
+
+        Args:
+            events (list[IoTEvent]): The events to add to the database.
+            
+        Returns the inserted events with the `_id` assigned by the insert, without the duplicates.
+        """
+        if not events:
+            return []
         
-        # Find the event that was just added and load it with the ID
-        return IoTEvent(**self.events.find_one(event_dict))
+        event_dicts = []
+        for event in events:
+            event_dict = event.dict()
+            if "_id" in event_dict:
+                del event_dict["_id"]
+            event_dicts.append(event_dict)
+            
+        duplicates = set()
+        try:
+            self.events.insert_many(event_dicts, ordered=False)
+        except BulkWriteError as err:
+            for error in err.details["writeErrors"]:
+                if error["code"] != 11000:  # Only duplicate key errors are expected
+                    raise
+                duplicates.add(error["index"])
+            DUPLICATE_EVENTS.inc(len(duplicates))
+        
+        # The IDs are assigned to the documents by the driver before they are sent
+        inserted = []
+        for i, (event, event_dict) in enumerate(zip(events, event_dicts)):
+            if i not in duplicates:
+                event._id = event_dict["_id"]
+                inserted.append(event)
+        return inserted
+
+    # ------------------ SCHEMA METHODS ------------------ #
+    
+    def ensure_indexes(self) -> None:
+        """Creates the indexes used by the event history queries, does nothing if they already exist"""
+        self.events.create_index([("location", ASCENDING), ("timestamp", ASCENDING)])
+        self.events.create_index([("timestamp", ASCENDING)])
+        # Events stored before the idempotency keys don't have a key
+        self.events.create_index([("key", ASCENDING)], unique=True,
+                                 partialFilterExpression={"key": {"$type": "string"}})
+        # The rollup buckets are looked up by their start, and replaced by location and start when recomputed
+        for rollups in (self.hourly, self.daily):
+            rollups.create_index([("location", ASCENDING), ("start", ASCENDING)], unique=True)
+            rollups.create_index([("start", ASCENDING)])
+        self.ensure_ttl(self.hourly, ROLLUP_HOURLY_RETENTION_DAYS)
+        
+    def ensure_ttl(self, collection, days: Optional[float]) -> None:
+        """
+        Let MongoDB delete the documents of a collection `days` after their `date` with a TTL index.
+        
+        The expiry of an existing TTL index is updated in place when `days` changes, and the index is dropped
+        if `days` is None so the documents are kept.
+        """
+        index = collection.index_information().get("date_1")
+        if days is None:
+            if index is not None and "expireAfterSeconds" in index:
+                collection.drop_index("date_1")
+            return
+        
+        seconds = int(days * 86400)
+        if index is None:
+            collection.create_index([("date", ASCENDING)], expireAfterSeconds=seconds)
+        elif index.get("expireAfterSeconds") != seconds:
+            self.database.command("collMod", collection.name, 
+                                  index={"keyPattern": {"date": 1}, "expireAfterSeconds": seconds})
+        
+    def migrate_event_types(self, batch_size: int = EVENT_QUERY_BATCH_SIZE) -> int:
+        """
+        Converts events stored with a string timestamp to an integer timestamp and BSON date.
+        
+        New events are always stored typed, so the version is recorded in the schema collection once the events are
+        converted, and later starts skip the scan of the whole collection.
+        
+        :return int: The amount of migrated events
+        """
+        if self.schema.find_one({"_id": MONGODB_EVENTS_COLLECTION, "version": {"$gte": EVENT_SCHEMA_VERSION}}):
+            return 0
+        
+        query = {"$or": [{"timestamp": {"$type": "string"}}, {"date": {"$exists": False}}]}
+        migrated = 0
+        updates = []
+        for event in self.events.find(query, projection={"timestamp": 1}, batch_size=batch_size):
+            timestamp = int(event["timestamp"])
+            updates.append(UpdateOne({"_id": event["_id"]}, 
+                                     {"$set": {"timestamp": timestamp, 
+                                               "date": datetime.fromtimestamp(timestamp, tz=timezone.utc)}}))
+            if len(updates) >= batch_size:
+                migrated += self.events.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if updates:
+            migrated += self.events.bulk_write(updates, ordered=False).modified_count
+        self.schema.update_one({"_id": MONGODB_EVENTS_COLLECTION}, {"$set": {"version": EVENT_SCHEMA_VERSION}}, upsert=True)
+        return migrated
+    
+    def prepare(self) -> int:
+        """Migrates existing events to the typed schema and creates the indexes
+        
+        :return int: The amount of migrated events
+        """
+        migrated = self.migrate_event_types()
+        self.ensure_indexes()
+        return migrated
 
     # ------------------ CLASS METHODS ------------------ #
 
     def ping(self, show_cxn: bool = False):
         print(self.admin.command('ping'))
         if show_cxn:
-            print(f"You successfully connected to MongoDB at {self.uri}!")
+            print("You successfully connected to MongoDB!")
+
+
+class LazyEventsMongoDB:
+    def __init__(self, *args, **kwargs):
+        """Creates the EventsMongoDB connector on first use instead of on import.
+        
+        Creating the client resolves the Atlas SRV record and starts the connection, which should not delay the 
+        server start or block the event loop. Attribute access is passed to the connector, so the first use should
+        happen in a worker thread (like every pymongo call) or after `await connect()`.
+        """
+        self._args = args
+        self._kwargs = kwargs
+        self._client = None
+        self._lock = threading.Lock()
+        
+    @property
+    def client(self) -> EventsMongoDB:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = EventsMongoDB(*self._args, **self._kwargs)
+        return self._client
+    
+    async def connect(self) -> EventsMongoDB:
+        """Create the connector in a worker thread"""
+        return await asyncio.to_thread(lambda: self.client)
+    
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+    
+
+class EventWriter:
+    def __init__(self, mongo: EventsMongoDB, spool_path: str, batch_size: int = EVENT_BATCH_SIZE, 
+                 flush_interval: float = EVENT_FLUSH_INTERVAL, logger=None):
+        """Write-behind queue that stores events in a local spool and drains them to MongoDB in bulk.
+        
+        Queued events are appended to the spool with one write and fsync once `batch_size` events are queued 
+        or `flush_interval` seconds have passed, whichever comes first. The spool is then drained in 
+        `insert_many` batches from its checkpoint. If MongoDB is slow or unreachable the events stay in the 
+        spool and the drain is retried with a backoff, so neither the webhook requests nor the durability of 
+        the events depend on the Atlas round trip. All file and pymongo calls run in a worker thread.
         
-    def close(self):
-        self.close()
-        print(f"Closed connection to MongoDB at {self.uri}.")
\ No newline at end of file
+        Args:
+            mongo (EventsMongoDB): The connector used to write the batches.
+            spool_path (str): The spool file, a different one is needed for every process (see EventSpool).
+            batch_size (int): The maximum amount of events written in one batch.
+            flush_interval (float): The maximum amount of seconds an event waits in memory before it is spooled.
+            logger: Optional logger used to report failed writes (printed otherwise).
+        """
+        self.mongo = mongo
+        self.spool = EventSpool(spool_path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.logger = logger
+        
+        self._pending = []  # Encoded events that are not spooled yet
+        self._retry_delay = 0  # Seconds to wait before the next drain after a failed write
+        self._retry_at = 0
+        self._wakeup = None
+        self._task = None
+        
+    def start(self) -> None:
+        """Open the spool and start the background task on the running event loop"""
+        if self._task is not None:
+            if not self._task.done():
+                return
+            if not self._task.cancelled() and self._task.exception() is not None:
+                self._log_error(f"Restarting the event writer after an error: {self._task.exception()}",
+                                self._task.exception())
+        if self.spool._fd is None:
+            self.spool.open()
+            if self.spool.backlog and self.logger is not None:
+                self.logger.warn(f"Resuming {self.spool.backlog} spooled events that were not written to MongoDB yet")
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        
+    async def stop(self) -> None:
+        """Stop the background task, spool any events still in memory and make a last attempt to drain the spool"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception as err:
+            # Still spool and drain what is left, and let the other services stop
+            self._log_error(f"The event writer stopped with an error: {err}", err)
+        self._task = None
+        
+        await self._sync()
+        await self._drain()
+        self.spool.close()
+        
+    def put(self, event: IoTEvent) -> None:
+        """Queue an event to be written, returns immediately without waiting on the disk or the database"""
+        if self._task is None or self._task.done():
+            self.start()
+        self._pending.append(EventSpool.encode(event.record()))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        
+    def qsize(self) -> int:
+        """Get the amount of events waiting to be written"""
+        return len(self._pending) + self.spool.backlog
+        
+    def put_many(self, events: list[IoTEvent]) -> None:
+        """Queue several events to be written, returns immediately without waiting on the disk or the database"""
+        for event in events:
+            self.put(event)
+        
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            
+            await self._sync()
+            if self.spool.backlog and loop.time() >= self._retry_at:
+                if not await self._drain():
+                    # Back off while MongoDB is unreachable, the events are safe in the spool meanwhile
+                    self._retry_delay = min(max(self._retry_delay * 2, 1), EVENT_RETRY_MAX_DELAY)
+                    self._retry_at = loop.time() + self._retry_delay
+                else:
+                    self._retry_delay = 0
+    
+    async def _sync(self) -> None:
+        """Append the events in memory to the spool"""
+        lines, self._pending = self._pending, []
+        if not lines:
+            return
+        try:
+            await asyncio.to_thread(self.spool.append, lines)
+        except Exception as err:
+            # Keep the events in memory and try again on the next flush
+            self._pending = lines + self._pending
+            self._log_error(f"Failed to append {len(lines)} events to the spool: {err}", err)
+                
+    async def _drain(self) -> bool:
+        """Write the spooled events to MongoDB in batches, returns False if reading, writing or committing failed"""
+        while self.spool.backlog:
+            try:
+                lines, offset = await asyncio.to_thread(self.spool.read, self.batch_size)
+            except Exception as err:
+                self._log_error(f"Failed to read the spool, {self.spool.backlog} events are kept in it: {err}", err)
+                return False
+            if not lines:
+                return True
+            
+            batch = []
+            for line in lines:
+                try:
+                    batch.append(IoTEvent(**EventSpool.decode(line)))
+                except (ValueError, TypeError) as err:
+                    # A corrupt line would block the spool forever, skip it but keep it in the log
+                    self._log_error(f"Skipping an undecodable spooled event {line[:200]!r}: {err}")
+            
+            if batch:
+                start = perf_counter()
+                try:
+                    inserted = await asyncio.to_thread(self.mongo.add_events, batch)
+                except Exception as err:
+                    MONGO_WRITE_ERRORS.inc()
+                    self._log_error(f"Failed to write a batch of {len(batch)} events to MongoDB, "
+                                    f"{self.spool.backlog} events are kept in the spool: {err}", err)
+                    return False
+                MONGO_WRITE_SECONDS.observe(perf_counter() - start)
+                MONGO_WRITTEN_EVENTS.inc(len(inserted))
+            
+            try:
+                await asyncio.to_thread(self.spool.commit, offset, len(lines))
+            except Exception as err:
+                # The batch is written again on the next drain, add_events skips the duplicates
+                self._log_error(f"Failed to advance the spool checkpoint: {err}", err)
+                return False
+        return True
+    
+    def _log_error(self, msg: str, err: Exception = None) -> None:
+        if self.logger is not None:
+            self.logger.error(msg, exc_info=err)
+        else:
+            print(msg)
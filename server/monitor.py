@@ -0,0 +1,127 @@
+import asyncio
+import heapq
+from typing import Awaitable, Callable, Optional
+
+from . import clock
+
+
+class DisconnectMonitor:
+    def __init__(self, timeout: float, on_disconnect: Callable[[str], Awaitable[None]], logger=None):
+        """Tracks a deadline per sensor in a min-heap and reports sensors whose deadline runs out.
+        
+        Every heartbeat pushes a new deadline in O(log n). Superseded deadlines stay in the heap and are 
+        skipped when they reach the top, so the background task only ever looks at the earliest deadline
+        and sleeps until it runs out instead of scanning every sensor.
+        
+        Args:
+            timeout (float): The amount of seconds without a message before a sensor is disconnected.
+            on_disconnect (coroutine function): Called with the location of every disconnected sensor.
+            logger: Optional logger used to report failed disconnects (printed otherwise).
+        """
+        self.timeout = timeout
+        self.on_disconnect = on_disconnect
+        self.logger = logger
+        self._heap = []  # [(deadline, location), ...] including superseded entries
+        self._deadlines = {}  # {location: deadline} with the current deadline of each tracked sensor
+        self._held = set()  # Locations whose liveness is tracked elsewhere (e.g. a WebSocket connection)
+        self._wakeup = None
+        self._task = None
+        
+    def __len__(self) -> int:
+        return len(self._deadlines)
+        
+    def touch(self, location: str, timestamp: float) -> None:
+        """Reschedule the deadline of a sensor after it sent a message at `timestamp`"""
+        if location in self._held:
+            return
+        deadline = timestamp + self.timeout
+        earliest = self.next_deadline()
+        
+        self._deadlines[location] = deadline
+        heapq.heappush(self._heap, (deadline, location))
+        
+        # Rebuild the heap once superseded entries clearly outnumber the tracked sensors
+        if len(self._heap) > 4 * len(self._deadlines) + 64:
+            self._heap = [(d, loc) for loc, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+        
+        # Only wake the background task if this deadline runs out before the one it is sleeping on
+        if self._wakeup is not None and (earliest is None or deadline < earliest):
+            self._wakeup.set()
+            
+    def discard(self, location: str) -> None:
+        """Stop tracking a sensor, its heap entries are skipped lazily"""
+        self._deadlines.pop(location, None)
+        
+    def hold(self, location: str) -> None:
+        """Stop the deadline of a sensor from running out until it is released"""
+        self._held.add(location)
+        self.discard(location)
+        
+    def release(self, location: str) -> None:
+        """Track the deadline of a held sensor again from its next message"""
+        self._held.discard(location)
+        
+    def next_deadline(self) -> Optional[float]:
+        """Get the earliest current deadline, or None if no sensors are tracked"""
+        while self._heap:
+            deadline, location = self._heap[0]
+            if self._deadlines.get(location) == deadline:
+                return deadline
+            heapq.heappop(self._heap)  # Superseded or discarded entry
+        return None
+        
+    def pop_expired(self, now: float) -> list[str]:
+        """Remove and return the locations of all sensors whose deadline ran out at `now`"""
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, location = heapq.heappop(self._heap)
+            if self._deadlines.get(location) == deadline:
+                del self._deadlines[location]
+                expired.append(location)
+        return expired
+    
+    def start(self) -> None:
+        """Start the background task on the running event loop"""
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        
+    async def stop(self) -> None:
+        """Stop the background task"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        
+    async def _run(self) -> None:
+        while True:
+            deadline = self.next_deadline()
+            try:
+                if deadline is None:
+                    await self._wakeup.wait()
+                else:
+                    await asyncio.wait_for(self._wakeup.wait(), max(deadline - clock.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            
+            now = clock.time()
+            for location in self.pop_expired(now):
+                try:
+                    await self.on_disconnect(location)
+                except Exception as err:
+                    # Keep monitoring the other sensors, and retry this one if it doesn't send a message in the meantime
+                    self._log_error(f"Failed to disconnect {location}, retrying in {self.timeout}s: {err}", err)
+                    self.touch(location, now)
+
+    def _log_error(self, msg: str, err: Exception = None) -> None:
+        if self.logger is not None:
+            self.logger.error(msg, exc_info=err)
+        else:
+            print(msg)
@@ -0,0 +1,128 @@
+import asyncio
+import sys
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from time import perf_counter
+
+import numpy as np
+
+from .config import PROFILE_SAMPLE_INTERVAL, PROFILE_LAG_INTERVAL
+
+
+@dataclass
+class ProfileResult:
+    """The samples of a profiling window"""
+    duration: float
+    samples: int = 0
+    stacks: Counter = field(default_factory=Counter)  # {(frame, ...) root first: samples}
+    lags: list[float] = field(default_factory=list)  # Seconds each event loop tick was late
+
+    def idle_samples(self) -> int:
+        """The amount of samples the event loop was waiting for IO in"""
+        return sum(samples for stack, samples in self.stacks.items() if "(selectors.py:" in stack[-1])
+
+    def self_samples(self) -> Counter:
+        """The amount of samples each function was running in (the innermost frame)"""
+        functions = Counter()
+        for stack, samples in self.stacks.items():
+            functions[stack[-1]] += samples
+        return functions
+
+    def total_samples(self) -> Counter:
+        """The amount of samples each function was on the stack in, counted once per sample for recursive calls"""
+        functions = Counter()
+        for stack, samples in self.stacks.items():
+            for function in set(stack):
+                functions[function] += samples
+        return functions
+
+    def lag_quantile(self, q: float) -> float:
+        return float(np.quantile(self.lags, q)) if self.lags else 0.0
+
+    def report(self, top: int = 50) -> str:
+        """The full text report: the event loop lag, the hottest functions and every sampled stack"""
+        busy = self.samples - self.idle_samples()
+        total = self.total_samples()
+        lines = [f"Duration: {self.duration:.1f}s, {self.samples} samples, {busy} busy",
+                 f"Event loop lag (ms): p50 {self.lag_quantile(0.5) * 1000:.1f}, p95 {self.lag_quantile(0.95) * 1000:.1f}, "
+                 f"p99 {self.lag_quantile(0.99) * 1000:.1f}, max {max(self.lags, default=0) * 1000:.1f}",
+                 "", f"{'self':>8} {'total':>8}  function"]
+        for function, samples in self.self_samples().most_common(top):
+            lines.append(f"{samples:>8} {total[function]:>8}  {function}")
+        lines += ["", "Folded stacks:", self.folded()]
+        return "\n".join(lines) + "\n"
+
+    def folded(self) -> str:
+        """The stacks in the folded format read by flamegraph.pl and speedscope, one `frame;frame;... samples` per line"""
+        return "\n".join(f"{';'.join(stack)} {samples}" for stack, samples in self.stacks.most_common())
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)  # Python 3.11+
+    return f"{name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL, lag_interval: float = PROFILE_LAG_INTERVAL):
+        """Samples the stack of the event loop thread and measures the event loop lag for a limited time.
+
+        A daemon thread reads the current frame of the event loop thread every `interval` seconds, so the profiled
+        code runs unchanged and no tracing hooks are installed. Meanwhile a coroutine sleeps for `lag_interval`
+        seconds in a loop and records how late it wakes up, which is how long other callbacks held the loop.
+        Nothing runs outside of a profiling window.
+
+        Args:
+            interval (float): Seconds between stack samples.
+            lag_interval (float): Seconds between event loop lag measurements.
+        """
+        self.interval = interval
+        self.lag_interval = lag_interval
+        self._running = False
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def _sample(self, thread_id: int, result: ProfileResult, stop: threading.Event) -> None:
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            result.stacks[tuple(reversed(stack))] += 1
+            result.samples += 1
+
+    async def _measure_lag(self, result: ProfileResult, stop: threading.Event) -> None:
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            result.lags.append(max(loop.time() - expected, 0))
+
+    async def profile(self, duration: float) -> ProfileResult:
+        """Profile the running event loop for `duration` seconds, only one window can run at a time"""
+        if self._running:
+            raise RuntimeError("A profile is already running")
+        self._running = True
+
+        result = ProfileResult(duration)
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample, args=(threading.get_ident(), result, stop),
+                                   name="profiler", daemon=True)
+        lag = asyncio.create_task(self._measure_lag(result, stop))
+        start = perf_counter()
+        sampler.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            lag.cancel()
+            result.duration = perf_counter() - start
+            self._running = False
+        return result
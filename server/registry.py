@@ -0,0 +1,186 @@
+import mmap
+import struct
+import sys
+from array import array
+from enum import IntEnum
+from os import replace, fsync
+from os.path import exists, getsize
+from typing import Iterator, Optional
+
+
+class SensorStatus(IntEnum):
+    """The status of a sensor as stored in the registry, NONE marks a free slot"""
+    NONE = -1
+    CLOSED = 0
+    OPEN = 1
+
+
+# Snapshot layout: header, status column (int8), last seen column (int64), the location names, then the names of the
+# armed groups (version 2, a version 1 snapshot only has the armed flag of the default group)
+SNAPSHOT_MAGIC = b"RRSR"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<4sHBI")  # magic, version, armed flag of the default group, amount of slots
+DEFAULT_GROUP = "default"
+
+
+class SensorRegistry:
+    def __init__(self):
+        """
+        Compact store of the status and last message time of each connected sensor.
+
+        Locations are interned and mapped to a slot id, and the status and last seen time of every slot live in
+        two typed arrays instead of a dict per sensor. Slots of disconnected sensors are reused.
+        """
+        self.armed_groups = set()  # The names of the groups that are armed
+        self._ids = {}  # {location: slot id}
+        self._names = []  # [location or None, ...] indexed by slot id
+        self._status = array('b')  # SensorStatus of each slot
+        self._last_seen = array('q')  # Unix timestamp of the last message of each slot
+        self._free = []  # Slot ids that can be reused
+        self.dirty = False  # Whether the registry changed since the last snapshot
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, location: str) -> bool:
+        return location in self._ids
+
+    def is_armed(self, group: str = DEFAULT_GROUP) -> bool:
+        return group in self.armed_groups
+
+    def set_armed(self, group: str, armed: bool) -> None:
+        if armed:
+            self.armed_groups.add(group)
+        else:
+            self.armed_groups.discard(group)
+        self.dirty = True
+
+    def record(self, location: str, status: SensorStatus, timestamp: int) -> Optional[SensorStatus]:
+        """Store a reading, returns the previous status or None if the sensor was not connected"""
+        self.dirty = True
+        slot = self._ids.get(location)
+        if slot is None:
+            location = sys.intern(location)
+            if self._free:
+                slot = self._free.pop()
+                self._names[slot] = location
+                self._status[slot] = status
+                self._last_seen[slot] = timestamp
+            else:
+                slot = len(self._names)
+                self._names.append(location)
+                self._status.append(status)
+                self._last_seen.append(timestamp)
+            self._ids[location] = slot
+            return None
+
+        previous = SensorStatus(self._status[slot])
+        self._status[slot] = status
+        if timestamp > self._last_seen[slot]:
+            self._last_seen[slot] = timestamp
+        return previous
+
+    def get(self, location: str) -> Optional[tuple[SensorStatus, int]]:
+        """Get (status, last seen) of a sensor, or None if it is not connected"""
+        slot = self._ids.get(location)
+        if slot is None:
+            return None
+        return SensorStatus(self._status[slot]), self._last_seen[slot]
+
+    def remove(self, location: str, older_than: float = None) -> bool:
+        """Remove a sensor, only if it was last seen at or before `older_than` when given"""
+        slot = self._ids.get(location)
+        if slot is None or (older_than is not None and self._last_seen[slot] > older_than):
+            return False
+        del self._ids[location]
+        self._names[slot] = None
+        self._status[slot] = SensorStatus.NONE
+        self._free.append(slot)
+        self.dirty = True
+        return True
+
+    def items(self) -> Iterator[tuple[str, SensorStatus, int]]:
+        """Iterate (location, status, last seen) of the connected sensors"""
+        for location, slot in self._ids.items():
+            yield location, SensorStatus(self._status[slot]), self._last_seen[slot]
+
+    # ------------------ SNAPSHOTS ------------------ #
+
+    def to_bytes(self) -> bytes:
+        """Serialize the registry to the binary snapshot layout"""
+        names = b"".join(struct.pack("<H", len(encoded)) + encoded
+                         for encoded in ((name or "").encode("utf8") for name in self._names))
+        groups = [group.encode("utf8") for group in self.armed_groups if group != DEFAULT_GROUP]
+        armed = struct.pack("<H", len(groups)) + b"".join(struct.pack("<H", len(group)) + group for group in groups)
+        return (SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.is_armed(), len(self._names))
+                + self._status.tobytes() + self._last_seen.tobytes() + names + armed)
+
+    def save(self, path: str, data: bytes = None) -> None:
+        """Atomically write a snapshot, `data` can be taken with to_bytes beforehand to write it from another thread"""
+        data = self.to_bytes() if data is None else data
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            fsync(f.fileno())
+        replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SensorRegistry":
+        """Memory-map a snapshot and load the columns from it, returns an empty registry if there is no valid snapshot"""
+        if not exists(path) or getsize(path) < SNAPSHOT_HEADER.size:
+            return cls()
+
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return cls._from_snapshot(mm)
+        except (struct.error, ValueError, UnicodeDecodeError) as err:
+            # A truncated or corrupt snapshot only costs the sensors reconnecting, it must not stop the server
+            print(f"Ignoring the corrupt sensor snapshot {path}: {err}", file=sys.stderr)
+            return cls()
+
+    @classmethod
+    def _from_snapshot(cls, mm: mmap.mmap) -> "SensorRegistry":
+        """Load a registry from a mapped snapshot, raises ValueError or struct.error when it is truncated or corrupt"""
+        registry = cls()
+        magic, version, armed, count = SNAPSHOT_HEADER.unpack_from(mm, 0)
+        if magic != SNAPSHOT_MAGIC or version not in (1, SNAPSHOT_VERSION):
+            return registry
+
+        def take(offset: int, length: int) -> bytes:
+            if offset + length > len(mm):
+                raise ValueError(f"record at {offset} runs past the end of the snapshot ({len(mm)} bytes)")
+            return mm[offset:offset + length]
+
+        offset = SNAPSHOT_HEADER.size
+        registry._status.frombytes(take(offset, count))
+        offset += count
+        registry._last_seen.frombytes(take(offset, count * 8))
+        offset += count * 8
+
+        for slot in range(count):
+            (length,) = struct.unpack_from("<H", mm, offset)
+            offset += 2
+            name = take(offset, length).decode("utf8")
+            offset += length
+
+            if registry._status[slot] == SensorStatus.NONE:
+                registry._names.append(None)
+                registry._free.append(slot)
+            else:
+                name = sys.intern(name)
+                registry._names.append(name)
+                registry._ids[name] = slot
+
+        if armed:
+            registry.armed_groups.add(DEFAULT_GROUP)
+        if version >= 2:
+            (count,) = struct.unpack_from("<H", mm, offset)
+            offset += 2
+            for _ in range(count):
+                (length,) = struct.unpack_from("<H", mm, offset)
+                offset += 2
+                registry.armed_groups.add(take(offset, length).decode("utf8"))
+                offset += length
+
+        return registry
@@ -0,0 +1,382 @@
+import argparse
+import asyncio
+import csv
+import heapq
+import logging
+import operator
+import random
+import re
+from dataclasses import dataclass, field
+from os import environ
+from time import perf_counter
+from typing import Iterable, Iterator
+
+from .clock import VirtualClock, set_clock
+from .coalescer import AlertCoalescer
+from .config import SENSOR_DISCONNECT_TIME, ALERT_COALESCE_WINDOW, ALERT_FLAP_CHANGES, DEDUP_CACHE_SIZE
+from .dedup import DedupCache
+from .monitor import DisconnectMonitor
+from .state import MemoryStateStore
+from .util import handle_env
+
+SYNTHETIC_START = 1700000000  # Synthetic traces start at a fixed time so runs with the same seed are identical
+DEFAULT_HEARTBEAT = 10  # Seconds between the readings replayed for a sensor between its recorded changes
+
+_OPERATORS = {"=": operator.eq, "<=": operator.le, ">=": operator.ge, "<": operator.lt, ">": operator.gt}
+
+
+@dataclass
+class ReplayResult:
+    """What the state machine did with a replayed trace, every list is in the order it happened"""
+    readings: int = 0
+    alerts: list = field(default_factory=list)  # [(timestamp, location, sensor_status)] alerted right away
+    digests: list = field(default_factory=list)  # [(timestamp, location, held back changes, flapping)]
+    connects: list = field(default_factory=list)  # [(timestamp, location)]
+    disconnects: list = field(default_factory=list)  # [(timestamp, location)]
+    messages: int = 0  # Telegram messages that would have been sent, one per recipient
+    events: int = 0  # Events that would have been written to MongoDB
+    simulated: float = 0  # Seconds of traffic that were replayed
+    elapsed: float = 0  # Seconds the replay took
+
+    def counts(self) -> dict:
+        """The totals that expectations can be checked against"""
+        return {"readings": self.readings, "events": self.events, "alerts": len(self.alerts),
+                "digests": len(self.digests), "flapping": sum(1 for digest in self.digests if digest[3]),
+                "connects": len(self.connects), "disconnects": len(self.disconnects), "messages": self.messages}
+
+    def check(self, expectations: Iterable[str]) -> list[str]:
+        """
+        Check expectations like "alerts=12", "disconnects<=3" or "flapping>0" against the counts.
+
+        :return list[str]: The expectations that failed, with the actual count
+        """
+        counts = self.counts()
+        failures = []
+        for expectation in expectations:
+            match = re.fullmatch(r"\s*(\w+)\s*(<=|>=|=|<|>)\s*(\d+)\s*", expectation)
+            if match is None or match[1] not in counts:
+                raise ValueError(f"Invalid expectation: {expectation} (e.g. alerts=12, one of {', '.join(counts)})")
+            name, op, expected = match[1], match[2], int(match[3])
+            if not _OPERATORS[op](counts[name], expected):
+                failures.append(f"{expectation.strip()} (was {counts[name]})")
+        return failures
+
+    def summary(self) -> str:
+        speedup = self.simulated / self.elapsed if self.elapsed else 0
+        lines = [f"Replayed {self.readings} readings over {self.simulated / 3600:.1f}h in {self.elapsed:.2f}s "
+                 f"({speedup:,.0f}x real time)"]
+        lines += [f"  {name}: {count}" for name, count in self.counts().items() if name != "readings"]
+        return "\n".join(lines)
+
+
+class ReplayDispatcher:
+    """Stands in for the AlertDispatcher, counts the messages instead of sending them"""
+    def __init__(self, result: ReplayResult):
+        self.result = result
+
+    def broadcast(self, chat_ids: list, text: str, **kwargs) -> None:
+        self.result.messages += len(chat_ids)
+
+    def pending(self) -> int:
+        return 0
+
+    async def drain(self) -> None:
+        pass
+
+
+class ReplayEventQueue:
+    """Stands in for the EventWriter, counts the events instead of writing them"""
+    def __init__(self, result: ReplayResult):
+        self.result = result
+
+    def put(self, event) -> None:
+        self.result.events += 1
+
+    def put_many(self, events: list) -> None:
+        self.result.events += len(events)
+
+    def qsize(self) -> int:
+        return 0
+
+
+class RecordingCoalescer(AlertCoalescer):
+    def __init__(self, window: float, flap_changes: int, result: ReplayResult):
+        """AlertCoalescer that records which changes were alerted right away"""
+        super().__init__(window, flap_changes, on_flush=None)
+        self.result = result
+
+    def add(self, events: list, now: float) -> list:
+        immediate = super().add(events, now)
+        self.result.alerts += [(now, event.location, event.sensor_status) for event in immediate]
+        return immediate
+
+
+class ReplayEngine:
+    def __init__(self, disconnect_time: float = SENSOR_DISCONNECT_TIME, coalesce_window: float = ALERT_COALESCE_WINDOW,
+                 flap_changes: int = ALERT_FLAP_CHANGES, armed: bool = True):
+        """Replays sensor readings through the real alarm state machine on a virtual clock.
+
+        While the engine is entered (`with ReplayEngine() as engine`), the state, disconnect monitor, coalescer and
+        dedup cache of server.telegram are replaced by fresh ones, Telegram and MongoDB by stubs that only count,
+        and the virtual clock is installed. Instead of sleeping, the engine moves the clock to the next reading and
+        first runs every disconnect deadline and coalescing window that runs out before it, in order.
+
+        Args:
+            disconnect_time (float): Seconds without a message before a sensor is disconnected.
+            coalesce_window (float): Seconds further changes of a sensor are held back after an alert.
+            flap_changes (int): The amount of changes within one window that mark a sensor as flapping.
+            armed (bool): Whether every group starts armed, readings with a system_status change it.
+        """
+        self.disconnect_time = disconnect_time
+        self.coalesce_window = coalesce_window
+        self.flap_changes = flap_changes
+        self.armed = armed
+        self.clock = VirtualClock()
+        self.result = None
+        self.telegram = None
+        self._saved = {}
+        self._saved_clock = None
+        self._log_levels = {}
+
+    def __enter__(self) -> "ReplayEngine":
+        # Imported here, so the module can be imported without the bot environment variables
+        from . import telegram
+        self.telegram = telegram
+        self.result = result = ReplayResult()
+
+        async def device_connected(device_id: str):
+            result.connects.append((self.clock.time(), device_id))
+            await self._saved["device_connected"](device_id)
+
+        async def device_disconnected(device_id: str):
+            result.disconnects.append((self.clock.time(), device_id))
+            await self._saved["device_disconnected"](device_id)
+
+        async def send_digest(digests: list):
+            # Only the digests of armed groups are sent
+            result.digests += [(self.clock.time(), digest.location, len(digest.events), digest.flapping)
+                               for digest in telegram.armed_digests(digests)]
+            await self._saved["send_digest"](digests)
+
+        replacements = {
+            "State": MemoryStateStore(),
+            "Monitor": DisconnectMonitor(self.disconnect_time, on_disconnect=telegram.on_sensor_timeout),
+            "Coalescer": RecordingCoalescer(self.coalesce_window, self.flap_changes, result),
+            "SeenReadings": DedupCache(DEDUP_CACHE_SIZE),
+            "Dispatcher": ReplayDispatcher(result),
+            "EventQueue": ReplayEventQueue(result),
+            "device_connected": device_connected,
+            "device_disconnected": device_disconnected,
+            "send_digest": send_digest,
+        }
+        self._saved = {name: getattr(telegram, name) for name in replacements}
+        for name, value in replacements.items():
+            setattr(telegram, name, value)
+        if self.armed:
+            for group in telegram.Subscriptions.groups:
+                telegram.State.set_system_status("Armed", group)
+
+        # Keep the log file and the Telegram log chat free of the replayed disconnects
+        for name in ("TeleBot", "telegram"):
+            self._log_levels[name] = logging.getLogger(name).level
+            logging.getLogger(name).setLevel(logging.ERROR if name == "TeleBot" else logging.CRITICAL + 1)
+
+        self._saved_clock = set_clock(self.clock)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        set_clock(self._saved_clock)
+        for name, value in self._saved.items():
+            setattr(self.telegram, name, value)
+        for name, level in self._log_levels.items():
+            logging.getLogger(name).setLevel(level)
+
+    async def _advance(self, timestamp: float) -> None:
+        """Run the disconnect deadlines and coalescing windows that run out up to `timestamp`, in time order"""
+        telegram = self.telegram
+        while True:
+            deadlines = [deadline for deadline in (telegram.Monitor.next_deadline(), telegram.Coalescer.next_deadline())
+                         if deadline is not None]
+            if not deadlines or min(deadlines) > timestamp:
+                return
+            now = min(deadlines)
+            self.clock.set(now)
+            for location in telegram.Monitor.pop_expired(now):
+                await telegram.on_sensor_timeout(location)
+            digests = telegram.Coalescer.flush_due(now)
+            if digests:
+                await telegram.send_digest(digests)
+
+    async def run(self, readings: Iterable[dict]) -> ReplayResult:
+        """
+        Replay readings in timestamp order, like {"timestamp": 1700713374, "location": "Bedroom Door",
+        "sensor_status": "OPEN"} with an optional "system_status" ("Armed" or "Disarmed") of the sensor's group.
+
+        The changes still held back at the end are flushed, the sensors are not disconnected at the end of the trace.
+        """
+        telegram = self.telegram
+        result = self.result
+        start = perf_counter()
+        first = last = None
+        for reading in readings:
+            timestamp = reading["timestamp"]
+            if first is None:
+                first = timestamp
+                self.clock.set(timestamp)
+            await self._advance(timestamp)
+            self.clock.set(timestamp)
+            last = timestamp
+
+            system_status = reading.pop("system_status", None)
+            if system_status is not None:
+                group = telegram.Subscriptions.group_of(reading["location"])
+                if telegram.State.get_system_status(group) != system_status:
+                    telegram.State.set_system_status(system_status, group)
+
+            reading.setdefault("action", "sensor_event")
+            await telegram.handle_events([reading])
+            result.readings += 1
+
+        digests = telegram.Coalescer.flush_all()
+        if digests:
+            await telegram.send_digest(digests)
+
+        result.simulated = (last - first) if first is not None else 0
+        result.elapsed = perf_counter() - start
+        return result
+
+
+# ------------------ TRACES ------------------ #
+
+def _reading(location: str, timestamp: int, sensor_status: str) -> dict:
+    return {"action": "sensor_event", "timestamp": timestamp, "location": location, "sensor_status": sensor_status}
+
+
+def _with_heartbeats(rows: list[dict], heartbeat: int) -> Iterator[dict]:
+    """Yield the recorded changes of one sensor, with a reading of the unchanged status every `heartbeat` seconds between them"""
+    for row, next_row in zip(rows, rows[1:] + [None]):
+        yield row
+        if heartbeat <= 0 or next_row is None:
+            continue
+        for timestamp in range(row["timestamp"] + heartbeat, next_row["timestamp"], heartbeat):
+            yield _reading(row["location"], timestamp, row["sensor_status"])
+
+
+def load_trace(path: str, heartbeat: int = DEFAULT_HEARTBEAT) -> Iterator[dict]:
+    """
+    Load recorded events from a CSV file with timestamp, location and sensor_status columns (and optionally
+    system_status), like testing/sensor_data.csv or an export, and yield them as readings in timestamp order.
+
+    The stored events only contain the changes, so the heartbeats the sensor sent in between are filled in every
+    `heartbeat` seconds (0 replays only the changes, which disconnects a sensor after every quiet period).
+    """
+    sensors = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            reading = _reading(row["location"], int(float(row["timestamp"])), row["sensor_status"].upper())
+            if row.get("system_status"):
+                reading["system_status"] = row["system_status"].capitalize()
+            sensors.setdefault(reading["location"], []).append(reading)
+
+    for rows in sensors.values():
+        rows.sort(key=lambda reading: reading["timestamp"])
+    return heapq.merge(*(_with_heartbeats(rows, heartbeat) for rows in sensors.values()),
+                       key=lambda reading: reading["timestamp"])
+
+
+def _synthetic_sensor(location: str, start: int, end: int, heartbeat: int, change_interval: float,
+                      flap_probability: float, dropout_interval: float, rng: random.Random) -> Iterator[dict]:
+    status = "CLOSED"
+    timestamp = start + rng.uniform(0, heartbeat)
+    next_change = timestamp + rng.expovariate(1 / change_interval)
+    next_dropout = timestamp + rng.expovariate(1 / dropout_interval) if dropout_interval else float("inf")
+    while timestamp < end:
+        if timestamp >= next_dropout:
+            # The sensor goes quiet for a few minutes, e.g. a WiFi outage
+            timestamp += rng.uniform(120, 600)
+            next_dropout = timestamp + rng.expovariate(1 / dropout_interval)
+        elif timestamp >= next_change:
+            # A change, or a burst of changes a few seconds apart from a flapping sensor
+            for _ in range(rng.randint(4, 8) if rng.random() < flap_probability else 1):
+                status = "OPEN" if status == "CLOSED" else "CLOSED"
+                yield _reading(location, int(timestamp), status)
+                timestamp += rng.uniform(1, 3)
+            next_change = timestamp + rng.expovariate(1 / change_interval)
+        else:
+            yield _reading(location, int(timestamp), status)
+            timestamp += heartbeat
+
+
+def synthetic_trace(sensors: int = 5, days: float = 1, heartbeat: int = DEFAULT_HEARTBEAT, seed: int = 0,
+                    change_interval: float = 1800, flap_probability: float = 0.05, dropout_interval: float = 43200,
+                    start: int = SYNTHETIC_START) -> Iterator[dict]:
+    """
+    Generate the readings of sensors that send a heartbeat every `heartbeat` seconds, change state on average
+    every `change_interval` seconds (in a flapping burst with `flap_probability`) and drop out for a few minutes
+    on average every `dropout_interval` seconds (0 for never), in timestamp order.
+    """
+    rng = random.Random(seed)
+    end = start + days * 86400
+    return heapq.merge(*(_synthetic_sensor(f"Sensor {i + 1}", start, end, heartbeat, change_interval, flap_probability,
+                                           dropout_interval, random.Random(rng.random()))
+                         for i in range(sensors)),
+                       key=lambda reading: reading["timestamp"])
+
+
+def main(argv: list[str]) -> int:
+    """Command line entry point: python -m server replay [trace.csv] [options]"""
+    parser = argparse.ArgumentParser(prog="python -m server replay",
+                                     description="Replay recorded or synthetic sensor traffic through the alarm state "
+                                                 "machine on a virtual clock, with Telegram and MongoDB stubbed")
+    parser.add_argument("trace", nargs="?", help="A CSV file of recorded events, a synthetic trace is generated if omitted")
+    parser.add_argument("--heartbeat", type=int, default=DEFAULT_HEARTBEAT,
+                        help=f"Seconds between the readings of a sensor (default: {DEFAULT_HEARTBEAT})")
+    parser.add_argument("--sensors", type=int, default=5, help="The amount of synthetic sensors (default: 5)")
+    parser.add_argument("--days", type=float, default=1, help="The length of the synthetic trace in days (default: 1)")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the synthetic trace (default: 0)")
+    parser.add_argument("--disconnect-time", type=float, default=SENSOR_DISCONNECT_TIME,
+                        help=f"Seconds without a message before a sensor is disconnected (default: {SENSOR_DISCONNECT_TIME})")
+    parser.add_argument("--coalesce-window", type=float, default=ALERT_COALESCE_WINDOW,
+                        help=f"Seconds changes are held back after an alert (default: {ALERT_COALESCE_WINDOW})")
+    parser.add_argument("--flap-changes", type=int, default=ALERT_FLAP_CHANGES,
+                        help=f"Changes within a window that mark a sensor as flapping (default: {ALERT_FLAP_CHANGES})")
+    parser.add_argument("--disarmed", action="store_true", help="Start with every group disarmed")
+    parser.add_argument("--expect", action="append", default=[], metavar="COUNT=N",
+                        help="Fail unless a count matches, e.g. --expect alerts=12 --expect 'disconnects<=3'")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print every alert, digest and disconnect")
+    args = parser.parse_args(argv)
+
+    try:
+        handle_env()
+    except ValueError:
+        # The bot and MongoDB are stubbed, but server.telegram reads their settings on import
+        environ.setdefault("TG_BOT_TOKEN", "0:replay")
+        environ.setdefault("TG_USERS", "0")
+        environ.setdefault("MONGODB_CONNECTION_STRING", "mongodb://localhost")
+
+    if args.trace:
+        readings = load_trace(args.trace, args.heartbeat)
+    else:
+        readings = synthetic_trace(args.sensors, args.days, args.heartbeat, args.seed)
+
+    with ReplayEngine(args.disconnect_time, args.coalesce_window, args.flap_changes, armed=not args.disarmed) as engine:
+        result = asyncio.run(engine.run(readings))
+
+    if args.verbose:
+        timeline = ([(t, f"alert       {location} {status}") for t, location, status in result.alerts]
+                    + [(t, f"digest      {location} +{held}{' flapping' if flapping else ''}")
+                       for t, location, held, flapping in result.digests]
+                    + [(t, f"connect     {location}") for t, location in result.connects]
+                    + [(t, f"disconnect  {location}") for t, location in result.disconnects])
+        for t, line in sorted(timeline, key=lambda item: item[0]):
+            print(f"{t:.0f}  {line}")
+    print(result.summary())
+
+    try:
+        failures = result.check(args.expect)
+    except ValueError as err:
+        print(err)
+        return 2
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    return 1 if failures else 0
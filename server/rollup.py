@@ -0,0 +1,202 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+import pytz
+from pymongo import ASCENDING, ReplaceOne
+
+from .config import ALERT_TIMEZONE, FLAP_WINDOW, ROLLUP_DELAY
+from .mongo import EventsMongoDB
+
+HOUR = 3600
+DAY = 86400
+
+# The rollup_state document of the events collection
+STATE_ID = "events"
+
+
+def floor_time(timestamp: int, size: int) -> int:
+    """Round a timestamp down to the start of its (UTC) hour or day"""
+    return timestamp - timestamp % size
+
+
+def _new_bucket(location: str, start: int, size: int) -> dict:
+    return {"location": location, "start": start, "size": size,
+            "date": datetime.fromtimestamp(start, tz=timezone.utc),
+            "events": 0, "opens": 0, "closes": 0, "open_seconds": 0, "flaps": 0,
+            "first_timestamp": None, "last_timestamp": None}
+
+
+def rollup_hours(mongo: EventsMongoDB, start: int, end: int, sensors: dict,
+                 flap_window: int = FLAP_WINDOW) -> list[dict]:
+    """
+    Compute the hourly buckets of every location between two hour boundaries from the raw events.
+
+    The events are streamed in timestamp order. The time a sensor is open is split over the hours it spans, and
+    a change counts as a flap in the hour it happened if the next change of the sensor reverses it within the
+    flap window, which may be after `end`, so the events up to `end + flap_window` are read.
+
+    :param mongo (EventsMongoDB): The connector to read the events from.
+    :param start (int): The start of the first hour.
+    :param end (int): The end of the last hour.
+    :param sensors (dict): {location: (sensor_status, since)} at `start`, updated in place to the states at `end`.
+    :param flap_window (int): The amount of seconds a change has to be reversed within to count as a flap.
+
+    :return list[dict]: The hourly bucket documents, only for the hours a sensor had events or was open
+    """
+    tz = pytz.timezone(ALERT_TIMEZONE)
+    buckets = {}  # {(location, start): bucket}
+
+    def bucket(location: str, timestamp: int) -> dict:
+        key = (location, floor_time(timestamp, HOUR))
+        if key not in buckets:
+            buckets[key] = _new_bucket(location, key[1], HOUR)
+            buckets[key]["hour"] = datetime.fromtimestamp(key[1], tz).hour
+        return buckets[key]
+
+    def add_open(location: str, since: int, until: int) -> None:
+        timestamp = max(since, start)
+        while timestamp < until:
+            hour_end = min(floor_time(timestamp, HOUR) + HOUR, until)
+            bucket(location, timestamp)["open_seconds"] += hour_end - timestamp
+            timestamp = hour_end
+
+    last_events = {}  # {location: (timestamp, sensor_status)} of the last event before `end` that may still flap
+    projection = {"_id": 0, "timestamp": 1, "location": 1, "sensor_status": 1}
+    for event in mongo.iter_events(start, end + flap_window, projection=projection):
+        location, timestamp, status = event["location"], event["timestamp"], event["sensor_status"]
+
+        last_event = last_events.get(location)
+        if last_event is not None and last_event[1] != status and timestamp - last_event[0] <= flap_window:
+            bucket(location, last_event[0])["flaps"] += 1
+
+        if timestamp >= end:
+            # Only needed to find the flaps of the last events before the end
+            last_events[location] = None
+            continue
+
+        state = sensors.get(location)
+        if state is not None and state[0] == "OPEN":
+            add_open(location, state[1], timestamp)
+
+        hour = bucket(location, timestamp)
+        hour["events"] += 1
+        hour["opens" if status == "OPEN" else "closes"] += 1
+        if hour["first_timestamp"] is None:
+            hour["first_timestamp"] = timestamp
+        hour["last_timestamp"] = timestamp
+
+        sensors[location] = (status, timestamp)
+        last_events[location] = (timestamp, status)
+
+    for location, (status, since) in sensors.items():
+        if status == "OPEN":
+            add_open(location, since, end)
+
+    return list(buckets.values())
+
+
+def rollup_days(mongo: EventsMongoDB, start: int, end: int) -> list[dict]:
+    """Compute the daily buckets of the days between `start` and `end` by adding up their stored hourly buckets"""
+    days = {}  # {(location, start): bucket}
+    query = {"start": {"$gte": floor_time(start, DAY), "$lt": floor_time(end - 1, DAY) + DAY}}
+    for hour in mongo.hourly.find(query, projection={"_id": 0}):
+        key = (hour["location"], floor_time(hour["start"], DAY))
+        if key not in days:
+            days[key] = _new_bucket(key[0], key[1], DAY)
+            days[key]["hours"] = [0] * 24  # Events by local hour of the day
+        day = days[key]
+        for field in ("events", "opens", "closes", "open_seconds", "flaps"):
+            day[field] += hour[field]
+        day["hours"][hour["hour"]] += hour["events"]
+        if hour["first_timestamp"] is not None:
+            if day["first_timestamp"] is None or hour["first_timestamp"] < day["first_timestamp"]:
+                day["first_timestamp"] = hour["first_timestamp"]
+            if day["last_timestamp"] is None or hour["last_timestamp"] > day["last_timestamp"]:
+                day["last_timestamp"] = hour["last_timestamp"]
+    return list(days.values())
+
+
+def _replace_buckets(collection, buckets: list[dict]) -> None:
+    if buckets:
+        collection.bulk_write([ReplaceOne({"location": bucket["location"], "start": bucket["start"]}, bucket, upsert=True)
+                               for bucket in buckets], ordered=False)
+
+
+def rolled_up_until(mongo: EventsMongoDB) -> Optional[int]:
+    """Get the end of the last hour that is rolled up, None if the rollup job did not run yet"""
+    state = mongo.rollup_state.find_one({"_id": STATE_ID}, projection={"until": 1})
+    return state["until"] if state is not None else None
+
+
+def rollup_events(mongo: EventsMongoDB, now: float, delay: int = ROLLUP_DELAY) -> int:
+    """
+    Roll up the raw events of the hours that ended at least `delay` seconds ago into the hourly and daily buckets.
+
+    The job continues where the previous run stopped and handles a day at a time, storing how far it got and the
+    state of every sensor at that point in the rollup_state collection, so the raw events only have to be read
+    once and can expire afterwards. The buckets of a day are replaced as a whole, so an interrupted run is simply
+    repeated. Events that are stored after their hour was rolled up (e.g. spooled during a long MongoDB outage)
+    are only counted in the raw events.
+
+    :return int: The amount of hours that were rolled up
+    """
+    until = floor_time(int(now) - delay, HOUR)
+
+    state = mongo.rollup_state.find_one({"_id": STATE_ID})
+    if state is not None:
+        start = state["until"]
+        sensors = {sensor["location"]: (sensor["sensor_status"], sensor["since"]) for sensor in state["sensors"]}
+    else:
+        first = mongo.events.find_one({}, projection={"timestamp": 1}, sort=[("timestamp", ASCENDING)])
+        if first is None:
+            return 0
+        start = floor_time(first["timestamp"], HOUR)
+        sensors = {}
+
+    hours = 0
+    while start < until:
+        end = min(floor_time(start, DAY) + DAY, until)
+        _replace_buckets(mongo.hourly, rollup_hours(mongo, start, end, sensors))
+        _replace_buckets(mongo.daily, rollup_days(mongo, start, end))
+
+        mongo.rollup_state.replace_one({"_id": STATE_ID}, {
+            "until": end,
+            "sensors": [{"location": location, "sensor_status": status, "since": since}
+                        for location, (status, since) in sensors.items()],
+        }, upsert=True)
+        hours += (end - start) // HOUR
+        start = end
+    return hours
+
+
+def iter_buckets(mongo: EventsMongoDB, start: int, end: int, location: str = None):
+    """
+    Stream the rollup buckets that cover the hours from `start` to `end`, both rounded down to the hour.
+
+    Whole days are read from the daily buckets and the hours before and after them from the hourly buckets, so a
+    year is read as about 365 documents per location. Only hours that are rolled up are covered.
+
+    :return tuple[Iterator[dict], int]: The buckets, and the end of the covered hours (`start` if none are covered)
+    """
+    start = floor_time(start, HOUR)
+    until = rolled_up_until(mongo)
+    stop = min(floor_time(end, HOUR), until if until is not None else start)
+    if stop <= start:
+        return iter(()), start
+
+    first_day, last_day = -(-start // DAY) * DAY, floor_time(stop, DAY)
+    if first_day < last_day:
+        ranges = [(mongo.hourly, start, first_day), (mongo.daily, first_day, last_day), (mongo.hourly, last_day, stop)]
+    else:
+        ranges = [(mongo.hourly, start, stop)]
+
+    def buckets():
+        for collection, range_start, range_end in ranges:
+            if range_start >= range_end:
+                continue
+            query = {"start": {"$gte": range_start, "$lt": range_end}}
+            if location is not None:
+                query["location"] = location
+            yield from collection.find(query, projection={"_id": 0})
+
+    return buckets(), stop
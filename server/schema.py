@@ -0,0 +1,202 @@
+import json
+from typing import Any, Callable, Optional
+
+from .config import SENSOR_BATCH_MAX_READINGS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def decode_json(body: bytes) -> Any:
+    """Decode a JSON request body, with orjson when it is installed. Raises ValueError for malformed JSON"""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+# A validator returns None for a valid value, or a message describing the first error
+Validator = Callable[[Any], Optional[str]]
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+}
+
+
+def compile_schema(schema: dict, path: str = "payload") -> Validator:
+    """
+    Compile a small subset of JSON Schema into a single validator function, so the schema is only walked once
+    at import time instead of on every request.
+
+    Supported keywords: type, enum, minLength, maxLength, minimum, maxItems, items, properties and required.
+    """
+    checks = []
+
+    if "type" in schema:
+        expected, type_name = _TYPES[schema["type"]], schema["type"]
+        # bool is a subclass of int, but true/false are not valid integers or numbers
+        exclude_bool = type_name in ("integer", "number")
+
+        def check_type(value):
+            if not isinstance(value, expected) or (exclude_bool and isinstance(value, bool)):
+                return f"{path} must be of type {type_name}"
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = frozenset(schema["enum"])
+
+        def check_enum(value):
+            if value not in allowed:
+                return f"{path} must be one of {', '.join(map(str, schema['enum']))}"
+        checks.append(check_enum)
+
+    if "minLength" in schema or "maxLength" in schema:
+        min_length, max_length = schema.get("minLength", 0), schema.get("maxLength", float("inf"))
+
+        def check_length(value):
+            if not min_length <= len(value) <= max_length:
+                return f"{path} must be between {min_length} and {max_length} characters"
+        checks.append(check_length)
+
+    if "minimum" in schema:
+        minimum = schema["minimum"]
+
+        def check_minimum(value):
+            if value < minimum:
+                return f"{path} must be at least {minimum}"
+        checks.append(check_minimum)
+
+    if "maxItems" in schema:
+        max_items = schema["maxItems"]
+
+        def check_max_items(value):
+            if len(value) > max_items:
+                return f"{path} must contain at most {max_items} items"
+        checks.append(check_max_items)
+
+    if "items" in schema:
+        validate_item = compile_schema(schema["items"], f"{path}[]")
+
+        def check_items(value):
+            for item in value:
+                error = validate_item(item)
+                if error:
+                    return error
+        checks.append(check_items)
+
+    if "required" in schema:
+        required = tuple(schema["required"])
+
+        def check_required(value):
+            for key in required:
+                if key not in value:
+                    return f"{path}.{key} is required"
+        checks.append(check_required)
+
+    if "properties" in schema:
+        properties = tuple((key, compile_schema(subschema, f"{path}.{key}"))
+                           for key, subschema in schema["properties"].items())
+
+        def check_properties(value):
+            for key, validate_property in properties:
+                if key in value:
+                    error = validate_property(value[key])
+                    if error:
+                        return error
+        checks.append(check_properties)
+
+    checks = tuple(checks)
+
+    def validate(value) -> Optional[str]:
+        # The type check comes first, so the following checks can rely on the type of the value
+        for check in checks:
+            error = check(value)
+            if error:
+                return error
+        return None
+
+    return validate
+
+
+# ------------------ SENSOR PAYLOADS ------------------ #
+
+_LOCATION = {"type": "string", "minLength": 1, "maxLength": 64}
+_SENSOR_STATUS = {"enum": ["OPEN", "CLOSED"]}
+_SEQ = {"type": "integer", "minimum": 0}  # Sequence number of the reading, counted by the sensor
+_BOOT = {"type": "integer", "minimum": 0}  # Random id of the sensor chosen at startup, as the sequence starts over
+
+PING_SCHEMA = {
+    "type": "object",
+    "properties": {"action": {"enum": ["ping"]}},
+}
+
+SENSOR_EVENT_SCHEMA = {
+    "type": "object",
+    "required": ["action", "location", "sensor_status"],
+    "properties": {
+        "action": {"enum": ["sensor_event"]},
+        "timestamp": {"type": "integer"},
+        "location": _LOCATION,
+        "sensor_status": _SENSOR_STATUS,
+        "seq": _SEQ,
+        "boot": _BOOT,
+    },
+}
+
+SENSOR_BATCH_SCHEMA = {
+    "type": "object",
+    "required": ["action", "readings"],
+    "properties": {
+        "action": {"enum": ["sensor_batch"]},
+        "location": _LOCATION,
+        "boot": _BOOT,
+        "readings": {
+            "type": "array",
+            "maxItems": SENSOR_BATCH_MAX_READINGS,
+            "items": {
+                "type": "object",
+                "required": ["sensor_status"],
+                "properties": {
+                    "sensor_status": _SENSOR_STATUS,
+                    "age_ms": {"type": "integer", "minimum": 0},
+                    "location": _LOCATION,
+                    "seq": _SEQ,
+                },
+            },
+        },
+    },
+}
+
+# The validator of each sensor action
+SENSOR_VALIDATORS = {
+    "ping": compile_schema(PING_SCHEMA),
+    "sensor_event": compile_schema(SENSOR_EVENT_SCHEMA),
+    "sensor_batch": compile_schema(SENSOR_BATCH_SCHEMA),
+}
+
+# The frames of the sensor WebSocket route, the first frame identifies the sensor and later frames carry its status
+SOCKET_FIRST_FRAME_SCHEMA = {
+    "type": "object",
+    "required": ["location", "sensor_status"],
+    "properties": {
+        "location": _LOCATION,
+        "sensor_status": _SENSOR_STATUS,
+    },
+}
+
+SOCKET_FRAME_SCHEMA = {
+    "type": "object",
+    "required": ["sensor_status"],
+    "properties": {
+        "sensor_status": _SENSOR_STATUS,
+    },
+}
+
+SOCKET_FIRST_FRAME_VALIDATOR = compile_schema(SOCKET_FIRST_FRAME_SCHEMA, "frame")
+SOCKET_FRAME_VALIDATOR = compile_schema(SOCKET_FRAME_SCHEMA, "frame")
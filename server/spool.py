@@ -0,0 +1,121 @@
+import json
+import os
+from os.path import dirname, exists
+
+from .config import EVENT_SPOOL_COMPACT_BYTES
+
+# The amount of bytes read from the spool at once when draining it
+READ_CHUNK = 1024 * 1024
+
+
+class EventSpool:
+    def __init__(self, path: str):
+        """Append-only file of events waiting to be written to MongoDB, one JSON document per line.
+
+        Events are appended and fsynced in batches, and drained from the checkpoint offset stored next to the
+        spool (`<path>.checkpoint`). The checkpoint is only advanced once a batch is stored, so after a crash or
+        an outage the drain resumes with the first event that was not written yet. Once everything is drained
+        and the file has grown past EVENT_SPOOL_COMPACT_BYTES, it is truncated and the offset starts over.
+
+        The methods do blocking file IO and are meant to be called from a worker thread, one call at a time.
+        """
+        self.path = path
+        self.checkpoint_path = path + ".checkpoint"
+        self.size = 0  # The amount of bytes that are written and fsynced
+        self.offset = 0  # The amount of bytes that are drained to MongoDB
+        self.backlog = 0  # The amount of events between the offset and the end of the spool
+        self._fd = None
+
+    def open(self) -> None:
+        """Open the spool, dropping a partially written last line and loading the checkpoint"""
+        os.makedirs(dirname(self.path), exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self._fd).st_size
+
+        # A crash in the middle of a write leaves a line without its newline, it was never acknowledged as synced
+        if self.size:
+            tail = os.pread(self._fd, min(self.size, READ_CHUNK), max(self.size - READ_CHUNK, 0))
+            if not tail.endswith(b"\n"):
+                self.size -= len(tail) - (tail.rfind(b"\n") + 1)
+                os.ftruncate(self._fd, self.size)
+
+        self.offset = 0
+        if exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                self.offset = int(f.read().strip() or 0)
+        # The spool was truncated before the checkpoint could be reset
+        if self.offset > self.size:
+            self.offset = 0
+
+        self.backlog = 0
+        offset = self.offset
+        while offset < self.size:
+            data = os.pread(self._fd, min(self.size - offset, READ_CHUNK), offset)
+            self.backlog += data.count(b"\n")
+            offset += len(data)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def encode(document: dict) -> bytes:
+        """Encode a document as a spool line"""
+        return json.dumps(document, separators=(",", ":")).encode("utf8") + b"\n"
+
+    def append(self, lines: list[bytes]) -> None:
+        """Write encoded lines to the end of the spool with a single write and fsync"""
+        if not lines:
+            return
+        data = b"".join(lines)
+        os.write(self._fd, data)
+        os.fsync(self._fd)
+        self.size += len(data)
+        self.backlog += len(lines)
+
+    @staticmethod
+    def decode(line: bytes) -> dict:
+        """Decode a spool line, raises ValueError if it is not a JSON document"""
+        document = json.loads(line)
+        if not isinstance(document, dict):
+            raise ValueError(f"Expected a JSON object, got {type(document).__name__}")
+        return document
+
+    def read(self, max_lines: int) -> tuple[list[bytes], int]:
+        """Read up to `max_lines` lines from the checkpoint offset, returns them with the offset after them"""
+        # Grow the window until it holds a whole line, so a line longer than READ_CHUNK doesn't stall the drain
+        window = READ_CHUNK
+        while True:
+            data = os.pread(self._fd, min(self.size - self.offset, window), self.offset)
+            if b"\n" in data or self.offset + len(data) >= self.size:
+                break
+            window *= 2
+
+        lines = []
+        start = 0
+        while len(lines) < max_lines:
+            newline = data.find(b"\n", start)
+            if newline == -1:
+                break
+            lines.append(data[start:newline])
+            start = newline + 1
+        return lines, self.offset + start
+
+    def commit(self, offset: int, count: int) -> None:
+        """Advance the checkpoint past `count` lines that were stored or skipped, ending at `offset`"""
+        self.offset = offset
+        self.backlog -= count
+        if self.offset == self.size and self.size >= EVENT_SPOOL_COMPACT_BYTES:
+            # Truncate before resetting the checkpoint, a checkpoint past the end is reset on open
+            os.ftruncate(self._fd, 0)
+            self.size = self.offset = 0
+        self._write_checkpoint()
+
+    def _write_checkpoint(self) -> None:
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(self.offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
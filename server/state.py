@@ -0,0 +1,248 @@
+import asyncio
+import sqlite3
+from os import getenv, getpid
+from os.path import join, dirname, abspath
+from typing import Optional
+
+from .config import STATE_DB_BUSY_TIMEOUT, STATE_DB_LOCK_RETRIES, STATE_DB_RETRY_DELAY
+from .registry import DEFAULT_GROUP, SensorRegistry, SensorStatus
+
+
+class StateStore:
+    """
+    Interface for the alarm state: the system status (armed or disarmed) of each group of sensors (see 
+    subscriptions.py) and the last status and message time of each sensor.
+
+    Every method is atomic, so several webhook workers sharing a store agree on which one saw a sensor
+    connect, change state or disconnect, and only that worker sends the alert.
+    """
+    def get_system_status(self, group: str = DEFAULT_GROUP) -> str:
+        raise NotImplementedError
+
+    def set_system_status(self, status: str, group: str = DEFAULT_GROUP) -> None:
+        raise NotImplementedError
+
+    def record_reading(self, location: str, sensor_status: str, timestamp: int) -> Optional[str]:
+        """
+        Store the latest reading of a sensor.
+
+        Returns the previous status of the sensor, or None if the sensor was not connected.
+        """
+        raise NotImplementedError
+
+    def touch_sensors(self, locations: list[str], timestamp: int) -> None:
+        """
+        Move the last message time of connected sensors forward to `timestamp` without a reading, for sensors whose 
+        liveness is tracked by one worker (e.g. over a WebSocket), so the other workers don't time them out.
+        """
+        raise NotImplementedError
+
+    def get_sensor(self, location: str) -> Optional[dict]:
+        """Get {"last_sensor_status": "OPEN" or "CLOSED", "last_message": int} of a sensor, or None if it is not connected"""
+        raise NotImplementedError
+
+    def remove_sensor(self, location: str, older_than: float = None) -> bool:
+        """
+        Remove a sensor, only if its last message is not newer than `older_than` when given.
+
+        Returns True if the sensor was removed by this call.
+        """
+        raise NotImplementedError
+
+    def sensors(self) -> dict:
+        """Get {location: {"last_sensor_status": "OPEN" or "CLOSED", "last_message": int}} of all connected sensors"""
+        raise NotImplementedError
+
+    def sensor_count(self) -> int:
+        return len(self.sensors())
+    
+    def snapshot(self) -> Optional[bytes]:
+        """
+        Take a snapshot of the state if it changed since the last one, to be written with save_snapshot.
+        Returns None if there is nothing to save (e.g. the store is already persistent).
+        """
+        return None
+    
+    def save_snapshot(self, data: bytes) -> None:
+        """Write a snapshot taken with snapshot, can be called from a worker thread"""
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryStateStore(StateStore):
+    def __init__(self, snapshot_path: str = None):
+        """
+        State kept in the memory of a single process, in a compact SensorRegistry.
+        
+        When `snapshot_path` is given, the registry is loaded from the last snapshot so a restart resumes with the 
+        sensors and arm state from before, instead of announcing every sensor as newly connected.
+        """
+        self.snapshot_path = snapshot_path
+        self.registry = SensorRegistry.load(snapshot_path) if snapshot_path else SensorRegistry()
+
+    def get_system_status(self, group: str = DEFAULT_GROUP) -> str:
+        return "Armed" if self.registry.is_armed(group) else "Disarmed"
+
+    def set_system_status(self, status: str, group: str = DEFAULT_GROUP) -> None:
+        self.registry.set_armed(group, status == "Armed")
+
+    def record_reading(self, location: str, sensor_status: str, timestamp: int) -> Optional[str]:
+        previous = self.registry.record(location, SensorStatus[sensor_status], timestamp)
+        return previous.name if previous is not None else None
+
+    def touch_sensors(self, locations: list[str], timestamp: int) -> None:
+        for location in locations:
+            sensor = self.registry.get(location)
+            if sensor is not None:
+                self.registry.record(location, sensor[0], timestamp)
+
+    def get_sensor(self, location: str) -> Optional[dict]:
+        sensor = self.registry.get(location)
+        if sensor is None:
+            return None
+        return {"last_sensor_status": sensor[0].name, "last_message": sensor[1]}
+
+    def remove_sensor(self, location: str, older_than: float = None) -> bool:
+        return self.registry.remove(location, older_than)
+
+    def sensors(self) -> dict:
+        return {location: {"last_sensor_status": status.name, "last_message": last_seen}
+                for location, status, last_seen in self.registry.items()}
+
+    def sensor_count(self) -> int:
+        return len(self.registry)
+    
+    def snapshot(self) -> Optional[bytes]:
+        if not self.snapshot_path or not self.registry.dirty:
+            return None
+        self.registry.dirty = False
+        return self.registry.to_bytes()
+    
+    def save_snapshot(self, data: bytes) -> None:
+        self.registry.save(self.snapshot_path, data)
+
+
+class SQLiteStateStore(StateStore):
+    def __init__(self, path: str):
+        """
+        State shared by the worker processes on one machine through a SQLite database in WAL mode.
+
+        The connection is opened lazily in each process, so the store can be created before the workers are forked.
+        Writes only wait STATE_DB_BUSY_TIMEOUT for the lock of another worker, so a busy database doesn't stall the 
+        event loop, call them through `retry_locked` to retry them in between other requests.
+        """
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != getpid():
+            self._conn = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            self._pid = getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS system (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sensors (location TEXT PRIMARY KEY, "
+                               "sensor_status TEXT NOT NULL, last_message INTEGER NOT NULL)")
+            # The setup above may wait for the other workers while they start, later writes are retried instead
+            self._conn.execute(f"PRAGMA busy_timeout = {int(STATE_DB_BUSY_TIMEOUT * 1000)}")
+        return self._conn
+
+    @staticmethod
+    def _status_key(group: str) -> str:
+        # The default group keeps the key used before there were groups
+        return "system_status" if group == DEFAULT_GROUP else f"system_status:{group}"
+
+    def get_system_status(self, group: str = DEFAULT_GROUP) -> str:
+        row = self.conn.execute("SELECT value FROM system WHERE key = ?", (self._status_key(group),)).fetchone()
+        return row[0] if row else "Disarmed"
+
+    def set_system_status(self, status: str, group: str = DEFAULT_GROUP) -> None:
+        self.conn.execute("INSERT INTO system VALUES (?, ?) "
+                          "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (self._status_key(group), status))
+
+    def record_reading(self, location: str, sensor_status: str, timestamp: int) -> Optional[str]:
+        conn = self.conn
+        # Take the write lock before reading, so only one worker sees each change of a sensor
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT sensor_status FROM sensors WHERE location = ?", (location,)).fetchone()
+            conn.execute("INSERT INTO sensors VALUES (?, ?, ?) ON CONFLICT(location) DO UPDATE SET "
+                         "sensor_status = excluded.sensor_status, "
+                         "last_message = MAX(last_message, excluded.last_message)",
+                         (location, sensor_status, timestamp))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row[0] if row else None
+
+    def touch_sensors(self, locations: list[str], timestamp: int) -> None:
+        if not locations:
+            return
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE sensors SET last_message = MAX(last_message, ?) WHERE location = ?",
+                             [(timestamp, location) for location in locations])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_sensor(self, location: str) -> Optional[dict]:
+        row = self.conn.execute("SELECT sensor_status, last_message FROM sensors WHERE location = ?",
+                                (location,)).fetchone()
+        return {"last_sensor_status": row[0], "last_message": row[1]} if row else None
+
+    def remove_sensor(self, location: str, older_than: float = None) -> bool:
+        if older_than is None:
+            cursor = self.conn.execute("DELETE FROM sensors WHERE location = ?", (location,))
+        else:
+            cursor = self.conn.execute("DELETE FROM sensors WHERE location = ? AND last_message <= ?",
+                                       (location, older_than))
+        return cursor.rowcount == 1
+
+    def sensors(self) -> dict:
+        rows = self.conn.execute("SELECT location, sensor_status, last_message FROM sensors ORDER BY location")
+        return {location: {"last_sensor_status": status, "last_message": last_message}
+                for location, status, last_message in rows}
+
+    def sensor_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM sensors").fetchone()[0]
+
+    def close(self) -> None:
+        if self._conn is not None and self._pid == getpid():
+            self._conn.close()
+        self._conn = None
+
+
+async def retry_locked(method, *args, **kwargs):
+    """
+    Call a state store method, retrying it after a short sleep while another worker holds the SQLite write lock,
+    so the event loop keeps handling other requests instead of blocking on the lock.
+    """
+    for attempt in range(STATE_DB_LOCK_RETRIES):
+        try:
+            return method(*args, **kwargs)
+        except sqlite3.OperationalError as err:
+            if "locked" not in str(err) or attempt == STATE_DB_LOCK_RETRIES - 1:
+                raise
+        await asyncio.sleep(STATE_DB_RETRY_DELAY)
+
+
+def create_state_store() -> StateStore:
+    """
+    Create the state store selected by the STATE_BACKEND environment variable ("memory" or "sqlite").
+    The SQLite store is used by default when the server runs more than one worker (WEBHOOK_WORKERS).
+    The memory store is snapshotted to STATE_SNAPSHOT (server/state.snapshot by default).
+    """
+    backend = getenv("STATE_BACKEND") or ("sqlite" if int(getenv("WEBHOOK_WORKERS") or 1) > 1 else "memory")
+    if backend == "memory":
+        return MemoryStateStore(getenv("STATE_SNAPSHOT") or join(dirname(abspath(__file__)), 'state.snapshot'))
+    if backend == "sqlite":
+        return SQLiteStateStore(getenv("STATE_DB") or join(dirname(abspath(__file__)), 'state.db'))
+    raise ValueError(f"Unknown STATE_BACKEND: {backend}")
@@ -0,0 +1,101 @@
+import json
+from os import getenv
+from os.path import abspath, dirname, exists, join
+from typing import Iterable
+
+from .registry import DEFAULT_GROUP
+
+
+class SubscriptionIndex:
+    def __init__(self, groups: dict[str, dict], user_locations: dict[str, list[str]] = None):
+        """
+        Routes the messages of each sensor to the users subscribed to it.
+
+        Every sensor location belongs to one group, which has its own arm state and members. Sensors that are not
+        listed in a group belong to the default group. Users can also subscribe to single sensors of other groups,
+        they get the alerts of those sensors (while their group is armed) but can't arm or disarm the group.
+
+        The subscribers of every listed location are computed once, so routing a message costs a dict lookup and
+        the amount of its subscribers instead of a check of every user.
+
+        Args:
+            groups (dict): {group: {"users": [user id, ...], "locations": [location, ...]}}, must contain DEFAULT_GROUP.
+            user_locations (dict): {user id: [location, ...]} single sensors users subscribed to outside their groups.
+        """
+        if DEFAULT_GROUP not in groups:
+            raise ValueError(f"The subscriptions have no {DEFAULT_GROUP} group")
+
+        self._members = {group: tuple(dict.fromkeys(map(str, config.get("users", ()))))
+                         for group, config in groups.items()}
+        self._groups = {}  # {location: group} of the listed locations
+        for group, config in groups.items():
+            for location in config.get("locations", ()):
+                if self._groups.setdefault(location, group) != group:
+                    raise ValueError(f"{location} is listed in both the {self._groups[location]} and {group} groups")
+
+        self._user_groups = {}  # {user id: (group, ...)}
+        for group, members in self._members.items():
+            for user in members:
+                self._user_groups[user] = self._user_groups.get(user, ()) + (group,)
+
+        self._user_locations = {str(user): frozenset(locations) for user, locations in (user_locations or {}).items()}
+        extra = {}  # {location: [user id, ...]} of the single sensor subscriptions
+        for user, locations in self._user_locations.items():
+            for location in locations:
+                extra.setdefault(location, []).append(user)
+
+        self._subscribers = {location: tuple(dict.fromkeys(self._members[self._groups.get(location, DEFAULT_GROUP)]
+                                                           + tuple(extra.get(location, ()))))
+                             for location in self._groups.keys() | extra.keys()}
+
+    @classmethod
+    def load(cls, path: str, default_users: list[str]) -> "SubscriptionIndex":
+        """
+        Load the subscriptions from a JSON file, see subscriptions.example.json. Without a file (or a default group
+        in it), `default_users` are the members of the default group, so every user gets every alert.
+        """
+        config = {}
+        if path and exists(path):
+            with open(path) as f:
+                config = json.load(f)
+
+        groups = dict(config.get("groups", {}))
+        groups.setdefault(DEFAULT_GROUP, {"users": default_users})
+        return cls(groups, config.get("users", {}))
+
+    @property
+    def groups(self) -> tuple[str, ...]:
+        """The names of all groups"""
+        return tuple(self._members)
+
+    def group_of(self, location: str) -> str:
+        """Get the group a sensor belongs to"""
+        return self._groups.get(location, DEFAULT_GROUP)
+
+    def subscribers(self, location: str) -> tuple[str, ...]:
+        """Get the users that receive the messages of a sensor"""
+        subscribers = self._subscribers.get(location)
+        return subscribers if subscribers is not None else self._members[DEFAULT_GROUP]
+
+    def groups_of(self, user: str) -> tuple[str, ...]:
+        """Get the groups a user is a member of, and can arm or disarm"""
+        return self._user_groups.get(str(user), ())
+
+    def can_see(self, user: str, location: str) -> bool:
+        """Whether a user receives the messages of a sensor"""
+        user = str(user)
+        return self.group_of(location) in self.groups_of(user) or location in self._user_locations.get(user, ())
+
+    def route(self, items: Iterable, location=lambda item: item.location) -> dict[tuple[str, ...], list]:
+        """Group items (e.g. events) by the users that should receive them, so each set of users gets one message"""
+        routes = {}
+        for item in items:
+            subscribers = self.subscribers(location(item))
+            if subscribers:
+                routes.setdefault(subscribers, []).append(item)
+        return routes
+
+
+def get_subscriptions_path() -> str:
+    """Get the subscriptions file from SUBSCRIPTIONS_FILE, server/subscriptions.json by default"""
+    return getenv("SUBSCRIPTIONS_FILE") or join(dirname(abspath(__file__)), 'subscriptions.json')
@@ -1,28 +1,79 @@
-from os import getenv
+import asyncio
+from os import getenv, close, remove
+from os.path import getsize
+from tempfile import mkstemp
 from telebot.async_telebot import AsyncTeleBot
+from telebot import types
 from datetime import datetime
+from functools import lru_cache
 import pytz
 
-from .mongo import EventsMongoDB, IoTEvent
-from .util import load_command_template
+from . import clock
+from .mongo import LazyEventsMongoDB, EventWriter, IoTEvent
+from .dispatcher import AlertDispatcher
+from .coalescer import AlertCoalescer, LocationDigest
+from .dedup import DedupCache, event_key, sequence_key
+from .monitor import DisconnectMonitor
+from .registry import DEFAULT_GROUP
+from .state import create_state_store, retry_locked
+from .subscriptions import SubscriptionIndex, get_subscriptions_path
+from .analytics import HistorySummary, summarize
+from .export import EXPORT_FORMATS, export_events, format_available
+from .profiler import ProfileResult, SamplingProfiler
+from .metrics import (Metrics, REQUEST_SECONDS, HANDLE_EVENTS_SECONDS, MONGO_WRITE_SECONDS, TELEGRAM_SEND_SECONDS, 
+                      SENSOR_CONNECTS, SENSOR_DISCONNECTS, ALERTS_COALESCED, DUPLICATE_EVENTS)
+from .config import (DEDUP_CACHE_SIZE, SENSOR_DISCONNECT_TIME, ALERT_COALESCE_WINDOW, ALERT_FLAP_CHANGES, ALERT_TIMEZONE, 
+                     HISTORY_DEFAULT_DAYS, HISTORY_MAX_DAYS, HISTORY_TIMEOUT, EXPORT_MAX_UPLOAD_BYTES, 
+                     PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS)
+from .util import load_command_template, format_duration, get_spool_path, get_profile_path, pretty_join
+from .logger import logger
 
 # Load bot token from env and create async bot instance
 # Commands are added using functional approach
 AlarmBot = AsyncTeleBot(getenv("TG_BOT_TOKEN"))
 AlarmBot.users = getenv("TG_USERS").split(",")
+AlarmBot.admins = getenv("TG_ADMINS", AlarmBot.users[0]).split(",")  # The first user is the admin by default
 AlarmBot.webhook_url = None  # Set the webhook URL here once the service is started
 
+# The groups of sensors with their own arm state, and the users that receive the messages of each sensor
+Subscriptions = SubscriptionIndex.load(get_subscriptions_path(), AlarmBot.users)
 
-# Status trackers
-AlarmBot.system_status = "Disarmed" # Set initial status to disarmed
+# Sends alerts to all users concurrently within the Telegram rate limits
+Dispatcher = AlertDispatcher(AlarmBot)
 
-# There is no initial sensor status, set once updates are received:
-# Should be formatted as: {location: {"last_sensor_status": "OPEN" or "CLOSED", "last_message": int}}
-AlarmBot.sensor_status_cache = {}
 
+# Holds back repeated state changes of a sensor after its first alert and sends them as one digest per window
+Coalescer = AlertCoalescer(ALERT_COALESCE_WINDOW, ALERT_FLAP_CHANGES, on_flush=lambda digests: send_digest(digests), 
+                           logger=logger)
 
-# Instantiate MongoDB connection
-Mongo = EventsMongoDB()
+
+# Status trackers (system status of each group and sensor status cache), shared by all webhook workers
+State = create_state_store()
+
+
+# Tracks the disconnect deadline of each sensor, see on_sensor_timeout below
+Monitor = DisconnectMonitor(SENSOR_DISCONNECT_TIME, on_disconnect=lambda location: on_sensor_timeout(location), 
+                            logger=logger)
+
+
+# The keys of recent readings with a sequence number, so readings resent by a sensor are only handled once
+SeenReadings = DedupCache(DEDUP_CACHE_SIZE)
+
+
+# MongoDB connector (connected on first use) and the write-behind queue used for new events, spooled to disk until written
+Mongo = LazyEventsMongoDB()
+EventQueue = EventWriter(Mongo, get_spool_path(), logger=logger)
+
+
+# Samples the event loop while a /profile window runs, idle otherwise
+Profiler = SamplingProfiler()
+
+
+# Gauges read from the live objects when /metrics is scraped
+Metrics.gauge("roomraider_event_queue_depth", "Events waiting to be written to MongoDB", EventQueue.qsize)
+Metrics.gauge("roomraider_alert_broadcasts_pending", "Alert broadcasts still being sent", Dispatcher.pending)
+Metrics.gauge("roomraider_alerts_held", "Sensor state changes held back for the next alert digest", Coalescer.pending)
+Metrics.gauge("roomraider_connected_sensors", "Sensors in the sensor status cache", State.sensor_count)
 
 
 # ------------------- BOT COMMANDS ------------------- #
@@ -38,87 +89,434 @@ async def on_help(message):
 # Handle /status command
 @AlarmBot.message_handler(commands=['status'])
 async def on_status(message):
-    """Get the current status of the system, armed or disarmed"""
+    """Get the current status of the caller's sensors and groups, armed or disarmed"""
+    user = str(message.from_user.id)
     devices_str = ""
-    for location, data in AlarmBot.sensor_status_cache.items():
-        devices_str += f"📶 _{location}_ (Status: `{data['last_sensor_status']}`)\n"
+    groups = dict.fromkeys(Subscriptions.groups_of(user))
+    for location, data in State.sensors().items():
+        if Subscriptions.can_see(user, location):
+            devices_str += f"📶 _{location}_ (Status: `{data['last_sensor_status']}`)\n"
+            groups.setdefault(Subscriptions.group_of(location))
     if not devices_str:
         devices_str = "🚫 _None Connected_"
         
-    emoji = "🛑🔒" if AlarmBot.system_status == "Armed" else "🟢🔓"
+    statuses = {group: State.get_system_status(group) for group in groups}
+    armed = [group for group, status in statuses.items() if status == "Armed"]
+    if len(statuses) <= 1:
+        system_status = next(iter(statuses.values()), "Disarmed")
+    else:
+        disarmed = [group for group in statuses if group not in armed]
+        system_status = "; ".join(part for part in (armed and f"Armed: {pretty_join(armed)}", 
+                                                    disarmed and f"Disarmed: {pretty_join(disarmed)}") if part)
+    emoji = "🟢🔓" if not armed else "🛑🔒" if len(armed) == len(statuses) else "⚠️"
     
     await AlarmBot.reply_to(message, load_command_template("status").format(emoji=emoji, 
-                                                                            status=AlarmBot.system_status, 
+                                                                            status=system_status, 
                                                                             devices=devices_str), 
                             parse_mode="Markdown")
     
+def command_groups(message) -> list[str]:
+    """Get the groups an /arm or /disarm command applies to: all groups of the caller, or the group given after the command"""
+    groups = Subscriptions.groups_of(message.from_user.id)
+    args = message.text.split(maxsplit=1)[1:]
+    if args:
+        return [group for group in groups if group == args[0].strip()]
+    return list(groups)
+
+
 # Handle /arm command
 @AlarmBot.message_handler(commands=['arm'])
 async def on_arm(message):
+    groups = command_groups(message)
+    if not groups:
+        await AlarmBot.reply_to(message, "🚫 You are not a member of that group.")
+        return
+    for group in groups:
+        await retry_locked(State.set_system_status, "Armed", group)
     text = "🛑🔒 System is now *armed*. You will be alerted for any new events."
-    AlarmBot.system_status = "Armed"
+    if groups != [DEFAULT_GROUP]:
+        text += f"\nGroups: _{pretty_join(groups)}_"
     await AlarmBot.reply_to(message, text, parse_mode="Markdown")
     
     
 # Handle /disarm command
 @AlarmBot.message_handler(commands=['disarm'])
 async def on_disarm(message):
+    groups = command_groups(message)
+    if not groups:
+        await AlarmBot.reply_to(message, "🚫 You are not a member of that group.")
+        return
+    for group in groups:
+        await retry_locked(State.set_system_status, "Disarmed", group)
     text = "🟢🔓 System is now *disarmed*. You will no longer be alerted for new events."
-    AlarmBot.system_status = "Disarmed"
+    if groups != [DEFAULT_GROUP]:
+        text += f"\nGroups: _{pretty_join(groups)}_"
     await AlarmBot.reply_to(message, text, parse_mode="Markdown")
     
+    
+# Handle /history command
+@AlarmBot.message_handler(commands=['history'])
+async def on_history(message):
+    """Summarize the sensor activity over the last days, e.g. /history 30"""
+    args = message.text.split()[1:]
+    try:
+        days = int(args[0]) if args else HISTORY_DEFAULT_DAYS
+    except ValueError:
+        await AlarmBot.reply_to(message, "Usage: /history [days]")
+        return
+    days = max(1, min(days, HISTORY_MAX_DAYS))
+    
+    end = int(clock.time())
+    try:
+        # The query runs in a worker thread so the event loop keeps serving sensors meanwhile
+        summary = await asyncio.wait_for(asyncio.to_thread(summarize, Mongo, end - days * 86400, end), 
+                                         HISTORY_TIMEOUT)
+    except Exception as err:
+        logger.error(f"Failed to summarize the event history: {err}", logger_type="main", exc_info=err)
+        await AlarmBot.reply_to(message, "⚠️ The history could not be loaded right now, try a shorter period.")
+        return
+    
+    await AlarmBot.reply_to(message, format_history(summary, days, str(message.from_user.id)), parse_mode="Markdown")
 
-# Send alerts when the system is triggered
-async def handle_event(data: dict) -> None:
-    sensor_cache = AlarmBot.sensor_status_cache.get(data['location'], None)
-    if not sensor_cache:
-        # if the sensor is not in the cache, add it
-        AlarmBot.sensor_status_cache[data['location']] = {"last_sensor_status": data['sensor_status'],
-                                                          "last_message": data['timestamp']}
-        # Alert that the new device has been connected
-        await device_connected(data['location'])
+
+# Handle /export command (admins only)
+@AlarmBot.message_handler(commands=['export'])
+async def on_export(message):
+    """Send the events of the last days as a file, e.g. /export 30 parquet"""
+    if str(message.from_user.id) not in AlarmBot.admins:
         return
     
-    # Set last message for event regardless
-    AlarmBot.sensor_status_cache[data['location']]['last_message'] = data['timestamp']
+    days, fmt = HISTORY_DEFAULT_DAYS, "csv"
+    for arg in message.text.split()[1:]:
+        if arg.isdigit():
+            days = int(arg)
+        elif arg.lower() in EXPORT_FORMATS:
+            fmt = arg.lower()
+        else:
+            await AlarmBot.reply_to(message, f"Usage: /export [days] [{'|'.join(EXPORT_FORMATS)}]")
+            return
+    if not format_available(fmt):
+        await AlarmBot.reply_to(message, f"⚠️ Exporting to {fmt} requires pyarrow on the server, use csv instead.")
+        return
+    days = max(1, min(days, HISTORY_MAX_DAYS))
     
-    if data['sensor_status'] == sensor_cache['last_sensor_status']:
-        # if the sensor status has not changed, do nothing
-        return 
+    # The export can take a while, so it is sent from a background task instead of holding up the webhook request
+    await AlarmBot.reply_to(message, f"📦 Exporting the events of the last {days} days as {fmt} ...")
+    task = asyncio.create_task(send_export(message, days, fmt))
+    CommandTasks.add(task)
+    task.add_done_callback(CommandTasks.discard)
     
-    # append the system status to the request data
-    data["system_status"] = AlarmBot.system_status
-    event = IoTEvent(**data)
     
-    # add event to mongoDB
-    Mongo.add_event(event)
+# The running /export and /profile tasks, referenced so they are not garbage collected before they finish
+CommandTasks = set()
+
+
+async def send_export(message, days: int, fmt: str) -> None:
+    """Stream the events to a temporary file in a worker thread and send it as a document"""
+    end = int(clock.time())
+    fd, path = mkstemp(prefix="roomraider-export-", suffix=f".{fmt}")
+    close(fd)
     
-    # Prepare and send the alert if the system is armed
-    if AlarmBot.system_status == "Armed":
-        # Convert Unix timestamp to a datetime object and apply the CST timezone
-        localized_dt = datetime.fromtimestamp(event.timestamp, 
-                                              tz=pytz.timezone('US/Central'))
+    def write_export() -> int:
+        with open(path, "wb") as f:
+            return export_events(Mongo, f, fmt, end - days * 86400, end)
+        
+    try:
+        exported = await asyncio.to_thread(write_export)
+        if getsize(path) > EXPORT_MAX_UPLOAD_BYTES:
+            await AlarmBot.reply_to(message, "⚠️ The export is too large to send, use a shorter period or "
+                                             "`python -m server export` on the server.", parse_mode="Markdown")
+            return
+        with open(path, "rb") as f:
+            await AlarmBot.send_document(message.chat.id, f, reply_parameters=types.ReplyParameters(message.message_id),
+                                         caption=f"{exported} events", 
+                                         visible_file_name=f"roomraider-events-{days}d.{fmt}")
+    except Exception as err:
+        logger.error(f"Failed to export the event history: {err}", logger_type="main", exc_info=err)
+        await AlarmBot.reply_to(message, "⚠️ The export failed, try again later.")
+    finally:
+        remove(path)
 
-        # create alert text
-        alert = load_command_template("alert").format(status=event.sensor_status.upper(),
-                                                      datetime=localized_dt.strftime('%Y-%m-%d %I:%M %p %Z'),
-                                                      location=event.location)
+
+# Handle /metrics command (admins only)
+@AlarmBot.message_handler(commands=['metrics'])
+async def on_metrics(message):
+    """Get a compact summary of the server metrics"""
+    if str(message.from_user.id) not in AlarmBot.admins:
+        return
+    
+    def latency(histogram, **labels) -> str:
+        return (f"`{histogram.count(**labels)}` × p50 `{histogram.quantile(0.5, **labels) * 1000:.1f}` "
+                f"p95 `{histogram.quantile(0.95, **labels) * 1000:.1f}` "
+                f"p99 `{histogram.quantile(0.99, **labels) * 1000:.1f}` ms")
+    
+    uptime_hours = max((clock.time() - Metrics.started) / 3600, 1 / 3600)
+    lines = [f"⏱ *Uptime:* `{format_duration(clock.time() - Metrics.started)}`",
+             f"📶 *Connected sensors:* `{State.sensor_count()}`",
+             f"🚫 *Disconnects:* `{SENSOR_DISCONNECTS.get():.0f}` (`{SENSOR_DISCONNECTS.get() / uptime_hours:.1f}`/h)",
+             f"📥 *Event queue:* `{EventQueue.qsize()}`, *Pending alerts:* `{Dispatcher.pending()}`",
+             "",
+             "*Requests:*"]
+    for key in REQUEST_SECONDS.series:
+        action = dict(key)["action"]
+        lines.append(f"• `{action}`: {latency(REQUEST_SECONDS, action=action)}")
+    lines += ["",
+              f"*Event handling:* {latency(HANDLE_EVENTS_SECONDS)}",
+              f"*MongoDB writes:* {latency(MONGO_WRITE_SECONDS)}",
+              f"*Telegram sends:* {latency(TELEGRAM_SEND_SECONDS)}"]
+    
+    await AlarmBot.reply_to(message, "\n".join(lines), parse_mode="Markdown")
+
+
+# Handle /profile command (admins only)
+@AlarmBot.message_handler(commands=['profile'])
+async def on_profile(message):
+    """Profile the event loop for some seconds, e.g. /profile 30"""
+    if str(message.from_user.id) not in AlarmBot.admins:
+        return
+    
+    args = message.text.split()[1:]
+    try:
+        seconds = int(args[0]) if args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await AlarmBot.reply_to(message, "Usage: /profile [seconds]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if Profiler.running:
+        await AlarmBot.reply_to(message, "⚠️ A profile is already running.")
+        return
+    
+    # The profile runs in a background task so the webhook request returns right away
+    await AlarmBot.reply_to(message, f"🔬 Profiling the server for {seconds} seconds ...")
+    task = asyncio.create_task(send_profile(message, seconds))
+    CommandTasks.add(task)
+    task.add_done_callback(CommandTasks.discard)
+    
+    
+async def send_profile(message, seconds: int) -> None:
+    """Run a profiling window, write the full report to server/logs and reply with the summary"""
+    try:
+        result = await Profiler.profile(seconds)
+        path = get_profile_path(datetime.now(ALERT_TZ).strftime("profile-%Y%m%d-%H%M%S"))
         
-        # send the alert
-        for user in AlarmBot.users:
-            await AlarmBot.send_message(user, text=alert, parse_mode="Markdown")
+        def write_report():
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(result.report())
             
-    # set the last sensor status to the current one
-    AlarmBot.sensor_status_cache[data['location']]['last_sensor_status'] = data['sensor_status']
+        await asyncio.to_thread(write_report)
+        await AlarmBot.reply_to(message, format_profile(result, path), parse_mode="Markdown")
+    except Exception as err:
+        logger.error(f"Failed to profile the server: {err}", logger_type="main", exc_info=err)
+        await AlarmBot.reply_to(message, "⚠️ The profile failed, try again later.")
+
+
+# Send alerts when the system is triggered
+async def handle_event(data: dict) -> None:
+    """Handle a single sensor reading, see handle_events"""
+    await handle_events([data])
+
+
+@HANDLE_EVENTS_SECONDS.time()
+async def handle_events(readings: list[dict]) -> None:
+    """
+    Handle sensor readings in the order they were received.
+    
+    Readings resent by a sensor (with a sequence number that was already seen) are dropped. A sequence number is
+    only marked as seen once its reading is stored and its change queued, so a reading that failed (e.g. on a 
+    locked state store) is handled again when the sensor resends it.
+    Every reading updates the sensor status cache and disconnect deadline. Readings that change the state of a 
+    sensor are queued to MongoDB as a single batch. If the group of the sensor is armed, the first change of each 
+    sensor is alerted right away to its subscribers (in one message for several sensors), and repeated changes are
+    held back by the Coalescer.
+    """
+    events = []
+    group_statuses = {}  # The system status of each group, read once per batch
+    handled = set()  # The sequence keys of the stored readings, only marked as seen once their changes are queued
+    try:
+        for data in readings:
+            Monitor.touch(data['location'], data['timestamp'])
+            
+            key = sequence_key(data)
+            if key is not None and (key in SeenReadings or key in handled):
+                DUPLICATE_EVENTS.inc()
+                continue
+            
+            # Store the reading and get the previous status, only one worker sees each change of a sensor
+            last_sensor_status = await retry_locked(State.record_reading, data['location'], data['sensor_status'], 
+                                                    data['timestamp'])
+            if key is not None:
+                handled.add(key)
+            
+            if last_sensor_status is None:
+                # Alert that the new device has been connected
+                await device_connected(data['location'])
+                continue
+            
+            if data['sensor_status'] == last_sensor_status:
+                # if the sensor status has not changed, do nothing
+                continue
+            
+            group = Subscriptions.group_of(data['location'])
+            system_status = group_statuses.get(group)
+            if system_status is None:
+                system_status = group_statuses[group] = State.get_system_status(group)
+            
+            events.append(IoTEvent(action=data['action'], timestamp=data['timestamp'], location=data['location'],
+                                   sensor_status=data['sensor_status'], system_status=system_status,
+                                   key=key or event_key(data)))
+    finally:
+        # When a reading fails, the changes stored before it are still queued and alerted, and the failed reading
+        # and the ones after it are not marked as seen, so they are handled when the sensor resends them
+        if events:
+            # queue the events to be written to mongoDB in the background
+            EventQueue.put_many(events)
+            
+            # Prepare and send the alerts of the sensors in armed groups
+            armed = [event for event in events if event.system_status == "Armed"]
+            if armed:
+                immediate = Coalescer.add(armed, clock.time())
+                # send each alert to the subscribers of its sensors at once without blocking the webhook request
+                for users, alerts in Subscriptions.route(immediate).items():
+                    Dispatcher.broadcast(users, format_alert(alerts), parse_mode="Markdown")
+        
+        for key in handled:
+            SeenReadings.add(key)
+
+
+def armed_digests(digests: list[LocationDigest]) -> list[LocationDigest]:
+    """Keep the digests of the sensors in armed groups, a group disarmed during the window gets no digest"""
+    group_statuses = {}  # The system status of each group, read once per flush
+    armed = []
+    for digest in digests:
+        group = Subscriptions.group_of(digest.location)
+        system_status = group_statuses.get(group)
+        if system_status is None:
+            system_status = group_statuses[group] = State.get_system_status(group)
+        if system_status == "Armed":
+            armed.append(digest)
+    return armed
+
+
+async def send_digest(digests: list[LocationDigest]) -> None:
+    """Called by the Coalescer with the changes that were held back during the last window"""
+    digests = armed_digests(digests)
+    ALERTS_COALESCED.inc(sum(len(digest.events) for digest in digests))
+    for users, routed in Subscriptions.route(digests).items():
+        Dispatcher.broadcast(users, format_digest(routed), parse_mode="Markdown")
+        
+
+# Timezone and format used for the alert timestamps
+ALERT_TZ = pytz.timezone(ALERT_TIMEZONE)
+ALERT_TIME_FORMAT = '%Y-%m-%d %I:%M %p %Z'
+
+
+def format_event_time(timestamp: int) -> str:
+    """Convert Unix timestamp to a datetime string in the CST timezone"""
+    # The format has minute precision, so the formatted string is cached per minute
+    return _format_minute(int(timestamp) // 60)
+
+
+@lru_cache(maxsize=256)
+def _format_minute(minute: int) -> str:
+    localized_dt = datetime.fromtimestamp(minute * 60, tz=ALERT_TZ)
+    return localized_dt.strftime(ALERT_TIME_FORMAT)
+        
+
+def format_history(summary: HistorySummary, days: int, user: str = None) -> str:
+    """Create the /history text with one block per location, only the locations the user is subscribed to if given"""
+    blocks = []
+    for i, location in enumerate(summary.locations):
+        if user is not None and not Subscriptions.can_see(user, location):
+            continue
+        blocks.append(f"📍 _{location}_\n"
+                      f"🔓 Opened `{summary.opens[i]}` times, 🔒 closed `{summary.closes[i]}` times\n"
+                      f"⏱ Open for `{format_duration(summary.open_seconds[i])}`\n"
+                      f"🕒 Busiest hour: `{int(summary.hourly[i].argmax()):02d}:00`\n"
+                      f"〰️ Flapping: `{summary.flap_rates[i]:.0%}` of events")
+    if not blocks:
+        blocks.append("🚫 _No events recorded_")
+        
+    return load_command_template("history").format(days=days, locations="\n\n".join(blocks))
+
+
+def format_profile(result: ProfileResult, path: str, top: int = 8) -> str:
+    """Create the /profile summary with the event loop lag and the functions the loop spent the most samples in"""
+    busy = result.samples - result.idle_samples()
+    lines = [f"🔬 *Profile of {result.duration:.0f}s:* `{result.samples}` samples, "
+             f"busy `{busy / max(result.samples, 1):.0%}` of the time",
+             f"⏱ *Event loop lag:* p50 `{result.lag_quantile(0.5) * 1000:.1f}` p95 `{result.lag_quantile(0.95) * 1000:.1f}` "
+             f"max `{max(result.lags, default=0) * 1000:.1f}` ms",
+             "",
+             "*Hot functions* (self / total samples):"]
+    total = result.total_samples()
+    hot = [(function, samples) for function, samples in result.self_samples().most_common() 
+           if "(selectors.py:" not in function][:top]
+    for function, samples in hot:
+        lines.append(f"• `{function}` {samples} / {total[function]}")
+    if not hot:
+        lines.append("🚫 _The event loop was idle_")
+    lines += ["", f"📄 Full profile: `{path}`"]
+    return "\n".join(lines)
+
+
+def format_alert(events: list[IoTEvent]) -> str:
+    """Create the alert text for one event, or a digest if several sensors changed state"""
+    if len(events) == 1:
+        event = events[0]
+        return load_command_template("alert").format(status=event.sensor_status.upper(),
+                                                     datetime=format_event_time(event.timestamp),
+                                                     location=event.location)
+        
+    lines = "\n".join(f"🕒 {format_event_time(event.timestamp)} - _{event.location}_ is now *{event.sensor_status.upper()}*"
+                      for event in events)
+    return load_command_template("alert_digest").format(count=len(events), events=lines)
+
+
+def format_digest(digests: list[LocationDigest]) -> str:
+    """Create the digest text for the changes held back by the Coalescer, with one line per sensor"""
+    lines = []
+    for digest in digests:
+        line = (f"🕒 {format_event_time(digest.last_timestamp)} - _{digest.location}_ is now *{digest.sensor_status.upper()}* "
+                f"after `{len(digest.events)}` more changes")
+        if digest.flapping:
+            line += " 〰️ *Flapping*"
+        lines.append(line)
+    return load_command_template("alert_digest").format(count=sum(len(digest.events) for digest in digests),
+                                                        events="\n".join(lines))
     
 
 async def device_connected(device_id: str):
-    """Send a message to all users when the device connects"""
-    for user in AlarmBot.users:
-        await AlarmBot.send_message(user, text=f"📶 *Device Connected:* {device_id}", parse_mode="Markdown")
+    """Send a message to the subscribers of the device when it connects"""
+    SENSOR_CONNECTS.inc()
+    Dispatcher.broadcast(Subscriptions.subscribers(device_id), f"📶 *Device Connected:* {device_id}", parse_mode="Markdown")
 
 
 async def device_disconnected(device_id: str):
-    """Send a message to all users when the device disconnects"""
-    for user in AlarmBot.users:
-        await AlarmBot.send_message(user, text=f"🚫 *Device Disconnected:* {device_id}", parse_mode="Markdown")
\ No newline at end of file
+    """Send a message to the subscribers of the device when it disconnects"""
+    Dispatcher.broadcast(Subscriptions.subscribers(device_id), f"🚫 *Device Disconnected:* {device_id}", 
+                         parse_mode="Markdown")
+
+
+async def on_sensor_disconnected(location: str, older_than: float = None) -> bool:
+    """
+    Called right away when the WebSocket connection of a sensor drops, or by on_sensor_timeout.
+    
+    Returns True if the sensor was disconnected by this call (and not already by another worker).
+    """
+    if not await retry_locked(State.remove_sensor, location, older_than=older_than):
+        return False
+    SENSOR_DISCONNECTS.inc()
+    await device_disconnected(location)
+    logger.info(f"Device has been disconnected: {location}")
+    return True
+
+
+async def on_sensor_timeout(location: str):
+    """Called by the disconnect monitor once a sensor has not sent a message for SENSOR_DISCONNECT_TIME"""
+    if await on_sensor_disconnected(location, older_than=clock.time() - Monitor.timeout):
+        return
+    
+    # Another worker received a newer message from the sensor, track the deadline from there
+    sensor = State.get_sensor(location)
+    if sensor is not None:
+        Monitor.touch(location, sensor["last_message"])
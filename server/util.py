@@ -1,8 +1,11 @@
-from os import getcwd, mkdir, getenv
+from os import getcwd, mkdir, getenv, listdir, stat
 import ssl
 from os.path import isdir, join, dirname, abspath
+from time import monotonic
 from dotenv import find_dotenv, load_dotenv
 
+from .config import TEMPLATE_RELOAD_INTERVAL
+
 
 def get_logfile() -> str:
     """
@@ -15,6 +18,21 @@ def get_logfile() -> str:
     return join(log_dir, 'log.txt')
 
 
+def get_profile_path(name: str) -> str:
+    """
+    Get the path of a /profile report in the server/logs directory
+    """
+    return join(dirname(get_logfile()), f'{name}.txt')
+
+
+def get_spool_path(worker: int = 0) -> str:
+    """
+    Get the event spool path of a webhook worker, in EVENT_SPOOL_DIR or the server/spool directory by default
+    """
+    spool_dir = getenv("EVENT_SPOOL_DIR") or join(dirname(abspath(__file__)), 'spool')
+    return join(spool_dir, f'events-{worker}.spool')
+
+
 def handle_env():
     """
     Checks if the .env file exists in the repo root, and imports the variables if so.
@@ -54,6 +72,67 @@ def get_ssl_filepaths() -> tuple:
     return join(current_dir, 'ssl', getenv("WEBHOOK_SSL_CERT")), join(current_dir, 'ssl', getenv("WEBHOOK_SSL_PRIV")) 
             
 
+class TemplateRegistry:
+    def __init__(self, directory: str, reload_interval: float = TEMPLATE_RELOAD_INTERVAL):
+        """
+        Loads every resource file once and serves it from memory.
+        
+        The files are only checked for changes (by mtime) once every `reload_interval` seconds, 
+        and a file is only read again if its mtime changed.
+        
+        Args:
+            directory (str): The directory containing the resource files.
+            reload_interval (float): The minimum amount of seconds between checks for changed files.
+        """
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self._mtimes = {}  # {filename: mtime}
+        self._templates = {}  # {filename: template text}
+        self._commands = {}  # {command: description} parsed from commands.txt
+        self._checked = 0
+        self.reload()
+        
+    def reload(self) -> None:
+        """Load all new or changed resource files"""
+        for filename in listdir(self.directory):
+            mtime = stat(join(self.directory, filename)).st_mtime
+            if self._mtimes.get(filename) != mtime:
+                self._load(filename)
+                self._mtimes[filename] = mtime
+        self._checked = monotonic()
+                
+    def _load(self, filename: str) -> None:
+        with open(join(self.directory, filename), 'r', encoding='utf8', errors='ignore') as f:
+            text = f.read()
+        self._templates[filename] = text
+        
+        if filename == 'commands.txt':
+            commands = {}
+            for line in text.splitlines():
+                if line.strip():
+                    command, description = line.strip().split(' - ')
+                    commands[command] = description
+            self._commands = commands
+            
+    def _check(self) -> None:
+        if monotonic() - self._checked >= self.reload_interval:
+            self.reload()
+        
+    def get(self, filename: str) -> str:
+        """Get the text of a resource file"""
+        self._check()
+        return self._templates[filename]
+    
+    def commands(self) -> dict:
+        """Get the commands parsed from commands.txt"""
+        self._check()
+        return dict(self._commands)
+    
+    
+# Resources are loaded once on import and served from memory
+Templates = TemplateRegistry(join(dirname(abspath(__file__)), 'resources'))
+
+
 def load_command_template(command: str) -> str:
     """
     Loads the markdown template from the templates directory.
@@ -61,8 +140,7 @@ def load_command_template(command: str) -> str:
     Args:
         command (str): The name of the command template to load (without the .md extension)
     """
-    with open(join(dirname(__file__), 'resources', f'{command}.md'), 'r', encoding='utf8', errors='ignore') as f:
-        return f.read()
+    return Templates.get(f'{command}.md')
     
     
 def pretty_join(items: list, conjunction: str ="and") -> str:
@@ -80,6 +158,18 @@ def pretty_join(items: list, conjunction: str ="and") -> str:
     return ', '.join(items[:-1]) + f' {conjunction} ' + items[-1]
 
 
+def format_duration(seconds: float) -> str:
+    """Format an amount of seconds as e.g. '2d 3h 15m'"""
+    minutes = int(seconds) // 60
+    days, minutes = divmod(minutes, 1440)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days}d {hours}h {minutes}m"
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m"
+
+
 class SafeFormat(object):
     def __init__(self, **kw):
         self.__dict = kw
@@ -100,10 +190,4 @@ def escape_markdown(s: str) -> str:
 
 def get_commands() -> dict:
     """Fetches the commands from the templates for the help command"""
-    commands = {}
-    with open(join(dirname(abspath(__file__)), 'resources', 'commands.txt')) as f:
-        for line in f.readlines():
-            command, description = line.strip().split(' - ')
-            commands[command] = description
-                
-    return commands
\ No newline at end of file
+    return Templates.commands()
\ No newline at end of file
@@ -0,0 +1,319 @@
+"""
+Sensor-fleet load generator and end-to-end latency benchmark for the webhook server.
+
+Runs the real aiohttp app from `server.__main__` on localhost, with local stand-ins for the
+Telegram Bot API and MongoDB, and simulates a fleet of M5Stick sensors against it:
+
+    python testing/benchmark.py --sensors 1000 --duration 30
+    python testing/benchmark.py --sensors 200 --replay testing/sensor_data.csv --speedup 60
+    python testing/benchmark.py --sensors 500 --mongo-latency 80 --json results.json
+
+Throughput and p50/p95/p99 latency are reported for each action (ping, sensor_event, sensor_batch
+and Telegram updates), so regressions show up before deployment.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+from collections import defaultdict
+from itertools import count
+from os.path import abspath, dirname, join
+from time import perf_counter, sleep, time
+
+# The server reads its configuration from the environment on import
+BOT_TOKEN = "123456789:BENCHMARKbenchmarkBENCHMARKbenchmark"
+BENCH_USERS = ["1001", "1002", "1003"]
+os.environ["TG_BOT_TOKEN"] = BOT_TOKEN
+os.environ["TG_USERS"] = ",".join(BENCH_USERS)
+os.environ.setdefault("MONGODB_CONNECTION_STRING", "mongodb://127.0.0.1:1/")
+BENCH_DIR = tempfile.mkdtemp(prefix="roomraider-benchmark-")
+os.environ["STATE_SNAPSHOT"] = join(BENCH_DIR, "state.snapshot")
+os.environ["EVENT_SPOOL_DIR"] = join(BENCH_DIR, "spool")
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from aiohttp import ClientSession, TCPConnector, web
+from bson import ObjectId
+from telebot import apihelper, asyncio_helper
+
+
+# ------------------ LOCAL STAND-INS ------------------ #
+
+class FakeTelegramAPI:
+    """Minimal Bot API server that accepts every method and counts the calls"""
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self._message_ids = count(1)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "RoomRaider", "username": "BenchmarkBot"}
+        elif method in ("sendMessage", "sendDocument"):
+            data = await request.post()
+            result = {"message_id": next(self._message_ids), "date": int(time()),
+                      "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+                      "text": data.get("text", "")}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+
+class FakeCollection:
+    """Empty collection, so the rollup job has nothing to roll up during a benchmark"""
+    def find_one(self, *args, **kwargs):
+        return None
+
+
+class FakeEventsMongoDB:
+    """In-memory replacement for EventsMongoDB with an optional simulated round-trip time"""
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.documents = []
+        self.writes = 0
+        self.events = self.rollup_state = FakeCollection()
+
+    async def connect(self) -> "FakeEventsMongoDB":
+        return self
+
+    def add_events(self, events: list) -> list:
+        if self.latency:
+            sleep(self.latency)  # Runs in the writer's worker thread, like the blocking pymongo call
+        self.writes += 1
+        for event in events:
+            event._id = ObjectId()
+            self.documents.append(event.dict())
+        return events
+
+    def add_event(self, event):
+        return self.add_events([event])[0]
+
+    def iter_events(self, start: int = None, end: int = None, location: str = None, projection: dict = None,
+                    batch_size: int = None):
+        for document in self.documents:
+            if start is not None and document["timestamp"] < start:
+                continue
+            if end is not None and document["timestamp"] > end:
+                continue
+            if location is not None and document["location"] != location:
+                continue
+            yield document
+
+    def prepare(self) -> int:
+        return 0
+
+    def ensure_ttl(self, collection, days) -> None:
+        pass
+
+
+# ------------------ TRAFFIC ------------------ #
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples = defaultdict(list)  # {action: [seconds, ...]}
+        self.errors = defaultdict(int)  # {action: amount of failed requests}
+
+    async def post(self, session: ClientSession, url: str, action: str, payload: dict) -> None:
+        start = perf_counter()
+        try:
+            async with session.post(url, json=payload) as response:
+                await response.read()
+                if response.status >= 400:
+                    self.errors[action] += 1
+        except Exception:
+            self.errors[action] += 1
+        self.samples[action].append(perf_counter() - start)
+
+
+def load_patterns(csv_path: str) -> list[list[tuple[float, str]]]:
+    """Load the recorded status changes of each location as [(seconds since previous change, status), ...]"""
+    rows = defaultdict(list)
+    with open(csv_path, newline="") as f:
+        for row in csv.DictReader(f):
+            rows[row["location"]].append((int(row["timestamp"]), row["sensor_status"]))
+
+    patterns = []
+    for events in rows.values():
+        events.sort()
+        patterns.append([(max(ts - prev_ts, 0), status)
+                         for (prev_ts, _), (ts, status) in zip([events[0]] + events[:-1], events)])
+    return patterns
+
+
+async def run_sensor(session: ClientSession, url: str, recorder: LatencyRecorder, location: str, stop_at: float,
+                     args, pattern: list = None) -> None:
+    """Simulate one M5Stick that sends a heartbeat every period and occasionally changes state"""
+    await asyncio.sleep(random.uniform(0, args.period))  # Spread the fleet over the period
+
+    status = random.choice(("OPEN", "CLOSED"))
+    step = 0
+    next_change = perf_counter() + (pattern[0][0] / args.speedup if pattern else 0)
+    buffered = []
+
+    while perf_counter() < stop_at:
+        now = perf_counter()
+        if pattern:
+            if now >= next_change:
+                status = pattern[step % len(pattern)][1]
+                step += 1
+                next_change = now + pattern[step % len(pattern)][0] / args.speedup
+        elif random.random() < args.change_probability:
+            status = "OPEN" if status == "CLOSED" else "CLOSED"
+
+        if args.batch > 1:
+            buffered.append({"sensor_status": status, "age_ms": 0})
+            if len(buffered) >= args.batch:
+                for i, reading in enumerate(buffered):
+                    reading["age_ms"] = int((len(buffered) - 1 - i) * args.period * 1000)
+                await recorder.post(session, url, "sensor_batch",
+                                    {"action": "sensor_batch", "location": location, "readings": buffered})
+                buffered = []
+        else:
+            await recorder.post(session, url, "sensor_event",
+                                {"action": "sensor_event", "timestamp": int(time()),
+                                 "location": location, "sensor_status": status})
+        await asyncio.sleep(args.period)
+
+
+async def run_pinger(session: ClientSession, url: str, recorder: LatencyRecorder, stop_at: float, rate: float) -> None:
+    """Simulate an uptime monitor"""
+    while perf_counter() < stop_at:
+        await recorder.post(session, url, "ping", {"action": "ping"})
+        await asyncio.sleep(1 / rate)
+
+
+async def run_telegram(session: ClientSession, url: str, recorder: LatencyRecorder, stop_at: float, rate: float) -> None:
+    """Simulate users sending /status to the bot through the Telegram webhook"""
+    update_ids = count(1)
+    while perf_counter() < stop_at:
+        user = int(random.choice(BENCH_USERS))
+        update = {"update_id": next(update_ids),
+                  "message": {"message_id": 1, "date": int(time()), "text": "/status",
+                              "entities": [{"offset": 0, "length": 7, "type": "bot_command"}],
+                              "chat": {"id": user, "type": "private"},
+                              "from": {"id": user, "is_bot": False, "first_name": "Bench"}}}
+        await recorder.post(session, url, "telegram_update", update)
+        await asyncio.sleep(1 / rate)
+
+
+# ------------------ REPORT ------------------ #
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def build_report(recorder: LatencyRecorder, elapsed: float) -> dict:
+    report = {}
+    for action, samples in sorted(recorder.samples.items()):
+        report[action] = {"requests": len(samples),
+                          "errors": recorder.errors[action],
+                          "throughput": len(samples) / elapsed,
+                          "p50_ms": percentile(samples, 0.50) * 1000,
+                          "p95_ms": percentile(samples, 0.95) * 1000,
+                          "p99_ms": percentile(samples, 0.99) * 1000}
+    return report
+
+
+def print_report(report: dict, extra: dict) -> None:
+    print(f"\n{'action':<18}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for action, row in report.items():
+        print(f"{action:<18}{row['requests']:>10}{row['errors']:>8}{row['throughput']:>10.1f}"
+              f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}")
+    print()
+    for key, value in extra.items():
+        print(f"{key}: {value}")
+
+
+# ------------------ MAIN ------------------ #
+
+async def main(args) -> dict:
+    # Start the Telegram Bot API stand-in and point both bot clients at it
+    telegram_api = FakeTelegramAPI()
+    api_runner = web.AppRunner(telegram_api.create_app())
+    await api_runner.setup()
+    api_site = web.TCPSite(api_runner, "127.0.0.1", 0)
+    await api_site.start()
+    api_port = api_runner.addresses[0][1]
+    asyncio_helper.API_URL = f"http://127.0.0.1:{api_port}/bot{{0}}/{{1}}"
+    apihelper.API_URL = f"http://127.0.0.1:{api_port}/bot{{0}}/{{1}}"
+
+    # Import the server once the environment is ready and replace MongoDB with the in-memory stand-in
+    import server.__main__ as webhook
+    import server.telegram as telegram
+    mongo = FakeEventsMongoDB(latency=args.mongo_latency / 1000)
+    telegram.Mongo = webhook.Mongo = telegram.EventQueue.mongo = mongo
+
+    runner = web.AppRunner(webhook.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}/{BOT_TOKEN}/"
+
+    patterns = load_patterns(args.replay) if args.replay else None
+
+    recorder = LatencyRecorder()
+    connector = TCPConnector(limit=args.connections)
+    async with ClientSession(connector=connector) as session:
+        start = perf_counter()
+        stop_at = start + args.duration
+        tasks = [run_sensor(session, url + "sensor", recorder, f"Sensor {i}", stop_at, args,
+                            patterns[i % len(patterns)] if patterns else None)
+                 for i in range(args.sensors)]
+        if args.ping_rate:
+            tasks.append(run_pinger(session, url + "sensor", recorder, stop_at, args.ping_rate))
+        if args.update_rate:
+            tasks.append(run_telegram(session, url, recorder, stop_at, args.update_rate))
+        await asyncio.gather(*tasks)
+        elapsed = perf_counter() - start
+
+    # Don't wait for the rate limited alerts to drain before shutting down
+    pending_alerts = telegram.Dispatcher.pending()
+    telegram.Dispatcher.cancel()
+    await runner.cleanup()
+    await telegram.AlarmBot.close_session()
+    await api_runner.cleanup()
+
+    report = build_report(recorder, elapsed)
+    print_report(report, {"stored events": len(mongo.documents),
+                          "mongo write batches": mongo.writes,
+                          "telegram api calls": dict(telegram_api.calls),
+                          "alert broadcasts still rate limited at the end": pending_alerts})
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sensors", type=int, default=500, help="The amount of simulated sensors")
+    parser.add_argument("--duration", type=float, default=20, help="The length of the run in seconds")
+    parser.add_argument("--period", type=float, default=1, help="Seconds between readings of each sensor")
+    parser.add_argument("--change-probability", type=float, default=0.01,
+                        help="The chance that a synthetic sensor changes state on a reading")
+    parser.add_argument("--replay", help="Replay the status changes recorded in a CSV export (e.g. testing/sensor_data.csv)")
+    parser.add_argument("--speedup", type=float, default=60, help="How much faster recorded patterns are replayed")
+    parser.add_argument("--batch", type=int, default=1, help="Send readings as sensor_batch requests of this size")
+    parser.add_argument("--ping-rate", type=float, default=1, help="Uptime pings per second")
+    parser.add_argument("--update-rate", type=float, default=2, help="Telegram /status updates per second")
+    parser.add_argument("--mongo-latency", type=float, default=0, help="Simulated MongoDB round-trip time in ms")
+    parser.add_argument("--connections", type=int, default=0, help="Maximum open client connections (0 = unlimited)")
+    parser.add_argument("--json", help="Also write the report to this JSON file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)